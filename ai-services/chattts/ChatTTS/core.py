@@ -2,20 +2,34 @@ import os
 import logging
 import tempfile
 from dataclasses import dataclass, asdict
-from typing import Literal, Optional, List, Tuple, Dict, Union
+from typing import Literal, Optional, List, Tuple, Dict, Union, Iterable, Iterator
 from json import load
 from pathlib import Path
-import lzma
+import hashlib
 
 import numpy as np
 import torch
 from vocos import Vocos
 from vocos.pretrained import instantiate_class
 from huggingface_hub import snapshot_download
-import pybase16384 as b14
 
 from .config import Config
-from .model import DVAE, GPT, gen_logits, Tokenizer
+from .model import (
+    DVAE,
+    GPT,
+    gen_logits,
+    Tokenizer,
+    ContinuousBatchingEngine,
+    PrefixCache,
+)
+from .model.ort import (
+    OnnxDecoder,
+    OnnxVocos,
+    export_decoder,
+    export_vocos,
+    is_stale,
+    onnx_path,
+)
 from .utils import (
     check_all_assets,
     download_all_assets,
@@ -26,6 +40,8 @@ from .utils import (
 from .utils import logger as utils_logger
 
 from .norm import Normalizer
+from .stream import StreamDecoder
+from .pipeline import StagePipeline
 
 
 class Chat:
@@ -47,6 +63,26 @@ class Chat:
 
         self.context = GPT.Context()
 
+        # onnxruntime sessions replacing the decoder, dvae decoding and vocos
+        self.decoder_onnx: Optional[OnnxDecoder] = None
+        self.dvae_onnx: Optional[OnnxDecoder] = None
+        self.vocos_onnx: Optional[OnnxVocos] = None
+
+        # rows are decoded in buckets of similar length whose padding
+        # stays within this share of the decoded frames, 1 to disable
+        self.max_padding_waste = 0.25
+        # frames decoded for the rows and frames decoded as padding
+        self.decode_frames = 0
+        self.decode_padded_frames = 0
+
+    @property
+    def padding_waste(self) -> float:
+        """
+        share of the decoded frames that were padding so far
+        """
+        total = self.decode_frames + self.decode_padded_frames
+        return self.decode_padded_frames / total if total > 0 else 0.0
+
     def has_loaded(self, use_decoder=False):
         not_finish = False
         check_list = ["vocos", "gpt", "tokenizer"]
@@ -131,6 +167,15 @@ class Chat:
         device: Optional[torch.device] = None,
         coef: Optional[torch.Tensor] = None,
         use_flash_attn=False,
+        static_cache=False,
+        prefix_cache_size=8,
+        speculative_layers=0,
+        quantize: Optional[Literal["int8", "int4"]] = None,
+        dtype: Optional[Union[Literal["float32", "float16", "bfloat16"], torch.dtype]] = None,
+        onnx=False,
+        onnx_providers: Optional[List[str]] = None,
+        onnx_threads=0,
+        max_padding_waste=0.25,
     ) -> bool:
         download_path = self.download_models(source, force_redownload, custom_path)
         if download_path is None:
@@ -140,6 +185,15 @@ class Chat:
             compile=compile,
             coef=coef,
             use_flash_attn=use_flash_attn,
+            static_cache=static_cache,
+            prefix_cache_size=prefix_cache_size,
+            speculative_layers=speculative_layers,
+            quantize=quantize,
+            dtype=dtype,
+            onnx=onnx,
+            onnx_providers=onnx_providers,
+            onnx_threads=onnx_threads,
+            max_padding_waste=max_padding_waste,
             **{
                 k: os.path.join(download_path, v)
                 for k, v in asdict(self.config.path).items()
@@ -157,8 +211,14 @@ class Chat:
                 delattr(self, module)
         self.__init__(logger)
 
-    def sample_random_speaker(self) -> str:
-        return self.tokenizer._encode_spk_emb(self._sample_random_speaker())
+    def sample_random_speaker(self, compact=False, seed: Optional[int] = None) -> str:
+        """
+        with seed the speaker is drawn from a local generator,
+        leaving the global RNG of a concurrent inference untouched
+        """
+        return self.tokenizer._encode_spk_emb(
+            self._sample_random_speaker(seed), compact
+        )
 
     @torch.inference_mode()
     def sample_audio_speaker(self, wav: Union[np.ndarray, torch.Tensor]) -> str:
@@ -167,10 +227,16 @@ class Chat:
         return self.tokenizer._encode_prompt(self.dvae(wav, "encode").squeeze_(0))
 
     @torch.no_grad()
-    def _sample_random_speaker(self) -> torch.Tensor:
+    def _sample_random_speaker(self, seed: Optional[int] = None) -> torch.Tensor:
         dim: int = self.gpt.gpt.layers[0].mlp.gate_proj.in_features
+        generator = None
+        if seed is not None:
+            # same stream as torch.manual_seed(seed) on that device
+            generator = torch.Generator(self.std.device).manual_seed(seed)
         spk = (
-            torch.randn(dim, device=self.std.device, dtype=self.std.dtype)
+            torch.randn(
+                dim, device=self.std.device, dtype=self.std.dtype, generator=generator
+            )
             .mul_(self.std)
             .add_(self.mean)
         )
@@ -187,6 +253,8 @@ class Chat:
         min_new_token: int = 0
         show_tqdm: bool = True
         ensure_non_empty: bool = True
+        # remove finished rows from the batch while the others go on
+        compact_finished: bool = False
 
     @dataclass(repr=False, eq=False)
     class InferCodeParams(RefineTextParams):
@@ -200,6 +268,10 @@ class Chat:
         stream_batch: int = 24
         stream_speed: int = 12000
         pass_first_n_batches: int = 2
+        # left context in code frames and crossfade in samples
+        # used by the incremental stream decoder
+        stream_decode_context: int = 40
+        stream_crossfade: int = 512
 
     def infer(
         self,
@@ -213,7 +285,14 @@ class Chat:
         do_homophone_replacement=True,
         params_refine_text=RefineTextParams(),
         params_infer_code=InferCodeParams(),
+        return_lengths=False,
     ):
+        """
+        with return_lengths the non-stream result is (wavs, lengths),
+        lengths being the number of samples of each row before padding.
+        a stream yields (wavs, lengths) chunks instead, lengths counting
+        the samples of each row from the start of the stream
+        """
         self.context.set(False)
         res_gen = self._infer(
             text,
@@ -226,15 +305,153 @@ class Chat:
             do_homophone_replacement,
             params_refine_text,
             params_infer_code,
+            return_lengths,
         )
         if stream:
             return res_gen
         else:
             return next(res_gen)
 
+    def infer_groups(
+        self,
+        texts: Iterable[List[str]],
+        seed: Optional[int] = None,
+        lang=None,
+        skip_refine_text=False,
+        use_decoder=True,
+        do_text_normalization=True,
+        do_homophone_replacement=True,
+        params_refine_text=RefineTextParams(),
+        params_infer_code=InferCodeParams(),
+        queue_size=2,
+        return_exceptions=False,
+        return_lengths=False,
+    ) -> Iterator[np.ndarray]:
+        """
+        non-stream inference of several batches of texts, yielding the
+        wavs of each batch in order as `infer` returns them.
+
+        the gpt, the decoder and the vocoder run in their own threads,
+        so the decoding of one batch overlaps with the code generation
+        of the next ones. at most queue_size batches wait between two
+        stages. with seed, torch is seeded before each batch.
+        with return_lengths (wavs, lengths) is yielded, see `infer`.
+        """
+        self.context.set(False)
+        assert self.has_loaded(use_decoder=use_decoder)
+
+        def generate(text: List[str]) -> List[torch.Tensor]:
+            if seed is not None:
+                torch.manual_seed(seed)
+            text = self._prepare_text(
+                text,
+                lang,
+                skip_refine_text,
+                do_text_normalization,
+                do_homophone_replacement,
+                params_refine_text,
+            )
+            result = next(
+                self._infer_code(
+                    text,
+                    False,
+                    self.device,
+                    use_decoder,
+                    params_infer_code,
+                )
+            )
+            codes = list(result.hiddens if use_decoder else result.ids)
+            result.destroy()
+            return codes
+
+        def decode(codes: List[torch.Tensor]):
+            if len(codes) == 0:
+                return None
+            return self._decode_buckets(codes, use_decoder)
+
+        def vocode(decoded) -> np.ndarray:
+            if decoded is None:
+                wavs = np.array([], dtype=np.float32)
+                return (wavs, []) if return_lengths else wavs
+            return self._vocode_buckets(decoded, return_lengths)
+
+        # the gpt stays on the default stream its cuda graphs were captured on
+        pipeline = StagePipeline(
+            [generate, decode, vocode],
+            queue_size,
+            self.device,
+            use_streams=[False, True, True],
+            name="ChatTTS",
+        )
+        yield from pipeline.run(
+            (t if isinstance(t, list) else [t] for t in texts),
+            return_exceptions,
+        )
+
     def interrupt(self):
         self.context.set(True)
 
+    def new_code_engine(
+        self,
+        params_infer_code=InferCodeParams(),
+        max_batch_size=8,
+        use_decoder=True,
+    ) -> ContinuousBatchingEngine:
+        """
+        create a continuous batching engine sharing the sampling params,
+        feed it with `submit_code` and drive it with `engine.step()`
+        """
+        num_code = int(self.gpt.emb_code[0].num_embeddings - 1)
+        logits_warpers, logits_processors = gen_logits(
+            num_code=num_code,
+            top_P=params_infer_code.top_P,
+            top_K=params_infer_code.top_K,
+            repetition_penalty=params_infer_code.repetition_penalty,
+        )
+        return ContinuousBatchingEngine(
+            self.gpt,
+            eos_token=num_code,
+            max_batch_size=max_batch_size,
+            max_new_token=params_infer_code.max_new_token,
+            min_new_token=params_infer_code.min_new_token,
+            logits_warpers=logits_warpers,
+            logits_processors=logits_processors,
+            infer_text=False,
+            return_hidden=use_decoder,
+            ensure_non_empty=params_infer_code.ensure_non_empty,
+            logger=self.logger,
+        )
+
+    @torch.no_grad()
+    def submit_code(
+        self,
+        engine: ContinuousBatchingEngine,
+        text: List[str],
+        params_infer_code=InferCodeParams(),
+        tags: Optional[list] = None,
+    ):
+        """
+        queue the normalized (and refined) text into the engine,
+        one row per text, tagged by `tags` or by the index in text
+        """
+        if not isinstance(text, list):
+            text = [text]
+        emb, input_ids, attention_mask = self._prepare_infer_code_inputs(
+            list(text), params_infer_code
+        )
+        del input_ids
+        temperature = params_infer_code.temperature
+        if not isinstance(temperature, list):
+            temperature = [temperature] * self.gpt.num_vq
+        temperature = torch.tensor(temperature)
+        for i in range(emb.size(0)):
+            engine.submit(
+                emb[i][attention_mask[i].bool()],
+                temperature,
+                tags[i] if tags is not None else i,
+            )
+        del emb, attention_mask
+
     @torch.no_grad()
     def _load(
         self,
@@ -247,12 +464,31 @@ class Chat:
         compile: bool = True,
         coef: Optional[str] = None,
         use_flash_attn=False,
+        static_cache=False,
+        prefix_cache_size=8,
+        speculative_layers=0,
+        quantize: Optional[Literal["int8", "int4"]] = None,
+        dtype: Optional[Union[Literal["float32", "float16", "bfloat16"], torch.dtype]] = None,
+        onnx=False,
+        onnx_providers: Optional[List[str]] = None,
+        onnx_threads=0,
+        max_padding_waste=0.25,
     ):
         if device is None:
             device = select_device()
             self.logger.info("use device %s", str(device))
         self.device = device
         self.compile = compile
+        if isinstance(dtype, str):
+            dtype = getattr(torch, dtype)
+        if dtype == torch.float16 and "cuda" not in str(device):
+            self.logger.warning("float16 is only used on cuda, keep float32")
+            dtype = None
+        if dtype == torch.float:
+            dtype = None
+        # dtype of the gpt, decoder and vocos backbone, None for float32
+        self.dtype = dtype
+        self.max_padding_waste = max_padding_waste
 
         feature_extractor = instantiate_class(
             args=(), init=asdict(self.config.vocos.feature_extractor)
@@ -271,6 +507,9 @@ class Chat:
         )
         assert vocos_ckpt_path, "vocos_ckpt_path should not be None"
         vocos.load_state_dict(torch.load(vocos_ckpt_path, weights_only=True, mmap=True))
+        if dtype is not None and not onnx:
+            # the ISTFT head stays in float32, see _vocos_decode
+            vocos.backbone.to(dtype=dtype)
         self.vocos = vocos
         self.logger.log(logging.INFO, "vocos loaded.")
 
@@ -298,9 +537,23 @@ class Chat:
             logger=self.logger,
         ).eval()
         assert gpt_ckpt_path, "gpt_ckpt_path should not be None"
-        gpt.from_pretrained(gpt_ckpt_path)
-        gpt.prepare(compile=compile and "cuda" in str(device))
+        # weight-only quantized linear layers on cpu
+        gpt.from_pretrained(gpt_ckpt_path, quantize=quantize)
+        # the static decode step is also worth compiling on cpu
+        gpt.prepare(
+            compile=compile and ("cuda" in str(device) or static_cache),
+            static_cache=static_cache,
+            # single-stream code generation drafted by the first layers
+            speculative_layers=speculative_layers,
+            dtype=dtype,
+        )
         self.gpt = gpt
+        # KV states of the speaker + prompt prefix shared by requests
+        self.prefix_cache = (
+            PrefixCache(gpt, prefix_cache_size)
+            if prefix_cache_size > 0 and not gpt.is_te_llama
+            else None
+        )
         spk_stat_path = os.path.join(os.path.dirname(gpt_ckpt_path), "spk_stat.pt")
         assert os.path.exists(spk_stat_path), f"Missing spk_stat.pt: {spk_stat_path}"
         spk_stat: torch.Tensor = torch.load(
@@ -326,9 +579,21 @@ class Chat:
         decoder.load_state_dict(
             torch.load(decoder_ckpt_path, weights_only=True, mmap=True)
         )
+        if dtype is not None and not onnx:
+            # the onnx graphs are exported and run in float32
+            decoder.to(dtype=dtype)
         self.decoder = decoder
         self.logger.log(logging.INFO, "decoder loaded.")
 
+        if onnx:
+            self._load_onnx(
+                vocos_ckpt_path,
+                dvae_ckpt_path,
+                decoder_ckpt_path,
+                onnx_providers,
+                onnx_threads,
+            )
+
         if tokenizer_path:
             self.tokenizer = Tokenizer(tokenizer_path, device)
             self.logger.log(logging.INFO, "tokenizer loaded.")
@@ -349,6 +614,7 @@ class Chat:
         do_homophone_replacement=True,
         params_refine_text=RefineTextParams(),
         params_infer_code=InferCodeParams(),
+        return_lengths=False,
     ):
 
         assert self.has_loaded(use_decoder=use_decoder)
@@ -356,33 +622,27 @@ class Chat:
         if not isinstance(text, list):
             text = [text]
 
-        text = [
-            self.normalizer(
-                t,
-                do_text_normalization,
-                do_homophone_replacement,
-                lang,
-            )
-            for t in text
-        ]
-
-        if not skip_refine_text:
-            refined = self._refine_text(
-                text,
-                self.device,
-                params_refine_text,
-            )
-            text_tokens = refined.ids
-            text_tokens = [i[i.less(self.tokenizer.break_0_ids)] for i in text_tokens]
-            text = self.tokenizer.decode(text_tokens)
-            refined.destroy()
-            if refine_text_only:
-                yield text
-                return
+        text = self._prepare_text(
+            text,
+            lang,
+            skip_refine_text,
+            do_text_normalization,
+            do_homophone_replacement,
+            params_refine_text,
+        )
+        if not skip_refine_text and refine_text_only:
+            yield text
+            return
 
         if stream:
-            length = 0
+            decoder = StreamDecoder(
+                lambda x: self._decode_to_wavs(x, use_decoder),
+                hop_length=self.config.vocos.head.init_args.hop_length,
+                context=params_infer_code.stream_decode_context,
+                crossfade=params_infer_code.stream_crossfade,
+            )
             pass_batch_count = 0
+            skipped = None
         for result in self._infer_code(
             text,
             stream,
@@ -390,104 +650,308 @@ class Chat:
             use_decoder,
             params_infer_code,
         ):
-            wavs = self._decode_to_wavs(
-                result.hiddens if use_decoder else result.ids,
-                use_decoder,
-            )
-            result.destroy()
-            if stream:
-                pass_batch_count += 1
-                if pass_batch_count <= params_infer_code.pass_first_n_batches:
-                    continue
-                a = length
-                b = a + params_infer_code.stream_speed
-                if b > wavs.shape[1]:
-                    b = wavs.shape[1]
-                new_wavs = wavs[:, a:b]
-                length = b
-                yield new_wavs
-            else:
+            if not stream:
+                wavs = self._decode_to_wavs(
+                    result.hiddens if use_decoder else result.ids,
+                    use_decoder,
+                    return_lengths,
+                )
+                result.destroy()
                 yield wavs
+                continue
+            pass_batch_count += 1
+            if pass_batch_count <= params_infer_code.pass_first_n_batches:
+                # only the latest prefix is needed, decode it later
+                if skipped is not None:
+                    skipped.destroy()
+                skipped = result
+                continue
+            if skipped is not None:
+                skipped.destroy()
+                skipped = None
+            # only the frames after the decoded ones (plus context) are decoded
+            decoder.update(list(result.hiddens if use_decoder else result.ids))
+            result.destroy()
+            wavs = decoder.read(params_infer_code.stream_speed)
+            yield (wavs, decoder.lengths) if return_lengths else wavs
         if stream:
-            new_wavs = wavs[:, length:]
+            if skipped is not None:
+                decoder.update(list(skipped.hiddens if use_decoder else skipped.ids))
+                skipped.destroy()
+            decoder.flush()
+            new_wavs = decoder.read()
+            if return_lengths:
+                # the lengths tell the padding apart, keep every column
+                yield new_wavs, decoder.lengths
+                return
             # Identify rows with non-zero elements using np.any
             # keep_rows = np.any(array != 0, axis=1)
             keep_cols = np.sum(new_wavs != 0, axis=0) > 0
             # Filter both rows and columns using slicing
             yield new_wavs[:][:, keep_cols]
 
+    def _load_onnx(
+        self,
+        vocos_ckpt_path: str,
+        dvae_ckpt_path: str,
+        decoder_ckpt_path: str,
+        providers: Optional[List[str]] = None,
+        threads=0,
+    ):
+        """
+        run the feed-forward stages after the gpt with onnxruntime,
+        the graphs are exported next to the checkpoints when missing
+        or older than them
+        """
+        paths = []
+        for ckpt_path, module, export in (
+            (decoder_ckpt_path, self.decoder, export_decoder),
+            (dvae_ckpt_path, self.dvae, export_decoder),
+            (vocos_ckpt_path, self.vocos, export_vocos),
+        ):
+            path = onnx_path(ckpt_path)
+            if is_stale(path, ckpt_path):
+                self.logger.info("export %s", path)
+                export(module, path)
+            paths.append(path)
+        self.decoder_onnx = OnnxDecoder(
+            paths[0], self.decoder, providers, threads, self.logger
+        )
+        self.dvae_onnx = OnnxDecoder(
+            paths[1], self.dvae, providers, threads, self.logger
+        )
+        self.vocos_onnx = OnnxVocos(
+            paths[2], self.vocos.head, providers, threads, self.logger
+        )
+
+    def _prepare_text(
+        self,
+        text: List[str],
+        lang,
+        skip_refine_text: bool,
+        do_text_normalization: bool,
+        do_homophone_replacement: bool,
+        params_refine_text: RefineTextParams,
+    ) -> List[str]:
+        text = [
+            self.normalizer(
+                t,
+                do_text_normalization,
+                do_homophone_replacement,
+                lang,
+            )
+            for t in text
+        ]
+        if skip_refine_text:
+            return text
+        refined = self._refine_text(
+            text,
+            self.device,
+            params_refine_text,
+        )
+        text_tokens = refined.ids
+        text_tokens = [i[i.less(self.tokenizer.break_0_ids)] for i in text_tokens]
+        text = self.tokenizer.decode(text_tokens)
+        refined.destroy()
+        return text
+
     @staticmethod
-    @torch.no_grad()
-    def _encode_spk_emb(spk_emb: torch.Tensor) -> str:
-        arr: np.ndarray = spk_emb.to(dtype=torch.float16, device="cpu").numpy()
-        s = b14.encode_to_string(
-            lzma.compress(
-                arr.tobytes(),
-                format=lzma.FORMAT_RAW,
-                filters=[{"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME}],
-            ),
-        )
-        del arr
-        return s
+    def _encode_spk_emb(spk_emb: torch.Tensor, compact=False) -> str:
+        return Tokenizer._encode_spk_emb(spk_emb, compact)
+
+    @staticmethod
+    def _to_host(x: torch.Tensor) -> np.ndarray:
+        if not x.is_cuda:
+            return x.cpu().numpy()
+        # copy through pinned memory, waiting only for the current stream
+        host = torch.empty(x.shape, dtype=x.dtype, pin_memory=True)
+        host.copy_(x, non_blocking=True)
+        torch.cuda.current_stream(x.device).synchronize()
+        return host.numpy()
 
     @torch.inference_mode()
     def _vocos_decode(self, spec: torch.Tensor) -> np.ndarray:
+        if self.vocos_onnx is not None:
+            return self._to_host(self.vocos_onnx.decode(spec))
         if "mps" in str(self.device):
-            return self.vocos.decode(spec.cpu()).cpu().numpy()
-        else:
-            return self.vocos.decode(spec).cpu().numpy()
+            spec = spec.cpu()
+        if self.dtype is None:
+            return self._to_host(self.vocos.decode(spec))
+        # Vocos.decode with the backbone in half precision
+        # and the ISTFT head in float32
+        x = self.vocos.backbone(spec.to(self.dtype))
+        return self._to_host(self.vocos.head(x.float()))
 
     @torch.inference_mode()
     def _decode_to_wavs(
         self,
         result_list: List[torch.Tensor],
         use_decoder: bool,
+        return_lengths=False,
+    ):
+        if len(result_list) == 0:
+            wavs = np.array([], dtype=np.float32)
+            return (wavs, []) if return_lengths else wavs
+        return self._vocode_buckets(
+            self._decode_buckets(result_list, use_decoder), return_lengths
+        )
+
+    def _length_buckets(self, lens: List[int]) -> List[List[int]]:
+        """
+        rows sorted by length, longest first, grouped so that the
+        padding of each group stays within max_padding_waste
+        """
+        buckets: List[List[int]] = []
+        total = 0
+        for i in sorted(range(len(lens)), key=lambda i: -lens[i]):
+            if len(buckets) > 0:
+                bucket = buckets[-1]
+                padded = lens[bucket[0]] * (len(bucket) + 1)
+                waste = 1 - (total + lens[i]) / padded if padded > 0 else 0.0
+                if waste <= self.max_padding_waste:
+                    bucket.append(i)
+                    total += lens[i]
+                    continue
+            buckets.append([i])
+            total = lens[i]
+        return buckets
+
+    @torch.inference_mode()
+    def _decode_buckets(
+        self,
+        result_list: List[torch.Tensor],
+        use_decoder: bool,
+    ) -> List[Tuple[List[int], torch.Tensor, List[int]]]:
+        """
+        decode rows of similar length together instead of padding all
+        of them to the longest one, see _length_buckets.
+        returns the row indices, mel spectrograms and lengths of each bucket.
+        """
+        lens = [r.size(0) for r in result_list]
+        buckets = self._length_buckets(lens)
+        frames = sum(lens)
+        padded = sum(len(b) * lens[b[0]] for b in buckets)
+        self.decode_frames += frames
+        self.decode_padded_frames += padded - frames
+        if padded > 0:
+            self.logger.debug(
+                "decode %d rows in %d buckets, padding waste %.3f (unbucketed %.3f)",
+                len(lens),
+                len(buckets),
+                1 - frames / padded,
+                1 - frames / (len(lens) * max(lens)),
+            )
+        decoded = [
+            (b, *self._decode_to_mel([result_list[i] for i in b], use_decoder))
+            for b in buckets
+        ]
+        del_all(result_list)
+        return decoded
+
+    @torch.inference_mode()
+    def _vocode_buckets(
+        self,
+        decoded: List[Tuple[List[int], torch.Tensor, List[int]]],
+        return_lengths=False,
     ):
+        """
+        wavs of all the rows, and with return_lengths
+        the number of samples of each row before padding
+        """
+        lengths = [0] * sum(len(rows) for rows, _, _ in decoded)
+        parts = []
+        while len(decoded) > 0:
+            rows, mel_specs, x_lens = decoded.pop(0)
+            part, part_lengths = self._mel_to_wavs(mel_specs, x_lens)
+            del mel_specs
+            for row, length in zip(rows, part_lengths):
+                lengths[row] = length
+            parts.append((rows, part))
+        if len(parts) == 1:
+            # the rows of a bucket are sorted by length
+            wavs = parts[0][1][np.argsort(parts[0][0])]
+            return (wavs, lengths) if return_lengths else wavs
+        # as wide as one batch padded to the longest row, which is in the first
+        # bucket. the padded tail of each row is already silenced
+        wavs = np.zeros(
+            (sum(len(rows) for rows, _ in parts), parts[0][1].shape[1]),
+            dtype=parts[0][1].dtype,
+        )
+        for rows, part in parts:
+            wavs[rows, : part.shape[1]] = part
+        return (wavs, lengths) if return_lengths else wavs
+
+    @torch.inference_mode()
+    def _decode_to_mel(
+        self,
+        result_list: List[torch.Tensor],
+        use_decoder: bool,
+    ) -> Tuple[torch.Tensor, List[int]]:
+        """
+        padded mel spectrograms of the codes or hidden states (T, C)
+        of every row, and the number of code frames of each row
+        """
         decoder = self.decoder if use_decoder else self.dvae
+        onnx_decoder = self.decoder_onnx if use_decoder else self.dvae_onnx
         max_x_len = -1
-        if len(result_list) == 0:
-            return np.array([], dtype=np.float32)
         for result in result_list:
             if result.size(0) > max_x_len:
                 max_x_len = result.size(0)
+        dtype = result_list[0].dtype
+        if dtype.is_floating_point:
+            # hidden states of the gpt in the dtype of the decoder
+            dtype = (
+                torch.float
+                if onnx_decoder is not None
+                else next(decoder.parameters()).dtype
+            )
         batch_result = torch.zeros(
             (len(result_list), result_list[0].size(1), max_x_len),
-            dtype=result_list[0].dtype,
+            dtype=dtype,
             device=result_list[0].device,
         )
+        x_lens = []
         for i in range(len(result_list)):
             src = result_list[i]
+            x_lens.append(src.size(0))
             batch_result[i].narrow(1, 0, src.size(0)).copy_(src.permute(1, 0))
             del src
         del_all(result_list)
-        mel_specs = decoder(batch_result)
+        mel_specs = (onnx_decoder or decoder)(batch_result)
         del batch_result
+        return mel_specs, x_lens
+
+    @torch.inference_mode()
+    def _mel_to_wavs(
+        self, mel_specs: torch.Tensor, x_lens: List[int]
+    ) -> Tuple[np.ndarray, List[int]]:
+        """
+        wavs of the padded mel spectrograms with the padded tail of each
+        row silenced, and the number of samples of each row
+        """
+        mel_len = mel_specs.size(-1)
         wavs = self._vocos_decode(mel_specs)
         del mel_specs
-        return wavs
+        # every mel frame less is hop_length samples less
+        hop_length = self.config.vocos.head.init_args.hop_length
+        max_x_len = max(x_lens)
+        lengths = []
+        for i, x_len in enumerate(x_lens):
+            pad = mel_len - x_len * mel_len // max_x_len
+            length = max(0, wavs.shape[1] - pad * hop_length)
+            wavs[i, length:] = 0
+            lengths.append(length)
+        return wavs, lengths
 
     @torch.no_grad()
-    def _infer_code(
+    def _prepare_infer_code_inputs(
         self,
-        text: Tuple[List[str], str],
-        stream: bool,
-        device: torch.device,
-        return_hidden: bool,
+        text: List[str],
         params: InferCodeParams,
-    ):
+    ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
 
         gpt = self.gpt
 
-        if not isinstance(text, list):
-            text = [text]
-
-        assert len(text), "text should not be empty"
-
-        if not isinstance(params.temperature, list):
-            temperature = [params.temperature] * gpt.num_vq
-        else:
-            temperature = params.temperature
-
         for i, t in enumerate(text):
             text[i] = (
                 t.replace("[Stts]", "")
@@ -502,11 +966,7 @@ class Chat:
         if params.prompt:
             text = [params.prompt + i for i in text]
 
-        txt_smp = "" if params.txt_smp is None else params.txt_smp
-        if params.spk_emb is not None:
-            text = [f"[Stts][spk_emb]{txt_smp}{i}[Ptts]" for i in text]
-        else:
-            text = [f"[Stts][empty_spk]{txt_smp}{i}[Ptts]" for i in text]
+        text = [f"{self._infer_code_prefix(params, False)}{i}[Ptts]" for i in text]
 
         input_ids, attention_mask, text_mask = self.tokenizer.encode(
             text,
@@ -524,6 +984,110 @@ class Chat:
                 emb, params.spk_emb, input_ids, self.gpt.device_gpt
             )
 
+        return emb, input_ids, attention_mask
+
+    @staticmethod
+    def _infer_code_prefix(params: InferCodeParams, with_prompt=True) -> str:
+        """
+        the part of the wrapped text before the user text
+        """
+        txt_smp = "" if params.txt_smp is None else params.txt_smp
+        spk = "[spk_emb]" if params.spk_emb is not None else "[empty_spk]"
+        prefix = f"[Stts]{spk}{txt_smp}"
+        if with_prompt and params.prompt:
+            prefix += params.prompt
+        return prefix
+
+    @torch.no_grad()
+    def _apply_prefix_cache(
+        self,
+        emb: torch.Tensor,
+        input_ids: torch.Tensor,
+        attention_mask: torch.Tensor,
+        params: InferCodeParams,
+    ):
+        """
+        Move the prefix shared by all rows in front of the left padding,
+        so that its KV states can be taken from the prefix cache and
+        only the rest of each row needs prefill. The position ids are
+        computed from the attention mask, so they do not change.
+        """
+        if (
+            self.prefix_cache is None
+            or params.spk_smp is not None
+            # the static cache is always prefilled from scratch
+            or self.gpt.static_decoder is not None
+        ):
+            return emb, input_ids, attention_mask, None
+
+        prefix_ids = self.tokenizer._tokenizer.encode(
+            self._infer_code_prefix(params), add_special_tokens=False
+        )
+        prefix_len = len(prefix_ids)
+        seq_len = input_ids.size(1)
+        starts = (seq_len - attention_mask.sum(1)).tolist()
+        prefix_t = torch.tensor(prefix_ids, dtype=input_ids.dtype, device=input_ids.device)
+        for i, s in enumerate(starts):
+            if s + prefix_len > seq_len or not torch.equal(
+                input_ids[i, s : s + prefix_len, 0], prefix_t
+            ):
+                # the prompt was merged with the text by the tokenizer
+                return emb, input_ids, attention_mask, None
+
+        index = torch.tensor(
+            [
+                list(range(s, s + prefix_len))
+                + list(range(s))
+                + list(range(s + prefix_len, seq_len))
+                for s in starts
+            ],
+            device=input_ids.device,
+        )
+        attention_mask = attention_mask.gather(1, index.to(attention_mask.device))
+        input_ids = input_ids.gather(
+            1, index.unsqueeze(-1).expand(-1, -1, input_ids.size(2))
+        )
+        index = index.to(emb.device)
+        emb = emb.gather(1, index.unsqueeze(-1).expand(-1, -1, emb.size(2)))
+        del index, prefix_t
+
+        spk_hash = (
+            "" if params.spk_emb is None
+            else hashlib.sha256(params.spk_emb.encode()).hexdigest()
+        )
+        prefix_key_values = self.prefix_cache.get(
+            (spk_hash, self._infer_code_prefix(params)),
+            emb.narrow(0, 0, 1).narrow(1, 0, prefix_len),
+        )
+        return emb, input_ids, attention_mask, prefix_key_values
+
+    @torch.no_grad()
+    def _infer_code(
+        self,
+        text: Tuple[List[str], str],
+        stream: bool,
+        device: torch.device,
+        return_hidden: bool,
+        params: InferCodeParams,
+    ):
+
+        gpt = self.gpt
+
+        if not isinstance(text, list):
+            text = [text]
+
+        assert len(text), "text should not be empty"
+
+        if not isinstance(params.temperature, list):
+            temperature = [params.temperature] * gpt.num_vq
+        else:
+            temperature = params.temperature
+
+        emb, input_ids, attention_mask = self._prepare_infer_code_inputs(text, params)
+        emb, input_ids, attention_mask, prefix_key_values = self._apply_prefix_cache(
+            emb, input_ids, attention_mask, params
+        )
+
         num_code = int(gpt.emb_code[0].num_embeddings - 1)
 
         logits_warpers, logits_processors = gen_logits(
@@ -550,9 +1114,11 @@ class Chat:
             ensure_non_empty=params.ensure_non_empty,
             stream_batch=params.stream_batch,
             context=self.context,
+            prefix_key_values=prefix_key_values,
+            compact_finished=params.compact_finished,
         )
 
-        del emb, input_ids
+        del emb, input_ids, prefix_key_values
         del_all(logits_warpers)
         del_all(logits_processors)
 
@@ -606,6 +1172,7 @@ class Chat:
                 show_tqdm=params.show_tqdm,
                 ensure_non_empty=params.ensure_non_empty,
                 context=self.context,
+                compact_finished=params.compact_finished,
             )
         )
 
@@ -1,4 +1,6 @@
 from .dvae import DVAE
 from .gpt import GPT
+from .engine import ContinuousBatchingEngine
+from .prefix import PrefixCache
 from .processors import gen_logits
 from .tokenizer import Tokenizer
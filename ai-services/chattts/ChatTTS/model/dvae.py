@@ -10,6 +10,12 @@ import torchaudio
 from vector_quantize_pytorch import GroupedResidualFSQ
 
 
+def _gelu_(x: torch.Tensor) -> torch.Tensor:
+    if hasattr(torch._C._nn, "gelu_"):
+        return torch._C._nn.gelu_(x)
+    return x.copy_(F.gelu(x))
+
+
 class ConvNeXtBlock(nn.Module):
     def __init__(
         self,
@@ -64,6 +70,44 @@ class ConvNeXtBlock(nn.Module):
 
         return x
 
+    def forward_channels_last(
+        self, x: torch.Tensor, out: torch.Tensor, hidden: torch.Tensor
+    ) -> torch.Tensor:
+        """
+        the same block on x (B, T, C) without any transposes:
+        the depthwise conv reads and writes channels-last, gamma is folded
+        into pwconv2 and the residual is added by the same matmul.
+        out (B*T, C) and hidden (B*T, intermediate_dim) are scratch
+        buffers shared by the blocks, returns out viewed as (B, T, C).
+        """
+        B, T, C = x.shape
+        # (B, C, 1, T) with channels-last strides, the same memory as x
+        y = F.conv2d(
+            x.transpose(1, 2).unsqueeze(2),
+            self.dwconv.weight.unsqueeze(2),
+            self.dwconv.bias,
+            padding=(0, self.dwconv.padding[0]),
+            dilation=(1, self.dwconv.dilation[0]),
+            groups=C,
+        )
+        y = F.layer_norm(
+            y.squeeze(2).transpose(1, 2),
+            (C,),
+            self.norm.weight,
+            self.norm.bias,
+            self.norm.eps,
+        ).view(-1, C)
+        torch.addmm(self.pwconv1.bias, y, self.pwconv1.weight.t(), out=hidden)
+        del y
+        _gelu_(hidden)
+        weight = self.pwconv2.weight
+        bias = self.pwconv2.bias
+        if self.gamma is not None:
+            weight = weight * self.gamma.unsqueeze(1)
+            bias = bias * self.gamma
+        torch.addmm(x.view(-1, C), hidden, weight.t(), out=out)
+        return out.add_(bias).view(B, T, C)
+
 
 class GFSQ(nn.Module):
 
@@ -138,9 +182,12 @@ class DVAEDecoder(nn.Module):
         kernel=7,
         dilation=2,
         up=False,
+        fused=True,
     ):
         super().__init__()
         self.up = up
+        # channels-last blocks without autograd, see forward_channels_last
+        self.fused = fused
         self.conv_in = nn.Sequential(
             nn.Conv1d(idim, bn_dim, 3, 1, 1),
             nn.GELU(),
@@ -163,13 +210,34 @@ class DVAEDecoder(nn.Module):
         # B, C, T
         y = self.conv_in(x)
         del x
-        for f in self.decoder_block:
-            y = f(y, conditioning)
+        if self.fused and not torch.is_grad_enabled():
+            y = self._forward_blocks_channels_last(y)
+        else:
+            for f in self.decoder_block:
+                y = f(y, conditioning)
 
         x = self.conv_out(y)
         del y
         return x
 
+    def _forward_blocks_channels_last(self, y: torch.Tensor) -> torch.Tensor:
+        B, C, T = y.shape
+        x = y.transpose(1, 2).contiguous()
+        del y
+        # ping-pong residual buffers and one hidden buffer for all blocks
+        out = torch.empty((B * T, C), dtype=x.dtype, device=x.device)
+        spare = x.view(-1, C)
+        hidden = torch.empty(
+            (B * T, self.decoder_block[0].pwconv1.out_features),
+            dtype=x.dtype,
+            device=x.device,
+        )
+        for f in self.decoder_block:
+            x = f.forward_channels_last(x, out, hidden)
+            out, spare = spare, out
+        del out, spare, hidden
+        return x.transpose(1, 2)
+
 
 class MelSpectrogramFeatures(torch.nn.Module):
     def __init__(
@@ -0,0 +1,413 @@
+from collections import deque
+from dataclasses import dataclass
+import logging
+import threading
+from typing import Any, Deque, List, Optional, Tuple
+
+import torch
+import torch.nn.functional as F
+from transformers import LogitsWarper
+from transformers.modeling_outputs import BaseModelOutputWithPast
+
+from .gpt import GPT
+from .processors import CustomRepetitionPenaltyLogitsProcessorRepeat
+from ..utils import del_all
+
+
+class ContinuousBatchingEngine:
+    """
+    In-flight batching on top of GPT.
+
+    Every `step` generates one token for all active rows. Rows that hit EOS
+    (or `max_new_token`) are returned right away and evicted from the KV cache,
+    and queued prompts are prefilled into the freed slots, so that a long
+    sentence never holds the shorter ones hostage.
+
+    All rows of one engine share the same sampling warpers and processors,
+    temperatures may differ per row.
+    """
+
+    @dataclass(repr=False, eq=False)
+    class _Request:
+        emb: torch.Tensor
+        temperature: torch.Tensor
+        tag: Any
+
+    @dataclass(repr=False, eq=False)
+    class Output:
+        tag: Any
+        ids: torch.Tensor
+        hiddens: Optional[torch.Tensor]
+        complete: bool
+
+    def __init__(
+        self,
+        gpt: GPT,
+        eos_token: int,
+        max_batch_size=8,
+        max_new_token=2048,
+        min_new_token=0,
+        logits_warpers: List[LogitsWarper] = [],
+        logits_processors: List[CustomRepetitionPenaltyLogitsProcessorRepeat] = [],
+        infer_text=False,
+        return_hidden=False,
+        ensure_non_empty=True,
+        repetition_window=16,
+        logger=logging.getLogger(__name__),
+    ):
+        if gpt.is_te_llama:
+            raise ValueError("continuous batching needs the kv cache of LlamaModel")
+
+        self.gpt = gpt
+        self.eos_token = eos_token
+        self.max_batch_size = max_batch_size
+        self.max_new_token = max_new_token
+        self.min_new_token = min_new_token
+        self.logits_warpers = logits_warpers
+        self.logits_processors = logits_processors
+        self.infer_text = infer_text
+        self.return_hidden = return_hidden
+        self.ensure_non_empty = ensure_non_empty
+        self.repetition_window = repetition_window
+        self.logger = logger
+
+        self.num_vq = 1 if infer_text else gpt.num_vq
+
+        self._pending: Deque[ContinuousBatchingEngine._Request] = deque()
+        self._lock = threading.Lock()
+
+        self._tags: List[Any] = []
+        # per layer (key, value) of (B, heads, seq, head_dim), left padded
+        self._past_key_values: Optional[Tuple[Tuple[torch.Tensor, ...], ...]] = None
+        self._attention_mask: Optional[torch.Tensor] = None  # (B, seq)
+        self._next_emb: Optional[torch.Tensor] = None  # (B, 1, model_dim)
+        self._temperature: Optional[torch.Tensor] = None  # (B, num_vq)
+        self._ids: Optional[torch.Tensor] = None  # (B, max_new_token, num_vq)
+        self._hiddens: Optional[torch.Tensor] = None  # (B, max_new_token, model_dim)
+        self._lengths: Optional[torch.Tensor] = None  # (B,)
+
+    def submit(
+        self,
+        emb: torch.Tensor,
+        temperature: Optional[torch.Tensor] = None,
+        tag: Any = None,
+    ):
+        """
+        emb: (seq, model_dim) prompt embedding without padding
+        temperature: (num_vq,) or scalar
+        """
+        if temperature is None:
+            temperature = torch.ones(self.num_vq)
+        temperature = (
+            torch.as_tensor(temperature, dtype=torch.float)
+            .flatten()
+            .expand(self.num_vq)
+            .to(self.gpt.device)
+        )
+        with self._lock:
+            self._pending.append(self._Request(emb=emb, temperature=temperature, tag=tag))
+
+    def num_active(self) -> int:
+        return len(self._tags)
+
+    def num_pending(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def has_work(self) -> bool:
+        return self.num_active() > 0 or self.num_pending() > 0
+
+    def abort(self) -> List[Any]:
+        """
+        drop all active and queued rows, return their tags
+        """
+        with self._lock:
+            tags = self._tags + [r.tag for r in self._pending]
+            self._pending.clear()
+        self._reset()
+        return tags
+
+    @torch.no_grad()
+    def step(self) -> List[Output]:
+        """
+        Generate one token for every active row, admitting queued prompts
+        into free slots first. Returns the rows finished during this step.
+        """
+        hidden_states: Optional[torch.Tensor] = None
+        if self.num_active() > 0:
+            hidden_states = self._decode()
+        new_hidden_states = self._admit()
+        if new_hidden_states is not None:
+            if hidden_states is None:
+                hidden_states = new_hidden_states
+            else:
+                hidden_states = torch.cat([hidden_states, new_hidden_states], 0)
+            del new_hidden_states
+        if hidden_states is None:
+            return []
+
+        finished = self._sample(hidden_states)
+        del hidden_states
+
+        return self._evict(finished)
+
+    def _admit(self) -> Optional[torch.Tensor]:
+        with self._lock:
+            n = min(self.max_batch_size - self.num_active(), len(self._pending))
+            reqs = [self._pending.popleft() for _ in range(max(n, 0))]
+        if len(reqs) == 0:
+            return None
+
+        gpt = self.gpt
+        max_len = max(r.emb.size(0) for r in reqs)
+        emb = torch.zeros(
+            (len(reqs), max_len, gpt.model_dim),
+            dtype=gpt.gpt.dtype,
+            device=gpt.device_gpt,
+        )
+        attention_mask = torch.zeros(
+            (len(reqs), max_len), dtype=torch.long, device=gpt.device_gpt
+        )
+        for i, r in enumerate(reqs):
+            sz = r.emb.size(0)
+            emb[i].narrow(0, max_len - sz, sz).copy_(r.emb)  # left padding
+            attention_mask[i].narrow(0, max_len - sz, sz).fill_(1)
+        position_ids = attention_mask.cumsum(-1) - 1
+        position_ids.masked_fill_(attention_mask.eq(0), 1)
+
+        outputs: BaseModelOutputWithPast = gpt.gpt(
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=None,
+            inputs_embeds=emb,
+            use_cache=True,
+            cache_position=torch.arange(max_len, device=gpt.device_gpt),
+        )
+        del emb, position_ids
+        hidden_states = outputs.last_hidden_state.narrow(1, -1, 1).squeeze_(1)
+        self._merge(
+            outputs.past_key_values,
+            attention_mask,
+            [r.tag for r in reqs],
+            torch.stack([r.temperature for r in reqs], 0),
+        )
+        del_all(outputs)
+        del_all(reqs)
+        return hidden_states.to(gpt.device, dtype=gpt.head_dtype)
+
+    def _merge(
+        self,
+        past_key_values: Tuple[Tuple[torch.Tensor, ...], ...],
+        attention_mask: torch.Tensor,
+        tags: List[Any],
+        temperature: torch.Tensor,
+    ):
+        gpt = self.gpt
+        n = len(tags)
+        ids = torch.zeros(
+            (n, self.max_new_token, self.num_vq), dtype=torch.long, device=gpt.device
+        )
+        hiddens = (
+            torch.zeros(
+                (n, self.max_new_token, gpt.model_dim),
+                dtype=gpt.head_dtype,
+                device=gpt.device,
+            )
+            if self.return_hidden
+            else None
+        )
+        lengths = torch.zeros(n, dtype=torch.long, device=gpt.device)
+
+        if self.num_active() == 0:
+            self._past_key_values = past_key_values
+            self._attention_mask = attention_mask
+            self._tags = tags
+            self._temperature = temperature
+            self._ids = ids
+            self._hiddens = hiddens
+            self._lengths = lengths
+            return
+
+        # align both parts to the right, then stack them along the batch dim
+        old_len, new_len = self._attention_mask.size(1), attention_mask.size(1)
+        seq_len = max(old_len, new_len)
+        self._past_key_values = tuple(
+            tuple(
+                torch.cat(
+                    [
+                        F.pad(old, (0, 0, seq_len - old_len, 0)),
+                        F.pad(new, (0, 0, seq_len - new_len, 0)),
+                    ],
+                    0,
+                )
+                for old, new in zip(old_layer, new_layer)
+            )
+            for old_layer, new_layer in zip(self._past_key_values, past_key_values)
+        )
+        self._attention_mask = torch.cat(
+            [
+                F.pad(self._attention_mask, (seq_len - old_len, 0)),
+                F.pad(attention_mask, (seq_len - new_len, 0)),
+            ],
+            0,
+        )
+        self._tags.extend(tags)
+        self._temperature = torch.cat([self._temperature, temperature], 0)
+        self._ids = torch.cat([self._ids, ids], 0)
+        if self.return_hidden:
+            self._hiddens = torch.cat([self._hiddens, hiddens], 0)
+        self._lengths = torch.cat([self._lengths, lengths], 0)
+
+    def _decode(self) -> torch.Tensor:
+        gpt = self.gpt
+        attention_mask = F.pad(self._attention_mask, (0, 1), value=1)
+        position_ids = self._attention_mask.sum(1, keepdim=True)
+        outputs: BaseModelOutputWithPast = gpt.gpt(
+            attention_mask=attention_mask,
+            position_ids=position_ids,
+            past_key_values=self._past_key_values,
+            inputs_embeds=self._next_emb,
+            use_cache=True,
+            cache_position=torch.tensor(
+                [self._attention_mask.size(1)], device=gpt.device_gpt
+            ),
+        )
+        del position_ids
+        self._past_key_values = outputs.past_key_values
+        self._attention_mask = attention_mask
+        hidden_states = outputs.last_hidden_state.narrow(1, -1, 1).squeeze_(1)
+        del_all(outputs)
+        return hidden_states.to(gpt.device, dtype=gpt.head_dtype)
+
+    def _sample(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        gpt = self.gpt
+        batch = hidden_states.size(0)
+        rows = torch.arange(batch, device=gpt.device)
+
+        if self.return_hidden:
+            self._hiddens[rows, self._lengths] = hidden_states
+
+        logits = gpt._compute_logits(hidden_states, self.infer_text)
+        logits /= self._temperature.view(-1, 1)
+
+        if len(self.logits_processors) > 0:
+            # the last tokens of every row, histories shorter than the
+            # window are padded with -1
+            window = min(self.repetition_window, int(self._lengths.max()))
+            pos = self._lengths.unsqueeze(1) - window + torch.arange(
+                window, device=gpt.device
+            )
+            logits_token = self._ids.gather(
+                1,
+                pos.clamp(min=0).unsqueeze_(-1).expand(-1, -1, self.num_vq),
+            )
+            logits_token.masked_fill_(pos.lt(0).unsqueeze_(-1), -1)
+            logits_token = logits_token.permute(0, 2, 1).reshape(
+                batch * self.num_vq, window
+            )
+            del pos
+            for logitsProcessors in self.logits_processors:
+                logits = logitsProcessors(logits_token, logits)
+            del logits_token
+
+        for logitsWarpers in self.logits_warpers:
+            logits = logitsWarpers(None, logits)
+
+        min_new_token = self.min_new_token
+        if self.ensure_non_empty:
+            min_new_token = max(min_new_token, 1)
+        too_short = self._lengths.lt(min_new_token)
+        if too_short.any():
+            logits.view(batch, self.num_vq, -1)[too_short, :, self.eos_token] = (
+                -torch.inf
+            )
+        del too_short
+
+        scores = F.softmax(logits, dim=-1)
+        del logits
+        idx_next = torch.multinomial(scores, num_samples=1).view(batch, self.num_vq)
+        del scores
+
+        finished = idx_next.eq(self.eos_token).any(1)
+        self._ids[rows, self._lengths] = idx_next
+        self._lengths.add_(finished.logical_not().long())
+        finished.logical_or_(self._lengths.ge(self.max_new_token))
+
+        idx_emb = idx_next.to(gpt.device_gpt)
+        if self.infer_text:
+            emb: torch.Tensor = gpt.emb_text(idx_emb[:, 0])
+        else:
+            emb = torch.stack(
+                [gpt.emb_code[i](idx_emb[:, i]) for i in range(self.num_vq)], 2
+            ).sum(2)
+        self._next_emb = emb.unsqueeze_(1).to(gpt.gpt.dtype)
+        del idx_next, idx_emb, rows
+
+        return finished
+
+    def _evict(self, finished: torch.Tensor) -> List[Output]:
+        if not finished.any():
+            return []
+
+        results: List[ContinuousBatchingEngine.Output] = []
+        for i in finished.nonzero().view(-1).tolist():
+            length = int(self._lengths[i])
+            ids = self._ids[i].narrow(0, 0, length)
+            if self.infer_text:
+                ids = ids.narrow(1, 0, 1).squeeze_(1)
+            complete = length < self.max_new_token
+            if not complete:
+                self.logger.warning(
+                    f"incomplete result. hit max_new_token: {self.max_new_token}"
+                )
+            results.append(
+                self.Output(
+                    tag=self._tags[i],
+                    ids=ids.clone(),
+                    hiddens=(
+                        self._hiddens[i].narrow(0, 0, length).clone()
+                        if self.return_hidden
+                        else None
+                    ),
+                    complete=complete,
+                )
+            )
+
+        keep = finished.logical_not().nonzero().view(-1)
+        self._tags = [self._tags[i] for i in keep.tolist()]
+        if len(self._tags) == 0:
+            self._reset()
+            return results
+
+        keep_gpt = keep.to(self.gpt.device_gpt)
+        attention_mask = self._attention_mask.index_select(0, keep_gpt)
+        # drop the leading columns that became padding for every remaining row
+        start = int(attention_mask.any(0).long().argmax())
+        seq_len = attention_mask.size(1) - start
+        self._attention_mask = attention_mask.narrow(1, start, seq_len)
+        self._past_key_values = tuple(
+            tuple(
+                kv.index_select(0, keep_gpt).narrow(2, start, seq_len)
+                for kv in layer
+            )
+            for layer in self._past_key_values
+        )
+        self._next_emb = self._next_emb.index_select(0, keep_gpt)
+        self._temperature = self._temperature.index_select(0, keep)
+        self._ids = self._ids.index_select(0, keep)
+        if self.return_hidden:
+            self._hiddens = self._hiddens.index_select(0, keep)
+        self._lengths = self._lengths.index_select(0, keep)
+        del keep, keep_gpt, attention_mask
+
+        return results
+
+    def _reset(self):
+        self._tags = []
+        self._past_key_values = None
+        self._attention_mask = None
+        self._next_emb = None
+        self._temperature = None
+        self._ids = None
+        self._hiddens = None
+        self._lengths = None
@@ -1,3 +1,4 @@
+import os
 import platform
 from dataclasses import dataclass
 import logging
@@ -16,6 +17,9 @@ from transformers.modeling_outputs import BaseModelOutputWithPast
 from transformers.utils import is_flash_attn_2_available
 
 from .processors import CustomRepetitionPenaltyLogitsProcessorRepeat
+from .quant import WeightOnlyLinear, has_kernel, quantize_linears
+from .speculative import SpeculativeDecoder
+from .static import StaticDecoder
 from ..utils import del_all
 
 
@@ -82,8 +86,46 @@ class GPT(nn.Module):
                 for _ in range(self.num_vq)
             ],
         )
+        # (num_vq * num_audio_tokens, model_dim), built by prepare
+        self.head_code_fused: Optional[Union[torch.Tensor, WeightOnlyLinear]] = None
+        self.static_decoder: Optional[StaticDecoder] = None
+        self.speculative_decoder: Optional[SpeculativeDecoder] = None
+        # dtype of the hidden states fed to the heads, see prepare
+        self.head_dtype = torch.float
+        # rows that ended at the first step, resampled or not,
+        # see _resample_unexpected_eos
+        self.unexpected_eos_count = 0
+        self.unexpected_eos_retries = 4
+
+    def from_pretrained(
+        self, file_path: str, quantize: Optional[str] = None, group_size=128
+    ):
+        """
+        quantize: "int8" or "int4" to replace the linear layers by
+            weight-only quantized ones, CPU only. The result is cached
+            next to file_path as e.g. GPT.int8.pt. int8 is not used
+            if this torch version has no kernel for it.
+        """
 
-    def from_pretrained(self, file_path: str):
+        if quantize is not None and "cpu" not in str(self.device_gpt):
+            self.logger.warning(f"{quantize} quantization is only used on cpu")
+            quantize = None
+        if quantize is not None and not has_kernel({"int8": 8, "int4": 4}[quantize]):
+            # without a kernel the weight is dequantized on every call,
+            # slower than the float weights. int4 still saves most of the memory
+            if quantize == "int8":
+                self.logger.warning(
+                    f"no int8 kernel in torch {torch.__version__}, keep float weights"
+                )
+                quantize = None
+            else:
+                self.logger.warning(
+                    f"no int4 kernel in torch {torch.__version__}, "
+                    "it only saves memory and runs slower than float weights"
+                )
+        if quantize is not None:
+            self._load_quantized(file_path, quantize, group_size)
+            return
 
         self.load_state_dict(torch.load(file_path, weights_only=True, mmap=True))
 
@@ -106,6 +148,40 @@ class GPT(nn.Module):
                     f"use default LlamaModel for importing TELlamaModel error: {e}"
                 )
 
+    def _load_quantized(self, file_path: str, quantize: str, group_size: int):
+        bits = {"int8": 8, "int4": 4}[quantize]
+        cache_path = f"{os.path.splitext(file_path)[0]}.{quantize}.pt"
+        cached = None
+        if (
+            os.path.exists(cache_path)
+            and os.path.getmtime(cache_path) >= os.path.getmtime(file_path)
+        ):
+            try:
+                cached = torch.load(cache_path, weights_only=True, mmap=True)
+            except Exception as e:
+                self.logger.warning(f"load {cache_path} failed: {e}")
+            if cached is not None and cached.get("group_size") != group_size:
+                cached = None
+        if cached is not None:
+            quantize_linears(self, bits, group_size, empty=True, logger=self.logger)
+            self.load_state_dict(cached["state_dict"])
+            self.logger.info(f"load quantized gpt from {cache_path}")
+            return
+        self.load_state_dict(torch.load(file_path, weights_only=True, mmap=True))
+        count = quantize_linears(self, bits, group_size, logger=self.logger)
+        gc.collect()
+        self.logger.info(f"{count} linear layers quantized to {quantize}")
+        tmp = f"{cache_path}.{os.getpid()}.tmp"
+        try:
+            torch.save(
+                {"group_size": group_size, "state_dict": self.state_dict()}, tmp
+            )
+            os.replace(tmp, cache_path)
+        except Exception as e:
+            self.logger.warning(f"save {cache_path} failed: {e}")
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
     class Context:
         def __init__(self):
             self._interrupt = False
@@ -138,9 +214,53 @@ class GPT(nn.Module):
 
         return model.to(device), llama_config
 
-    def prepare(self, compile=False):
-        if self.use_flash_attn and is_flash_attn_2_available():
+    def prepare(
+        self,
+        compile=False,
+        static_cache=False,
+        static_cache_len=2560,
+        speculative_layers=0,
+        speculative_tokens=4,
+        dtype: Optional[torch.dtype] = None,
+        freeze=True,
+    ):
+        """
+        dtype: run the embeddings, the Llama body and the heads in
+            float16/bfloat16, only the logits are turned into float32
+            for the logits processors and sampling.
+        freeze: bake the weight norm of the heads into plain weights,
+            see freeze. the model can no longer be trained afterwards.
+        """
+        if freeze:
+            count = self.freeze()
+            if count > 0:
+                self.logger.debug(f"{count} parametrizations frozen")
+        self.fuse_head_code()
+        if dtype is not None and dtype != torch.float:
+            self.to(dtype=dtype)
+            if isinstance(self.head_code_fused, torch.Tensor):
+                self.head_code_fused = self.head_code_fused.to(dtype)
+            self.head_dtype = dtype
+        elif self.use_flash_attn and is_flash_attn_2_available():
             self.gpt = self.gpt.to(dtype=torch.float16)
+        if 0 < speculative_layers < len(self.gpt.layers) and not self.is_te_llama:
+            # single-row code generation drafted by the first layers
+            self.speculative_decoder = SpeculativeDecoder(
+                self,
+                draft_layers=speculative_layers,
+                num_draft=speculative_tokens,
+                logger=self.logger,
+            )
+        if static_cache and not self.is_te_llama:
+            # the fixed-shape decode step is compiled instead of the whole model
+            self.static_decoder = StaticDecoder(
+                self.gpt,
+                max_cache_len=static_cache_len,
+                compile=compile,
+                cuda_graph=compile and "cuda" in str(self.device_gpt),
+                logger=self.logger,
+            )
+            return
         if compile and not self.is_te_llama:
             try:
                 self.compile(backend="inductor", dynamic=True)
@@ -148,6 +268,38 @@ class GPT(nn.Module):
             except RuntimeError as e:
                 self.logger.warning(f"compile failed: {e}. fallback to normal mode.")
 
+    @torch.no_grad()
+    def freeze(self) -> int:
+        """
+        replace every parametrized weight, like the weight norm of
+        head_text and head_code, by a plain parameter holding its current
+        value, so that it is not computed again on every step.
+        returns the number of removed parametrizations.
+        """
+        count = 0
+        for module in list(self.modules()):
+            if not P.is_parametrized(module):
+                continue
+            for name in list(module.parametrizations.keys()):
+                P.remove_parametrizations(module, name, leave_parametrized=True)
+                count += 1
+        return count
+
+    @torch.no_grad()
+    def fuse_head_code(self):
+        """
+        resolve the weight norm of every head_code once and stack them,
+        so that all codebook logits come out of a single GEMM.
+        call it again after the weights are changed.
+        """
+        if isinstance(self.head_code[0], WeightOnlyLinear):
+            self.head_code_fused = WeightOnlyLinear.cat(list(self.head_code))
+            return
+        with P.cached():
+            self.head_code_fused = torch.cat(
+                [head.weight for head in self.head_code], 0
+            ).detach()
+
     def __call__(
         self, input_ids: torch.Tensor, text_mask: torch.Tensor
     ) -> torch.Tensor:
@@ -352,6 +504,137 @@ class GPT(nn.Module):
             hiddens=hiddens,
         )
 
+    def _compute_logits(
+        self, hidden_states: torch.Tensor, infer_text: bool
+    ) -> torch.Tensor:
+        """
+        (B, model_dim) -> (B, num_text_tokens) if infer_text
+        else (B * num_vq, num_audio_tokens)
+        """
+        with P.cached():
+            if infer_text:
+                logits: torch.Tensor = self.head_text(hidden_states)
+            elif self.head_code_fused is not None:
+                # (B, num_vq * num_audio_tokens) is already laid out as "(b n) c"
+                if isinstance(self.head_code_fused, WeightOnlyLinear):
+                    logits = self.head_code_fused(hidden_states)
+                else:
+                    logits = F.linear(hidden_states, self.head_code_fused)
+                return logits.float().view(-1, self.num_audio_tokens)
+            else:
+                # logits = torch.stack([self.head_code[i](hidden_states) for i in range(self.num_vq)], 2)
+                logits = torch.empty(
+                    hidden_states.size(0),
+                    self.num_audio_tokens,
+                    self.num_vq,
+                    dtype=torch.float,
+                    device=self.device,
+                )
+                for num_vq_iter in range(self.num_vq):
+                    x: torch.Tensor = self.head_code[num_vq_iter](hidden_states)
+                    logits[..., num_vq_iter] = x
+                    del x
+
+        logits = logits.float()
+
+        if not infer_text:
+            # logits = rearrange(logits, "b c n -> (b n) c")
+            logits = logits.permute(0, 2, 1)
+            logits = logits.reshape(-1, logits.size(2))
+
+        return logits
+
+    @torch.no_grad()
+    def prefill_prefix(self, emb: torch.Tensor) -> Tuple[Tuple[torch.FloatTensor]]:
+        """
+        emb: (1, P, model_dim) of a prefix without padding.
+        returns its KV states to be passed to generate as prefix_key_values.
+        """
+        outputs: BaseModelOutputWithPast = self.gpt(
+            position_ids=torch.arange(emb.size(1), device=self.device_gpt).unsqueeze_(0),
+            inputs_embeds=emb.to(self.device_gpt, self.gpt.dtype),
+            use_cache=True,
+        )
+        past_key_values = outputs.past_key_values
+        del_all(outputs)
+        return past_key_values
+
+    def _resample_unexpected_eos(
+        self,
+        scores: torch.Tensor,
+        idx_next: torch.Tensor,
+        eos_token: Union[int, torch.Tensor],
+        n: int,
+    ):
+        """
+        Resample in place the first token of the rows that ended at once,
+        instead of regenerating the whole batch. The rest of the batch
+        and the KV cache are kept. After unexpected_eos_retries attempts
+        EOS is masked out, which is the same distribution as retrying.
+
+        scores: (B * n, vocab) probabilities of the first step
+        idx_next: (B * n, 1) sampled tokens, n = num_vq in code mode
+        """
+        idx = idx_next.view(-1, n)
+        rows = idx.eq(eos_token).any(1).nonzero().squeeze_(1)
+        if rows.numel() == 0:
+            return
+        self.logger.warning(
+            "unexpected end at index %s, resample the first token", rows.tolist()
+        )
+        self.unexpected_eos_count += rows.numel()
+        offset = torch.arange(n, device=rows.device)
+        for retry in range(self.unexpected_eos_retries + 1):
+            row_scores = scores.index_select(
+                0, rows.unsqueeze(1).mul(n).add(offset).view(-1).to(scores.device)
+            )
+            if retry == self.unexpected_eos_retries:
+                no_eos = row_scores.clone()
+                no_eos[:, eos_token] = 0
+                # a row with nothing left but EOS stays empty
+                row_scores = torch.where(
+                    no_eos.sum(1, keepdim=True).gt(0), no_eos, row_scores
+                )
+                del no_eos
+            new_idx = torch.multinomial(row_scores, num_samples=1).to(idx.device)
+            del row_scores
+            new_idx = new_idx.view(-1, n)
+            idx.index_copy_(0, rows, new_idx)
+            rows = rows.masked_select(new_idx.eq(eos_token).any(1).to(rows.device))
+            del new_idx
+            if rows.numel() == 0:
+                return
+
+    @staticmethod
+    def _select_past_key_values(
+        past_key_values: Union[Cache, Tuple[Tuple[torch.FloatTensor]], None],
+        index: torch.Tensor,
+    ):
+        """
+        keep the rows in index of the KV states
+        """
+        if past_key_values is None:
+            return None
+        if isinstance(past_key_values, Cache):
+            for cache in (past_key_values.key_cache, past_key_values.value_cache):
+                for layer, t in enumerate(cache):
+                    cache[layer] = t.index_select(0, index.to(t.device))
+            return past_key_values
+        return tuple(
+            tuple(t.index_select(0, index.to(t.device)) for t in layer)
+            for layer in past_key_values
+        )
+
+    def _embed_next(self, input_ids: torch.Tensor, infer_text: bool) -> torch.Tensor:
+        """
+        (B, S, num_vq) -> (B, S, model_dim)
+        """
+        input_ids = input_ids.to(self.device_gpt)
+        if infer_text:
+            return self.emb_text(input_ids[:, :, 0])
+        code_emb = [self.emb_code[i](input_ids[:, :, i]) for i in range(self.num_vq)]
+        return torch.stack(code_emb, 3).sum(3)
+
     @torch.no_grad()
     def generate(
         self,
@@ -372,7 +655,42 @@ class GPT(nn.Module):
         ensure_non_empty=True,
         stream_batch=24,
         context=Context(),
+        prefix_key_values: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
+        compact_finished=False,
     ):
+        """
+        prefix_key_values: KV states of the first columns of inputs_ids,
+            shared by all rows (see prefill_prefix), only the rest is prefilled.
+        compact_finished: drop the finished rows from the batch instead of
+            decoding them until every row is done. Not used together with
+            return_attn or the static cache, whose batch size is fixed.
+        """
+
+        if (
+            self.speculative_decoder is not None
+            and not infer_text
+            and not return_attn
+            and inputs_ids.size(0) == 1
+        ):
+            yield from self.speculative_decoder.generate(
+                emb,
+                inputs_ids,
+                temperature,
+                eos_token,
+                attention_mask,
+                max_new_token,
+                min_new_token,
+                logits_warpers,
+                logits_processors,
+                return_hidden,
+                stream,
+                show_tqdm,
+                ensure_non_empty,
+                stream_batch,
+                context,
+                prefix_key_values,
+            )
+            return
 
         attentions: List[Optional[Tuple[torch.FloatTensor, ...]]] = []
         hiddens = []
@@ -383,8 +701,6 @@ class GPT(nn.Module):
         )
         finish = torch.zeros(inputs_ids.shape[0], device=inputs_ids.device).bool()
 
-        old_temperature = temperature
-
         temperature = (
             temperature.unsqueeze(0)
             .expand(inputs_ids.shape[0], -1)
@@ -417,6 +733,11 @@ class GPT(nn.Module):
         inputs_ids_buf.narrow(1, 0, progress).copy_(inputs_ids)
         del inputs_ids
         inputs_ids = inputs_ids_buf.narrow(1, 0, progress)
+        # the outputs of all rows, inputs_ids_buf only keeps
+        # the unfinished rows once the batch has been compacted
+        outputs_ids_buf = inputs_ids_buf
+        # original index of every row still in the batch, None before compaction
+        rows: Optional[torch.Tensor] = None
 
         pbar: Optional[tqdm] = None
 
@@ -428,78 +749,90 @@ class GPT(nn.Module):
             )
 
         past_key_values = None
+        if prefix_key_values is not None:
+            past_key_values = tuple(
+                (
+                    k.expand(inputs_ids.size(0), -1, -1, -1),
+                    v.expand(inputs_ids.size(0), -1, -1, -1),
+                )
+                for k, v in prefix_key_values
+            )
 
-        for i in range(max_new_token):
+        static_decoder = self.static_decoder
+        if static_decoder is not None and (
+            return_attn
+            # the static cache is always prefilled from scratch
+            or prefix_key_values is not None
+            or not static_decoder.start(attention_mask_cache)
+        ):
+            static_decoder = None
 
-            model_input = self._prepare_generation_inputs(
-                inputs_ids,
-                past_key_values,
-                attention_mask_cache.narrow(1, 0, inputs_ids.shape[1]),
-                use_cache=not self.is_te_llama,
-            )
+        if return_attn or static_decoder is not None:
+            compact_finished = False
 
-            if i > 0:
-                del emb
-                inputs_ids_emb = model_input.input_ids.to(self.device_gpt)
-                if infer_text:
-                    emb: torch.Tensor = self.emb_text(inputs_ids_emb[:, :, 0])
-                else:
-                    code_emb = [
-                        self.emb_code[i](inputs_ids_emb[:, :, i])
-                        for i in range(self.num_vq)
-                    ]
-                    emb = torch.stack(code_emb, 3).sum(3)
-                del inputs_ids_emb, model_input.input_ids
-            model_input.inputs_embeds = emb
-
-            model_input.to(self.device_gpt, self.gpt.dtype)
-
-            outputs: BaseModelOutputWithPast = self.gpt(
-                attention_mask=model_input.attention_mask,
-                position_ids=model_input.position_ids,
-                past_key_values=model_input.past_key_values,
-                inputs_embeds=model_input.inputs_embeds,
-                use_cache=model_input.use_cache,
-                output_attentions=return_attn,
-                cache_position=model_input.cache_position,
-            )
-            del_all(model_input)
-            attentions.append(outputs.attentions)
-            hidden_states = outputs.last_hidden_state.to(
-                self.device, dtype=torch.float
-            )  # 🐻
-            past_key_values = outputs.past_key_values
-            del_all(outputs)
-            if return_hidden:
-                hiddens.append(hidden_states.narrow(1, -1, 1).squeeze_(1))
+        for i in range(max_new_token):
 
-            with P.cached():
-                if infer_text:
-                    logits: torch.Tensor = self.head_text(hidden_states)
+            if static_decoder is not None:
+                if i > 0:
+                    del emb
+                    emb = self._embed_next(inputs_ids.narrow(1, -1, 1), infer_text)
+                hidden_states = static_decoder(emb)
+                attentions.append(None)
+            else:
+                model_input = self._prepare_generation_inputs(
+                    inputs_ids,
+                    past_key_values,
+                    attention_mask_cache.narrow(1, 0, inputs_ids.shape[1]),
+                    use_cache=not self.is_te_llama,
+                )
+
+                if i > 0:
+                    del emb
+                    emb = self._embed_next(model_input.input_ids, infer_text)
+                    del model_input.input_ids
+                    model_input.inputs_embeds = emb
                 else:
-                    # logits = torch.stack([self.head_code[i](hidden_states) for i in range(self.num_vq)], 3)
-                    logits = torch.empty(
-                        hidden_states.size(0),
-                        hidden_states.size(1),
-                        self.num_audio_tokens,
-                        self.num_vq,
-                        dtype=torch.float,
-                        device=self.device,
+                    # skip the columns already in prefix_key_values
+                    model_input.inputs_embeds = emb.narrow(
+                        1,
+                        inputs_ids.size(1) - model_input.cache_position.size(0),
+                        model_input.cache_position.size(0),
                     )
-                    for num_vq_iter in range(self.num_vq):
-                        x: torch.Tensor = self.head_code[num_vq_iter](hidden_states)
-                        logits[..., num_vq_iter] = x
-                        del x
 
-            del hidden_states
+                model_input.to(self.device_gpt, self.gpt.dtype)
+
+                outputs: BaseModelOutputWithPast = self.gpt(
+                    attention_mask=model_input.attention_mask,
+                    position_ids=model_input.position_ids,
+                    past_key_values=model_input.past_key_values,
+                    inputs_embeds=model_input.inputs_embeds,
+                    use_cache=model_input.use_cache,
+                    output_attentions=return_attn,
+                    cache_position=model_input.cache_position,
+                )
+                del_all(model_input)
+                attentions.append(outputs.attentions)
+                hidden_states = outputs.last_hidden_state
+                past_key_values = outputs.past_key_values
+                del_all(outputs)
+            # a no-op unless only the Llama body runs in half precision
+            hidden_states = hidden_states.to(self.device, dtype=self.head_dtype)  # 🐻
+            if return_hidden:
+                hidden = hidden_states.narrow(1, -1, 1).squeeze_(1)
+                if rows is not None:
+                    hidden = hidden.new_zeros(
+                        (finish.size(0), hidden.size(1))
+                    ).index_copy_(0, rows.to(hidden.device), hidden)
+                hiddens.append(hidden)
+                del hidden
+
+            logits = self._compute_logits(
+                hidden_states.narrow(1, -1, 1).squeeze_(1), infer_text
+            )
 
-            # logits = logits[:, -1].float()
-            logits = logits.narrow(1, -1, 1).squeeze_(1).float()
+            del hidden_states
 
             if not infer_text:
-                # logits = rearrange(logits, "b c n -> (b n) c")
-                logits = logits.permute(0, 2, 1)
-                logits = logits.reshape(-1, logits.size(2))
                 # logits_token = rearrange(inputs_ids[:, start_idx:], "b c n -> (b n) c")
                 inputs_ids_sliced = inputs_ids.narrow(
                     1,
@@ -541,72 +874,64 @@ class GPT(nn.Module):
 
             idx_next = torch.multinomial(scores, num_samples=1).to(finish.device)
 
+            if i == 0 and ensure_non_empty:
+                self._resample_unexpected_eos(
+                    scores, idx_next, eos_token, 1 if infer_text else self.num_vq
+                )
+
             del scores
 
             if not infer_text:
                 # idx_next = rearrange(idx_next, "(b n) 1 -> b n", n=self.num_vq)
                 idx_next = idx_next.view(-1, self.num_vq)
                 finish_or = idx_next.eq(eos_token).any(1)
-                finish.logical_or_(finish_or)
-                del finish_or
-                inputs_ids_buf.narrow(1, progress, 1).copy_(idx_next.unsqueeze_(1))
+                idx_next.unsqueeze_(1)
             else:
                 finish_or = idx_next.eq(eos_token).any(1)
+                idx_next = idx_next.unsqueeze_(-1).expand(-1, -1, self.num_vq)
+            inputs_ids_buf.narrow(1, progress, 1).copy_(idx_next)
+            if rows is None:
                 finish.logical_or_(finish_or)
-                del finish_or
-                inputs_ids_buf.narrow(1, progress, 1).copy_(
-                    idx_next.unsqueeze_(-1).expand(-1, -1, self.num_vq),
-                )
+            else:
+                finish.index_copy_(0, rows, finish.index_select(0, rows) | finish_or)
+                outputs_ids_buf.narrow(1, progress, 1).index_copy_(0, rows, idx_next)
 
-            if i == 0 and finish.any():
+            # with ensure_non_empty it was logged when resampled
+            if i == 0 and not ensure_non_empty and finish.any():
+                unexpected = finish.nonzero()
+                self.unexpected_eos_count += unexpected.size(0)
                 self.logger.warning(
                     "unexpected end at index %s",
-                    str([unexpected_idx.item() for unexpected_idx in finish.nonzero()]),
+                    str([unexpected_idx.item() for unexpected_idx in unexpected]),
                 )
-                if ensure_non_empty:
-                    if show_tqdm:
-                        pbar.close()
-                    self.logger.warning("regenerate in order to ensure non-empty")
-                    del_all(attentions)
-                    del_all(hiddens)
-                    del (
-                        start_idx,
-                        end_idx,
-                        finish,
-                        temperature,
-                        attention_mask_cache,
-                        past_key_values,
-                        idx_next,
-                        inputs_ids_buf,
-                    )
-                    new_gen = self.generate(
-                        emb,
-                        inputs_ids,
-                        old_temperature,
-                        eos_token,
-                        attention_mask,
-                        max_new_token,
-                        min_new_token,
-                        logits_warpers,
-                        logits_processors,
-                        infer_text,
-                        return_attn,
-                        return_hidden,
-                        stream,
-                        show_tqdm,
-                        ensure_non_empty,
-                        stream_batch,
-                        context,
-                    )
-                    for result in new_gen:
-                        yield result
-                    del inputs_ids
                 return
 
             del idx_next
             progress += 1
             inputs_ids = inputs_ids_buf.narrow(1, 0, progress)
 
+            if compact_finished and finish_or.any() and not finish.all():
+                keep = finish_or.logical_not().nonzero().squeeze_(1)
+                rows = keep if rows is None else rows.index_select(0, keep)
+                inputs_ids_buf = inputs_ids_buf.index_select(0, keep)
+                inputs_ids = inputs_ids_buf.narrow(1, 0, progress)
+                attention_mask_cache = attention_mask_cache.index_select(0, keep)
+                past_key_values = self._select_past_key_values(past_key_values, keep)
+                # rows of logits are "(b n)" in code mode
+                n = 1 if infer_text else self.num_vq
+                keep_logits = (
+                    keep.unsqueeze(1).mul(n).add(torch.arange(n, device=keep.device))
+                ).view(-1)
+                temperature = temperature.index_select(
+                    0, keep_logits.to(temperature.device)
+                )
+                for p in logits_processors:
+                    select_rows = getattr(p, "select_rows", None)
+                    if select_rows is not None:
+                        select_rows(keep_logits)
+                del keep, keep_logits
+            del finish_or
+
             not_finished = finish.logical_not().to(end_idx.device)
             end_idx.add_(not_finished.int())
             stream_iter += not_finished.any().int()
@@ -614,7 +939,7 @@ class GPT(nn.Module):
                 if stream_iter > 0 and stream_iter % stream_batch == 0:
                     self.logger.debug("yield stream result, end: %d", end_idx)
                     yield self._prepare_generation_outputs(
-                        inputs_ids,
+                        outputs_ids_buf.narrow(1, 0, progress),
                         start_idx,
                         end_idx,
                         attentions,
@@ -643,7 +968,7 @@ class GPT(nn.Module):
         del finish, inputs_ids_buf
 
         yield self._prepare_generation_outputs(
-            inputs_ids,
+            outputs_ids_buf.narrow(1, 0, progress),
             start_idx,
             end_idx,
             attentions,
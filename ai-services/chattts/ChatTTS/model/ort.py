@@ -0,0 +1,176 @@
+import copy
+import logging
+import os
+from typing import List, Optional, Tuple
+
+import torch
+import torch.nn as nn
+
+from .dvae import DVAE
+
+
+class _DecoderGraph(nn.Module):
+    """
+    the decode mode of DVAE.forward after the vq embedding,
+    whose reshapes do not keep dynamic axes, and without its out= ops
+    """
+
+    def __init__(self, dvae: DVAE):
+        super().__init__()
+        self.dvae = dvae
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        dvae = self.dvae
+        x = (
+            x.view((x.size(0), 2, x.size(1) // 2, x.size(2)))
+            .permute(0, 2, 3, 1)
+            .flatten(2)
+        )
+        return dvae.out_conv(dvae.decoder(x)) * dvae.coef
+
+
+class _VocosGraph(nn.Module):
+    """
+    Vocos.decode up to the complex spectrogram, the ISTFT is not
+    an onnx operator and stays in torch
+    """
+
+    def __init__(self, vocos):
+        super().__init__()
+        self.backbone = vocos.backbone
+        self.out = vocos.head.out
+
+    def forward(self, mel: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        x = self.out(self.backbone(mel)).transpose(1, 2)
+        mag, p = x.chunk(2, dim=1)
+        mag = torch.exp(mag).clip(max=1e2)
+        return mag * torch.cos(p), mag * torch.sin(p)
+
+
+def onnx_path(ckpt_path: str) -> str:
+    return os.path.splitext(ckpt_path)[0] + ".onnx"
+
+
+def is_stale(path: str, ckpt_path: str) -> bool:
+    return not os.path.exists(path) or os.path.getmtime(path) < os.path.getmtime(
+        ckpt_path
+    )
+
+
+@torch.no_grad()
+def export_decoder(dvae: DVAE, path: str, opset=17):
+    """
+    export the decoding of DVAE or the decoder with dynamic
+    batch and time axes, the vq embedding stays in torch
+    """
+    dvae = copy.deepcopy(dvae).float().cpu()
+    # the channels-last path relies on out= ops and scratch buffers
+    # that do not trace with dynamic axes
+    dvae.decoder.fused = False
+    x = torch.randn(1, dvae.decoder.conv_in[0].in_channels * 2, 16)
+    torch.onnx.export(
+        _DecoderGraph(dvae),
+        (x,),
+        path,
+        input_names=["x"],
+        output_names=["mel"],
+        dynamic_axes={"x": {0: "batch", 2: "time"}, "mel": {0: "batch", 2: "time"}},
+        opset_version=opset,
+    )
+
+
+@torch.no_grad()
+def export_vocos(vocos, path: str, opset=17):
+    """
+    export Vocos.decode without the ISTFT, see OnnxVocos
+    """
+    vocos = copy.deepcopy(vocos).float().cpu()
+    mel = torch.randn(1, vocos.backbone.embed.in_channels, 32)
+    torch.onnx.export(
+        _VocosGraph(vocos),
+        (mel,),
+        path,
+        input_names=["mel"],
+        output_names=["real", "imag"],
+        dynamic_axes={
+            "mel": {0: "batch", 2: "time"},
+            "real": {0: "batch", 2: "time"},
+            "imag": {0: "batch", 2: "time"},
+        },
+        opset_version=opset,
+    )
+
+
+class OnnxModule:
+    """
+    an exported graph run by onnxruntime, called with and
+    returning torch tensors like the module it was exported from
+    """
+
+    def __init__(
+        self,
+        path: str,
+        providers: Optional[List[str]] = None,
+        threads=0,
+        logger=logging.getLogger(__name__),
+    ):
+        import onnxruntime as ort
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if threads > 0:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(
+            path,
+            options,
+            providers=providers or ["CPUExecutionProvider"],
+        )
+        self.input_name = self.session.get_inputs()[0].name
+        logger.info(
+            "onnx %s loaded on %s", os.path.basename(path), self.session.get_providers()
+        )
+
+    def run(self, x: torch.Tensor) -> List[torch.Tensor]:
+        outputs = self.session.run(None, {self.input_name: x.cpu().numpy()})
+        return [torch.from_numpy(o) for o in outputs]
+
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        return self.run(x)[0]
+
+
+class OnnxDecoder(OnnxModule):
+    def __init__(
+        self,
+        path: str,
+        dvae: DVAE,
+        providers: Optional[List[str]] = None,
+        threads=0,
+        logger=logging.getLogger(__name__),
+    ):
+        super().__init__(path, providers, threads, logger)
+        self.vq_layer = (
+            None if dvae.vq_layer is None else copy.deepcopy(dvae.vq_layer).cpu()
+        )
+
+    @torch.inference_mode()
+    def __call__(self, x: torch.Tensor) -> torch.Tensor:
+        if self.vq_layer is not None:
+            x = self.vq_layer._embed(x.cpu())
+        return super().__call__(x.float())
+
+
+class OnnxVocos(OnnxModule):
+    def __init__(
+        self,
+        path: str,
+        head: nn.Module,
+        providers: Optional[List[str]] = None,
+        threads=0,
+        logger=logging.getLogger(__name__),
+    ):
+        super().__init__(path, providers, threads, logger)
+        self.istft = copy.deepcopy(head.istft).cpu()
+
+    def decode(self, mel: torch.Tensor) -> torch.Tensor:
+        real, imag = self.run(mel.float())
+        return self.istft(torch.complex(real, imag))
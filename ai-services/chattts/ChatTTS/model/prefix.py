@@ -0,0 +1,42 @@
+from collections import OrderedDict
+from typing import Optional, Tuple
+
+import torch
+
+from .gpt import GPT
+
+
+class PrefixCache:
+    """
+    LRU of the KV states of prompt prefixes shared by many requests,
+    such as the speaker embedding and the [speed_5] prompt.
+    """
+
+    def __init__(self, gpt: GPT, max_entries=8):
+        self.gpt = gpt
+        self.max_entries = max_entries
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[Tuple[torch.Tensor]]]" = (
+            OrderedDict()
+        )
+
+    def get(
+        self, key: Tuple[str, str], emb: Optional[torch.Tensor] = None
+    ) -> Optional[Tuple[Tuple[torch.Tensor]]]:
+        """
+        key: (speaker hash, prefix string)
+        emb: (1, P, model_dim) of the prefix, prefilled when key is missing
+        """
+        kv = self._entries.get(key)
+        if kv is not None:
+            self._entries.move_to_end(key)
+            return kv
+        if emb is None:
+            return None
+        kv = self.gpt.prefill_prefix(emb)
+        self._entries[key] = kv
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return kv
+
+    def clear(self):
+        self._entries.clear()
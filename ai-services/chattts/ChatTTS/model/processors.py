@@ -1,6 +1,8 @@
+from typing import Optional
+
 import torch
-import torch.nn.functional as F
-from transformers.generation import TopKLogitsWarper, TopPLogitsWarper
+
+from .sampler import TopKTopPLogitsWarper
 
 
 class CustomRepetitionPenaltyLogitsProcessorRepeat:
@@ -15,24 +17,89 @@ class CustomRepetitionPenaltyLogitsProcessorRepeat:
         self.max_input_ids = max_input_ids
         self.past_window = past_window
 
+        # rolling token count of the last window, see _update_freq
+        self._window: Optional[torch.Tensor] = None
+        self._freq: Optional[torch.Tensor] = None
+
     def __call__(
         self, input_ids: torch.LongTensor, scores: torch.FloatTensor
     ) -> torch.FloatTensor:
+        if input_ids.dim() == 3:
+            # (B, T, 1) in text mode
+            input_ids = input_ids.squeeze(-1)
         if input_ids.size(1) > self.past_window:
             input_ids = input_ids.narrow(1, -self.past_window, self.past_window)
-        freq = F.one_hot(input_ids, scores.size(1)).sum(1)
-        if freq.size(0) > self.max_input_ids:
-            freq.narrow(
-                0, self.max_input_ids, freq.size(0) - self.max_input_ids
-            ).zero_()
-        alpha = torch.pow(self.penalty, freq)
+        freq = self._update_freq(input_ids, scores.size(1))
+        # negative ids pad the shorter histories of a ragged batch,
+        # id 0 is looked up instead and gets exactly its own penalty
+        ids = input_ids.clamp(min=0).to(scores.device)
+        cnt = freq.gather(1, ids)
+        if cnt.size(0) > self.max_input_ids:
+            cnt.narrow(0, self.max_input_ids, cnt.size(0) - self.max_input_ids).zero_()
+        # only the tokens in the window can have a penalty other than 1
+        alpha = torch.pow(self.penalty, cnt)
         scores = scores.contiguous()
-        inp = scores.multiply(alpha)
-        oth = scores.divide(alpha)
-        con = scores < 0
-        out = torch.where(con, inp, oth)
-        del inp, oth, scores, con, alpha
-        return out
+        val = scores.gather(1, ids)
+        val = torch.where(val < 0, val.multiply(alpha), val.divide(alpha))
+        scores.scatter_(1, ids, val)
+        del cnt, alpha, val, ids
+        return scores
+
+    def _update_freq(self, window: torch.Tensor, vocab: int) -> torch.Tensor:
+        """
+        keep a (rows, vocab) token count of the window, updated
+        incrementally when the window just slid by one new token
+        """
+        last = self._window
+        if (
+            last is not None
+            and last.size(0) == window.size(0)
+            and self._freq.size(1) == vocab
+            and self._freq.device == window.device
+        ):
+            if window.size(1) == last.size(1) + 1 and torch.equal(
+                window.narrow(1, 0, last.size(1)), last
+            ):
+                # the window grew by one token
+                self._add(window.narrow(1, -1, 1), 1)
+                self._window = window.clone()
+                return self._freq
+            if (
+                window.size(1) == last.size(1)
+                and window.size(1) > 0
+                and torch.equal(
+                    window.narrow(1, 0, window.size(1) - 1),
+                    last.narrow(1, 1, last.size(1) - 1),
+                )
+            ):
+                # the oldest token left the window and a new one came in
+                self._add(last.narrow(1, 0, 1), -1)
+                self._add(window.narrow(1, -1, 1), 1)
+                self._window = window.clone()
+                return self._freq
+        self._freq = torch.zeros(
+            (window.size(0), vocab), dtype=torch.long, device=window.device
+        )
+        self._add(window, 1)
+        self._window = window.clone()
+        return self._freq
+
+    def select_rows(self, index: torch.Tensor):
+        """
+        keep the rows in index of the running count
+        after finished rows were removed from the batch
+        """
+        if self._window is None:
+            return
+        index = index.to(self._window.device)
+        self._window = self._window.index_select(0, index)
+        self._freq = self._freq.index_select(0, index)
+
+    def _add(self, ids: torch.Tensor, sign: int):
+        valid = ids.ge(0).long()
+        if sign < 0:
+            valid.neg_()
+        self._freq.scatter_add_(1, ids.clamp(min=0), valid)
 
 
 def gen_logits(
@@ -42,10 +109,9 @@ def gen_logits(
     repetition_penalty=1.0,
 ):
     logits_warpers = []
-    if top_P is not None:
-        logits_warpers.append(TopPLogitsWarper(top_P, min_tokens_to_keep=3))
-    if top_K is not None:
-        logits_warpers.append(TopKLogitsWarper(top_K, min_tokens_to_keep=3))
+    if top_P is not None or top_K is not None:
+        # same result as TopPLogitsWarper followed by TopKLogitsWarper
+        logits_warpers.append(TopKTopPLogitsWarper(top_P, top_K, min_tokens_to_keep=3))
 
     logits_processors = []
     if repetition_penalty is not None and repetition_penalty != 1:
@@ -0,0 +1,268 @@
+import logging
+from typing import Dict, List, Optional
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def _check_kernel(fn, reference: torch.Tensor) -> bool:
+    # the private kernels change their layouts and dtypes between
+    # torch versions, so each one is checked against the dequantized result
+    try:
+        out = fn()
+    except (RuntimeError, AttributeError, NotImplementedError):
+        return False
+    return out.shape == reference.shape and torch.allclose(
+        out.float(), reference.float(), rtol=5e-2, atol=5e-2
+    )
+
+
+# input dtype -> dtype the int8 kernel computes in, None if not usable
+_int8_kernel_dtype: Dict[torch.dtype, Optional[torch.dtype]] = {}
+
+
+class WeightOnlyLinear(nn.Module):
+    """
+    Linear layer without bias whose weight is stored as int8 with a scale
+    per output channel, or as int4 with a scale and zero point per group
+    of group_size inputs. The activations are not quantized.
+
+    On CPU the matmul runs in torch._weight_int8pack_mm or
+    torch._weight_int4pack_mm if this torch version provides them,
+    otherwise the weight is dequantized for F.linear on every call,
+    which is slower than the float layer, see has_kernel.
+    """
+
+    def __init__(
+        self,
+        in_features: int,
+        out_features: int,
+        bits=8,
+        group_size=128,
+        device: Optional[torch.device] = None,
+    ):
+        super().__init__()
+        if bits not in (4, 8):
+            raise ValueError(f"`bits` has to be 4 or 8, but is {bits}")
+        if bits == 4 and (in_features % group_size or group_size % 2):
+            raise ValueError(
+                f"in_features {in_features} is not a multiple of group_size {group_size}"
+            )
+        self.in_features = in_features
+        self.out_features = out_features
+        self.bits = bits
+        self.group_size = group_size
+        if bits == 8:
+            self.register_buffer(
+                "qweight",
+                torch.zeros(
+                    (out_features, in_features), dtype=torch.int8, device=device
+                ),
+            )
+            self.register_buffer(
+                "scales", torch.ones(out_features, dtype=torch.float, device=device)
+            )
+        else:
+            # two 4-bit values in every byte, the even column in the low half
+            self.register_buffer(
+                "qweight",
+                torch.zeros(
+                    (out_features, in_features // 2), dtype=torch.uint8, device=device
+                ),
+            )
+            # w = (q - 8) * scale + zero, as the int4 kernel expects
+            self.register_buffer(
+                "scales_and_zeros",
+                torch.zeros(
+                    (in_features // group_size, out_features, 2),
+                    dtype=torch.float,
+                    device=device,
+                ),
+            )
+        # kernel layout of the int4 weight, built on first use
+        self._int4_packed: Optional[torch.Tensor] = None
+        self._int4_checked = False
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, bits={self.bits}"
+
+    @classmethod
+    @torch.no_grad()
+    def from_float(cls, weight: torch.Tensor, bits=8, group_size=128):
+        out_features, in_features = weight.shape
+        layer = cls(in_features, out_features, bits, group_size, weight.device)
+        weight = weight.detach().float()
+        if bits == 8:
+            scales = weight.abs().amax(1).div_(127).clamp_(min=1e-8)
+            layer.qweight.copy_(
+                weight.div(scales.unsqueeze(1)).round_().clamp_(-127, 127)
+            )
+            layer.scales.copy_(scales)
+            return layer
+        groups = weight.view(out_features, -1, group_size)
+        w_min = groups.amin(2)
+        w_max = groups.amax(2)
+        scales = w_max.sub(w_min).div_(15).clamp_(min=1e-8)
+        zeros = w_min.add(scales.mul(8))
+        q = (
+            groups.sub(w_min.unsqueeze(2))
+            .div_(scales.unsqueeze(2))
+            .round_()
+            .clamp_(0, 15)
+            .to(torch.uint8)
+            .view(out_features, in_features)
+        )
+        layer.qweight.copy_(q[:, 0::2] | (q[:, 1::2] << 4))
+        layer.scales_and_zeros.copy_(torch.stack((scales, zeros), 2).transpose(0, 1))
+        return layer
+
+    @classmethod
+    @torch.no_grad()
+    def cat(cls, layers: List["WeightOnlyLinear"]) -> "WeightOnlyLinear":
+        """
+        stack the outputs of layers with the same input into one layer
+        """
+        first = layers[0]
+        layer = cls(
+            first.in_features,
+            sum(l.out_features for l in layers),
+            first.bits,
+            first.group_size,
+            first.qweight.device,
+        )
+        layer.qweight.copy_(torch.cat([l.qweight for l in layers], 0))
+        if first.bits == 8:
+            layer.scales.copy_(torch.cat([l.scales for l in layers], 0))
+        else:
+            layer.scales_and_zeros.copy_(
+                torch.cat([l.scales_and_zeros for l in layers], 1)
+            )
+        return layer
+
+    def _unpack_int4(self) -> torch.Tensor:
+        q = torch.stack((self.qweight & 15, self.qweight >> 4), 2)
+        return q.view(self.out_features, self.in_features)
+
+    def dequantize(self, dtype=torch.float) -> torch.Tensor:
+        if self.bits == 8:
+            return self.qweight.to(dtype).mul_(self.scales.unsqueeze(1).to(dtype))
+        q = self._unpack_int4().view(self.out_features, -1, self.group_size)
+        scales, zeros = self.scales_and_zeros.transpose(0, 1).unbind(2)
+        w = q.to(dtype).sub_(8).mul_(scales.unsqueeze(2).to(dtype))
+        return w.add_(zeros.unsqueeze(2).to(dtype)).view(
+            self.out_features, self.in_features
+        )
+
+    def _int8_dtype(self, x: torch.Tensor) -> Optional[torch.dtype]:
+        if x.dtype not in _int8_kernel_dtype:
+            _int8_kernel_dtype[x.dtype] = None
+            probe = WeightOnlyLinear.from_float(torch.randn(8, 64))
+            for dtype in (x.dtype, torch.bfloat16):
+                a = torch.randn(2, 64).to(dtype)
+                if _check_kernel(
+                    lambda: torch._weight_int8pack_mm(
+                        a, probe.qweight, probe.scales.to(dtype)
+                    ),
+                    F.linear(a.float(), probe.dequantize()),
+                ):
+                    _int8_kernel_dtype[x.dtype] = dtype
+                    break
+        return _int8_kernel_dtype[x.dtype]
+
+    def _pack_int4(self) -> Optional[torch.Tensor]:
+        if self.out_features % 8 or self.in_features % 128:
+            return None
+        q = self._unpack_int4()
+        a = torch.randn(2, self.in_features, dtype=torch.bfloat16)
+        reference = F.linear(a.float(), self.dequantize())
+        sz = self.scales_and_zeros.to(torch.bfloat16)
+        # torch < 2.5 takes int32 values, later versions two values per byte
+        for weight in (q.int(), (q[:, 0::2] << 4) | q[:, 1::2]):
+            try:
+                packed = torch._convert_weight_to_int4pack(weight, 8)
+            except (RuntimeError, AttributeError, NotImplementedError):
+                continue
+            if _check_kernel(
+                lambda: torch._weight_int4pack_mm(a, packed, self.group_size, sz),
+                reference,
+            ):
+                return packed
+        return None
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        shape = x.shape[:-1] + (self.out_features,)
+        on_cpu = x.device.type == "cpu"
+        if self.bits == 8:
+            dtype = self._int8_dtype(x) if on_cpu else None
+            if dtype is not None:
+                y = torch._weight_int8pack_mm(
+                    x.reshape(-1, self.in_features).to(dtype).contiguous(),
+                    self.qweight,
+                    self.scales.to(dtype),
+                )
+                return y.view(shape).to(x.dtype)
+            return F.linear(x, self.qweight.to(x.dtype)).mul_(self.scales.to(x.dtype))
+        if on_cpu and not self._int4_checked:
+            self._int4_checked = True
+            self._int4_packed = self._pack_int4()
+        if on_cpu and self._int4_packed is not None:
+            y = torch._weight_int4pack_mm(
+                x.reshape(-1, self.in_features).to(torch.bfloat16).contiguous(),
+                self._int4_packed,
+                self.group_size,
+                self.scales_and_zeros.to(torch.bfloat16),
+            )
+            return y.view(shape).to(x.dtype)
+        return F.linear(x, self.dequantize(x.dtype))
+
+
+@torch.no_grad()
+def has_kernel(bits=8, dtype=torch.float) -> bool:
+    """
+    whether this torch version has a working cpu kernel
+    for bits-wide weights and inputs of dtype
+    """
+    probe = WeightOnlyLinear.from_float(torch.randn(8, 128), bits)
+    if bits == 8:
+        return probe._int8_dtype(torch.empty(0, dtype=dtype)) is not None
+    return probe._pack_int4() is not None
+
+
+@torch.no_grad()
+def quantize_linears(
+    module: nn.Module,
+    bits=8,
+    group_size=128,
+    empty=False,
+    logger=logging.getLogger(__name__),
+) -> int:
+    """
+    replace every nn.Linear without bias in module by a WeightOnlyLinear,
+    including those with weight_norm whose weight is computed once here.
+    with empty=True the quantized weights are left to load_state_dict.
+    returns the number of replaced layers.
+    """
+    count = 0
+    for name, child in list(module.named_children()):
+        if not isinstance(child, nn.Linear):
+            count += quantize_linears(child, bits, group_size, empty, logger)
+            continue
+        if child.bias is not None:
+            continue
+        layer_bits = bits
+        if bits == 4 and child.in_features % group_size:
+            logger.warning(
+                f"{name} with {child.in_features} inputs is quantized to int8"
+            )
+            layer_bits = 8
+        if empty:
+            device = next(child.parameters()).device
+            layer = WeightOnlyLinear(
+                child.in_features, child.out_features, layer_bits, group_size, device
+            )
+        else:
+            layer = WeightOnlyLinear.from_float(child.weight, layer_bits, group_size)
+        setattr(module, name, layer)
+        count += 1
+    return count
@@ -0,0 +1,63 @@
+from typing import Optional
+
+import torch
+
+
+class TopKTopPLogitsWarper:
+    """
+    Top-k and top-p filtering in one pass.
+
+    Equivalent to TopPLogitsWarper followed by TopKLogitsWarper, but
+    only the k best candidates are sorted and checked against top_p,
+    with the probabilities still normalized over the whole vocab.
+    The filtered logits keep the full-vocab layout, so softmax and
+    torch.multinomial afterwards consume the same RNG stream as before.
+
+    Only the filtering is fused. The temperature division, the softmax
+    and torch.multinomial stay separate steps in GPT.generate: the
+    repetition penalty works on the tempered logits, the first-step EOS
+    resampling and speculative decoding need the full-vocab
+    probabilities, and sampling among the sorted candidates would pick
+    other tokens for the same random numbers.
+    """
+
+    def __init__(
+        self,
+        top_P: Optional[float] = None,
+        top_K: Optional[int] = None,
+        min_tokens_to_keep=1,
+        filter_value=-float("inf"),
+    ):
+        if top_P is not None and (top_P < 0 or top_P > 1.0):
+            raise ValueError(f"`top_p` has to be a float > 0 and < 1, but is {top_P}")
+        if top_K is not None and (not isinstance(top_K, int) or top_K <= 0):
+            raise ValueError(
+                f"`top_k` has to be a strictly positive integer, but is {top_K}"
+            )
+        self.top_P = top_P
+        self.top_K = None if top_K is None else max(top_K, min_tokens_to_keep)
+        self.min_tokens_to_keep = min_tokens_to_keep
+        self.filter_value = filter_value
+
+    def __call__(
+        self, input_ids: torch.LongTensor, scores: torch.FloatTensor
+    ) -> torch.FloatTensor:
+        vocab = scores.size(-1)
+        k = vocab if self.top_K is None else min(self.top_K, vocab)
+        # sorted in descending order
+        top_scores, top_indices = scores.topk(k, dim=-1)
+
+        if self.top_P is not None:
+            probs = top_scores.sub(scores.logsumexp(-1, keepdim=True)).exp_()
+            # a token is removed when the tokens ranked above it
+            # already hold top_p of the whole probability mass
+            mass_above = probs.cumsum(-1).sub_(probs)
+            to_remove = mass_above.ge(self.top_P)
+            to_remove.narrow(-1, 0, min(self.min_tokens_to_keep, k)).fill_(False)
+            top_scores.masked_fill_(to_remove, self.filter_value)
+            del probs, mass_above, to_remove
+
+        out = torch.full_like(scores, self.filter_value)
+        out.scatter_(-1, top_indices, top_scores)
+        del top_scores, top_indices
+        return out
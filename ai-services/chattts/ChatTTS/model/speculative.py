@@ -0,0 +1,368 @@
+import copy
+import logging
+from collections import OrderedDict
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
+
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from tqdm import tqdm
+from transformers import LlamaModel, LogitsWarper
+from transformers.cache_utils import DynamicCache
+
+from .processors import CustomRepetitionPenaltyLogitsProcessorRepeat
+
+if TYPE_CHECKING:
+    from .gpt import GPT
+
+
+class SpeculativeDecoder:
+    """
+    Speculative decoding of audio codes for a single row.
+
+    The draft is the first draft_layers layers of the same Llama (plus its
+    final norm and the code heads), so it shares the weights and the KV
+    cache of those layers with the full model. The draft proposes up to
+    num_draft frames, the full model scores them all in one forward pass.
+
+    Every codebook of a frame is sampled independently, so each draft
+    code is accepted with probability min(1, p/q) on its own and a
+    rejected code is resampled from norm(max(0, p - q)). Each code then
+    follows p exactly, and the frame is kept only if all of its codes
+    were accepted, otherwise it is the last frame of this round.
+    """
+
+    def __init__(
+        self,
+        gpt: "GPT",
+        draft_layers=4,
+        num_draft=4,
+        logger=logging.getLogger(__name__),
+    ):
+        self.gpt = gpt
+        self.num_draft = num_draft
+        self.logger = logger
+        self.draft = self._build_draft(gpt.gpt, draft_layers)
+        self.draft_layers = draft_layers
+
+        # statistics of the proposed and accepted draft frames
+        self.proposed = 0
+        self.accepted = 0
+
+    @staticmethod
+    def _build_draft(model: LlamaModel, num_layers: int) -> LlamaModel:
+        # a shallow copy shares every parameter, only the layer list is cut
+        draft = copy.copy(model)
+        draft._modules = OrderedDict(model._modules)
+        draft.layers = nn.ModuleList(list(model.layers)[:num_layers])
+        draft.config = copy.copy(model.config)
+        draft.config.num_hidden_layers = num_layers
+        return draft
+
+    @property
+    def acceptance_rate(self) -> float:
+        return self.accepted / self.proposed if self.proposed > 0 else 0.0
+
+    @staticmethod
+    def _crop(cache: DynamicCache, length: int):
+        for layer in range(len(cache.key_cache)):
+            cache.key_cache[layer] = cache.key_cache[layer].narrow(2, 0, length)
+            cache.value_cache[layer] = cache.value_cache[layer].narrow(2, 0, length)
+        cache._seen_tokens = length
+
+    def _draft_cache(self, cache: DynamicCache) -> DynamicCache:
+        # the draft layers see exactly the same KV as the first full layers,
+        # new entries go to the lists of the copy and are simply dropped
+        draft_cache = DynamicCache()
+        draft_cache.key_cache = cache.key_cache[: self.draft_layers]
+        draft_cache.value_cache = cache.value_cache[: self.draft_layers]
+        draft_cache._seen_tokens = cache._seen_tokens
+        return draft_cache
+
+    def _forward(
+        self,
+        model: LlamaModel,
+        emb: torch.Tensor,
+        cache: DynamicCache,
+        attention_mask: torch.Tensor,
+    ) -> torch.Tensor:
+        """
+        emb: (1, S, D) of the last S columns of attention_mask.
+        returns the hidden states (S, D) on gpt.device.
+        """
+        gpt = self.gpt
+        seq_len = emb.size(1)
+        end = attention_mask.size(1)
+        position_ids = attention_mask.long().cumsum(-1).sub_(1)
+        position_ids.masked_fill_(attention_mask.eq(0), 1)
+        hidden = model(
+            attention_mask=attention_mask.to(gpt.device_gpt),
+            position_ids=position_ids.narrow(1, -seq_len, seq_len).to(gpt.device_gpt),
+            past_key_values=cache,
+            inputs_embeds=emb.to(gpt.device_gpt, gpt.gpt.dtype),
+            use_cache=True,
+            cache_position=torch.arange(end - seq_len, end, device=gpt.device_gpt),
+        ).last_hidden_state
+        return hidden.squeeze(0).to(gpt.device, dtype=gpt.head_dtype)
+
+    def _probs(
+        self,
+        logits: torch.Tensor,
+        history: torch.Tensor,
+        temperature: torch.Tensor,
+        eos_token: Union[int, torch.Tensor],
+        mask_eos: bool,
+        logits_warpers: List[LogitsWarper],
+        logits_processors: List[CustomRepetitionPenaltyLogitsProcessorRepeat],
+    ) -> torch.Tensor:
+        """
+        the same processing as in GPT.generate
+        logits: (num_vq, vocab), history: (1, T, num_vq) generated so far
+        """
+        logits_token = history.permute(0, 2, 1).reshape(history.size(2), -1)
+        logits_token = logits_token.to(self.gpt.device)
+        logits /= temperature
+        for logitsProcessors in logits_processors:
+            logits = logitsProcessors(logits_token, logits)
+        for logitsWarpers in logits_warpers:
+            logits = logitsWarpers(logits_token, logits)
+        if mask_eos:
+            logits[:, eos_token] = -torch.inf
+        return F.softmax(logits, dim=-1)
+
+    @staticmethod
+    def _verify(
+        p: torch.Tensor, q: torch.Tensor, frame: torch.Tensor
+    ) -> Tuple[torch.Tensor, bool]:
+        """
+        p, q: (num_vq, vocab) of the full and the draft model
+        frame: (num_vq,) sampled from q
+        returns the frame that follows p and whether it is the draft one
+        """
+        index = frame.unsqueeze(1).to(p.device)
+        p_frame = p.gather(1, index).squeeze_(1)
+        q_frame = q.gather(1, index).squeeze_(1)
+        # r < p / q, q is not 0 as the code was sampled from it
+        accept = torch.rand_like(p_frame).mul_(q_frame).lt(p_frame)
+        if accept.all():
+            return frame, True
+        residual = p.sub(q).clamp_(min=0)
+        # no residual mass means p == q, which is always accepted
+        residual = torch.where(residual.sum(1, keepdim=True).gt(0), residual, p)
+        resampled = torch.multinomial(residual, num_samples=1).squeeze_(1)
+        return torch.where(accept, index.squeeze(1), resampled).to(frame.device), False
+
+    @torch.no_grad()
+    def generate(
+        self,
+        emb: torch.Tensor,
+        inputs_ids: torch.Tensor,
+        temperature: torch.Tensor,
+        eos_token: Union[int, torch.Tensor],
+        attention_mask: Optional[torch.Tensor] = None,
+        max_new_token=2048,
+        min_new_token=0,
+        logits_warpers: List[LogitsWarper] = [],
+        logits_processors: List[CustomRepetitionPenaltyLogitsProcessorRepeat] = [],
+        return_hidden=False,
+        stream=False,
+        show_tqdm=True,
+        ensure_non_empty=True,
+        stream_batch=24,
+        context: "GPT.Context" = None,
+        prefix_key_values: Optional[Tuple[Tuple[torch.FloatTensor]]] = None,
+    ):
+        """
+        GPT.generate of audio codes for inputs_ids of batch size 1
+        """
+        gpt = self.gpt
+        num_vq = gpt.num_vq
+        hiddens = []
+        # the draft has its own repetition counts as it runs ahead
+        draft_processors = copy.deepcopy(logits_processors)
+        temperature = temperature.view(-1, 1)
+
+        start_idx = inputs_ids.size(1)
+        progress = start_idx
+        end_idx = torch.zeros(1, device=inputs_ids.device, dtype=torch.long)
+        finish = False
+
+        attention_mask_cache = torch.ones(
+            (1, start_idx + max_new_token),
+            dtype=torch.bool,
+            device=inputs_ids.device,
+        )
+        if attention_mask is not None:
+            attention_mask_cache.narrow(1, 0, attention_mask.shape[1]).copy_(
+                attention_mask
+            )
+        inputs_ids_buf = torch.zeros(
+            1,
+            start_idx + max_new_token,
+            num_vq,
+            dtype=inputs_ids.dtype,
+            device=inputs_ids.device,
+        )
+        inputs_ids_buf.narrow(1, 0, start_idx).copy_(inputs_ids)
+        del inputs_ids
+
+        pbar: Optional[tqdm] = None
+        if show_tqdm:
+            pbar = tqdm(
+                total=max_new_token,
+                desc="code",
+                bar_format="{l_bar}{bar}| {n_fmt}/{total_fmt}(max) [{elapsed}, {rate_fmt}{postfix}]",
+            )
+
+        def history(end: int) -> torch.Tensor:
+            return inputs_ids_buf.narrow(1, start_idx, end - start_idx)
+
+        cache = DynamicCache.from_legacy_cache(prefix_key_values)
+        cached = cache.get_seq_length()
+        hidden = self._forward(
+            gpt.gpt,
+            emb.narrow(1, cached, start_idx - cached),
+            cache,
+            attention_mask_cache.narrow(1, 0, start_idx),
+        ).narrow(0, -1, 1)
+        # the first frame is sampled as usual
+        scores = self._probs(
+            gpt._compute_logits(hidden, False),
+            history(progress),
+            temperature,
+            eos_token,
+            min_new_token > 0,
+            logits_warpers,
+            logits_processors,
+        )
+        frame = torch.multinomial(scores, num_samples=1)
+        if ensure_non_empty:
+            gpt._resample_unexpected_eos(scores, frame, eos_token, num_vq)
+        del scores
+        frames = [frame.view(-1)]
+        frame_hiddens = [hidden]
+        stream_iter = 0
+
+        while True:
+            # commit the frames of the last round
+            for frame, hidden in zip(frames, frame_hiddens):
+                inputs_ids_buf[0, progress].copy_(frame)
+                progress += 1
+                if return_hidden:
+                    hiddens.append(hidden)
+                if frame.eq(eos_token).any():
+                    finish = True
+                    break
+                end_idx.add_(1)
+                stream_iter += 1
+                if stream and stream_iter % stream_batch == 0:
+                    yield gpt._prepare_generation_outputs(
+                        inputs_ids_buf.narrow(1, 0, progress),
+                        start_idx,
+                        end_idx,
+                        [],
+                        hiddens,
+                        False,
+                    )
+            if pbar is not None:
+                pbar.update(len(frames))
+            del frames, frame_hiddens
+
+            # with ensure_non_empty it was logged when resampled
+            if progress == start_idx + 1 and finish and not ensure_non_empty:
+                gpt.unexpected_eos_count += 1
+                self.logger.warning("unexpected end at index [0]")
+                return
+            generated = progress - start_idx
+            if finish or generated >= max_new_token or context.get():
+                break
+
+            # the draft runs ahead from the last committed frame
+            num_draft = min(self.num_draft, max_new_token - generated - 1)
+            draft_cache = self._draft_cache(cache)
+            draft_probs = []
+            last = inputs_ids_buf.narrow(1, progress - 1, 1)
+            for j in range(num_draft):
+                hidden = self._forward(
+                    self.draft,
+                    gpt._embed_next(last, False),
+                    draft_cache,
+                    attention_mask_cache.narrow(1, 0, progress + j),
+                )
+                q = self._probs(
+                    gpt._compute_logits(hidden, False),
+                    history(progress + j),
+                    temperature,
+                    eos_token,
+                    generated + j < min_new_token,
+                    logits_warpers,
+                    draft_processors,
+                )
+                frame = torch.multinomial(q, num_samples=1).view(-1)
+                draft_probs.append(q)
+                # written ahead, overwritten if the frame is rejected
+                inputs_ids_buf[0, progress + j].copy_(frame)
+                last = inputs_ids_buf.narrow(1, progress + j, 1)
+                if frame.eq(eos_token).any():
+                    break
+            del draft_cache
+            num_draft = len(draft_probs)
+
+            # the full model scores the last frame and all the draft frames at once
+            hidden = self._forward(
+                gpt.gpt,
+                gpt._embed_next(
+                    inputs_ids_buf.narrow(1, progress - 1, num_draft + 1), False
+                ),
+                cache,
+                attention_mask_cache.narrow(1, 0, progress + num_draft),
+            )
+            logits = gpt._compute_logits(hidden, False)
+            frames = []
+            frame_hiddens = []
+            for j in range(num_draft + 1):
+                p = self._probs(
+                    logits.narrow(0, j * num_vq, num_vq),
+                    history(progress + j),
+                    temperature,
+                    eos_token,
+                    generated + j < min_new_token,
+                    logits_warpers,
+                    logits_processors,
+                )
+                frame_hiddens.append(hidden.narrow(0, j, 1))
+                if j == num_draft:
+                    frames.append(torch.multinomial(p, num_samples=1).view(-1))
+                    break
+                frame, accepted = self._verify(
+                    p, draft_probs[j], inputs_ids_buf[0, progress + j]
+                )
+                frames.append(frame)
+                if not accepted:
+                    break
+            self.proposed += num_draft
+            self.accepted += len(frames) - 1
+            # keep the KV of the committed frames except the newest one
+            self._crop(cache, progress + len(frames) - 1)
+            del logits, hidden, draft_probs
+
+        if pbar is not None:
+            pbar.close()
+
+        if not finish:
+            if context.get():
+                self.logger.warning("generation is interrupted")
+            else:
+                self.logger.warning(
+                    f"incomplete result. hit max_new_token: {max_new_token}"
+                )
+
+        del cache
+        yield gpt._prepare_generation_outputs(
+            inputs_ids_buf.narrow(1, 0, progress),
+            start_idx,
+            end_idx,
+            [],
+            hiddens,
+            False,
+        )
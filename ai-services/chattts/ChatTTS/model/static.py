@@ -0,0 +1,212 @@
+import copy
+import logging
+from typing import Callable, Dict, Optional, Tuple
+
+import torch
+from transformers import LlamaModel
+from transformers.cache_utils import StaticCache
+
+
+class StaticDecoder:
+    """
+    Run LlamaModel on a preallocated KV cache.
+
+    The batch is padded to the nearest bucket size and the cache always
+    holds max_cache_len positions, so every single-token decode step
+    has exactly the same shapes and can be compiled once per bucket
+    (and captured into CUDA graphs on GPU) instead of being traced
+    through the dynamic cache path on every token.
+
+    The buckets share one cache sized for the largest bucket used so far,
+    the smaller ones are views of its first rows. It takes
+    2 * num_layers * bucket * max_cache_len * hidden_size elements,
+    about 2.5GB in float32 for 8 rows of the default 20 layer model
+    and 2560 positions. Generations run one at a time, so the rows
+    are never used by two buckets at once.
+    """
+
+    def __init__(
+        self,
+        gpt: LlamaModel,
+        max_cache_len=2560,
+        batch_buckets=(1, 2, 4, 8),
+        compile=False,
+        cuda_graph=False,
+        logger=logging.getLogger(__name__),
+    ):
+        self.gpt = gpt
+        self.max_cache_len = max_cache_len
+        self.batch_buckets = tuple(sorted(batch_buckets))
+        self.compile = compile
+        self.cuda_graph = cuda_graph
+        self.logger = logger
+
+        # bucket -> (cache, decode step), allocated on first use
+        self._buckets: Dict[int, Tuple[StaticCache, Callable]] = {}
+        # the cache of the largest bucket, the others are views of it
+        self._storage: Optional[StaticCache] = None
+
+        self._batch_size = 0
+        self._cache: Optional[StaticCache] = None
+        self._step: Optional[Callable] = None
+        self._progress = 0
+        self._attention_mask: Optional[torch.Tensor] = None
+        self._position_ids: Optional[torch.Tensor] = None
+        self._cache_position: Optional[torch.Tensor] = None
+
+    def bucket(self, batch_size: int) -> Optional[int]:
+        for b in self.batch_buckets:
+            if b >= batch_size:
+                return b
+        return None
+
+    def _view_cache(self, bucket: int) -> StaticCache:
+        storage = self._storage
+        if storage is not None and storage.max_batch_size >= bucket:
+            if storage.max_batch_size == bucket:
+                return storage
+            cache = copy.copy(storage)
+            cache.max_batch_size = bucket
+            cache.key_cache = [k.narrow(0, 0, bucket) for k in storage.key_cache]
+            cache.value_cache = [v.narrow(0, 0, bucket) for v in storage.value_cache]
+            for x in cache.key_cache + cache.value_cache:
+                torch._dynamo.mark_static_address(x)
+            return cache
+        # grow to the new largest bucket, the views of the old storage
+        # and the steps compiled on them are rebuilt on the next use
+        self._buckets.clear()
+        self._storage = None
+        param = next(self.gpt.parameters())
+        self._storage = StaticCache(
+            self.gpt.config,
+            bucket,
+            self.max_cache_len,
+            param.device,
+            param.dtype,
+        )
+        nbytes = sum(
+            x.nbytes for x in self._storage.key_cache + self._storage.value_cache
+        )
+        self.logger.info(
+            "static kv cache of %d rows: %.1f MB", bucket, nbytes / (1 << 20)
+        )
+        return self._storage
+
+    def _get_bucket(self, bucket: int) -> Tuple[StaticCache, Callable]:
+        if bucket in self._buckets:
+            return self._buckets[bucket]
+        cache = self._view_cache(bucket)
+
+        def step(
+            inputs_embeds: torch.Tensor,
+            attention_mask: torch.Tensor,
+            position_ids: torch.Tensor,
+            cache_position: torch.Tensor,
+        ) -> torch.Tensor:
+            return self.gpt(
+                attention_mask=attention_mask,
+                position_ids=position_ids,
+                past_key_values=cache,
+                inputs_embeds=inputs_embeds,
+                use_cache=True,
+                cache_position=cache_position,
+            ).last_hidden_state
+
+        if self.compile:
+            step = torch.compile(
+                step,
+                backend="inductor",
+                mode="reduce-overhead" if self.cuda_graph else None,
+                dynamic=False,
+            )
+        self._buckets[bucket] = (cache, step)
+        return cache, step
+
+    def start(self, attention_mask: torch.Tensor) -> bool:
+        """
+        attention_mask: (B, prefill + max_new_token) of the whole generation.
+        returns False if the generation does not fit into any bucket.
+        """
+        batch_size, length = attention_mask.shape
+        bucket = self.bucket(batch_size)
+        if bucket is None or length > self.max_cache_len:
+            return False
+        self._cache, self._step = self._get_bucket(bucket)
+        self._batch_size = batch_size
+        self._progress = 0
+
+        device = self._cache.key_cache[0].device
+        mask = torch.zeros(
+            (bucket, self.max_cache_len), dtype=torch.long, device=device
+        )
+        mask.narrow(1, 0, length).narrow(0, 0, batch_size).copy_(attention_mask)
+        # the padded rows attend to themselves only, their outputs are dropped
+        mask.narrow(0, batch_size, bucket - batch_size).fill_(1)
+        self._attention_mask = mask
+        self._position_ids = torch.zeros((bucket, 1), dtype=torch.long, device=device)
+        self._cache_position = torch.zeros(1, dtype=torch.long, device=device)
+        return True
+
+    def _pad(self, emb: torch.Tensor) -> torch.Tensor:
+        bucket = self._attention_mask.size(0)
+        if emb.size(0) == bucket:
+            return emb
+        padded = emb.new_zeros((bucket,) + emb.shape[1:])
+        padded.narrow(0, 0, emb.size(0)).copy_(emb)
+        return padded
+
+    @torch.no_grad()
+    def __call__(self, emb: torch.Tensor) -> torch.Tensor:
+        """
+        emb: (B, S, D), the whole prompt on the first call and
+        then the single new token of every step.
+        returns the hidden states (B, S, D).
+        """
+        dtype = self._cache.dtype
+        emb = self._pad(emb.to(self._attention_mask.device, dtype=dtype))
+        seq_len = emb.size(1)
+        if self._progress == 0 or seq_len != 1:
+            # prefill has a different length every time, run it eagerly
+            mask = self._attention_mask.narrow(1, 0, self._progress + seq_len)
+            position_ids = mask.cumsum(-1).sub_(1)
+            position_ids.masked_fill_(mask.eq(0), 1)
+            position_ids = position_ids.narrow(1, self._progress, seq_len)
+            self._position_ids.copy_(position_ids.narrow(1, -1, 1))
+            hidden = self.gpt(
+                attention_mask=self._attention_mask,
+                position_ids=position_ids,
+                past_key_values=self._cache,
+                inputs_embeds=emb,
+                use_cache=True,
+                cache_position=torch.arange(
+                    self._progress,
+                    self._progress + seq_len,
+                    device=emb.device,
+                ),
+            ).last_hidden_state
+        else:
+            self._position_ids.add_(1)
+            self._cache_position.fill_(self._progress)
+            hidden = self._step(
+                emb,
+                self._attention_mask,
+                self._position_ids,
+                self._cache_position,
+            )
+            if self.cuda_graph:
+                # the output buffer is overwritten by the next replay
+                hidden = hidden.clone()
+        self._progress += seq_len
+        return hidden.narrow(0, 0, self._batch_size)
+
+    def clear(self):
+        """
+        release all preallocated caches
+        """
+        self._buckets.clear()
+        self._storage = None
+        self._cache = None
+        self._step = None
+        self._attention_mask = None
+        self._position_ids = None
+        self._cache_position = None
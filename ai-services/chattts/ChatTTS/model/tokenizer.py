@@ -5,7 +5,8 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 https://stackoverflow.com/questions/62691279/how-to-disable-tokenizers-parallelism-true-false-warning
 """
 
-from typing import List, Tuple, Optional
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Optional
 import lzma
 
 import numpy as np
@@ -14,7 +15,17 @@ import torch
 import torch.nn.functional as F
 from transformers import BertTokenizerFast
 
-from ..utils import del_all
+# the lzma streams are raw, so the decoder needs a dictionary at least as
+# large as the encoder's. decoding keeps preset 9 to read the strings of
+# older versions, encoding with preset 0 is much faster and barely larger.
+_LZMA_DECODE_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME}]
+_LZMA_ENCODE_FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 0}]
+
+# compact speaker format: magic, version and number of values (<u2),
+# then the raw <f2 values. no lzma2 raw stream starts with "S".
+_SPK_MAGIC = b"SPK"
+_SPK_VERSION = 1
+_SPK_HEADER_SIZE = 6
 
 
 class Tokenizer:
@@ -33,6 +44,53 @@ class Tokenizer:
 
         self.decode = self._tokenizer.batch_decode
 
+        # text -> token ids, the same segments and prompt wrappers
+        # like [Stts][spk_emb]...[Ptts] come back across requests
+        self._encode_cache: "OrderedDict[str, List[int]]" = OrderedDict()
+        self.encode_cache_size = 1024
+
+        # spk_emb str -> decoded and L2-normalized embedding
+        self._spk_emb_cache: Dict[str, torch.Tensor] = {}
+
+        # recently decoded speakers and prompts that are not cached above
+        self._spk_emb_lru: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self._prompt_lru: "OrderedDict[str, torch.Tensor]" = OrderedDict()
+        self.decode_cache_size = 64
+
+    def _lru_get(self, cache: OrderedDict, key: str, load):
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+            return value
+        value = load(key)
+        cache[key] = value
+        while len(cache) > self.decode_cache_size:
+            cache.popitem(last=False)
+        return value
+
+    def _encode_ids(self, text: List[str]) -> List[List[int]]:
+        """
+        token ids of every text, the ones not seen recently
+        are encoded together in one call of the fast tokenizer
+        """
+        cache = self._encode_cache
+        ids = [cache.get(t) for t in text]
+        missing = list(dict.fromkeys(t for t, i in zip(text, ids) if i is None))
+        if len(missing) > 0:
+            encoded = dict(
+                zip(
+                    missing,
+                    self._tokenizer(missing, add_special_tokens=False)["input_ids"],
+                )
+            )
+            ids = [encoded[t] if i is None else i for t, i in zip(text, ids)]
+            cache.update(encoded)
+        for t in text:
+            cache.move_to_end(t)
+        while len(cache) > self.encode_cache_size:
+            cache.popitem(last=False)
+        return ids
+
     @torch.inference_mode()
     def encode(
         self,
@@ -42,103 +100,88 @@ class Tokenizer:
         device="cpu",
     ) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
 
-        input_ids_lst = []
-        attention_mask_lst = []
-        max_input_ids_len = -1
-        max_attention_mask_len = -1
         prompt_size = 0
 
-        prompt = self._decode_prompt(prompt_str) if prompt_str is not None else None
+        prompt = (
+            self._lru_get(self._prompt_lru, prompt_str, self._decode_prompt)
+            if prompt_str is not None
+            else None
+        )
 
         if prompt is not None:
             assert prompt.size(0) == num_vq, "prompt dim 0 must equal to num_vq"
             prompt_size = prompt.size(1)
 
         # avoid random speaker embedding of tokenizer in the other dims
-        for t in text:
-            x = self._tokenizer.encode_plus(
-                t, return_tensors="pt", add_special_tokens=False, padding=True
-            )
-            input_ids_lst.append(x["input_ids"].squeeze_(0))
-            attention_mask_lst.append(x["attention_mask"].squeeze_(0))
-            del_all(x)
-            ids_sz = input_ids_lst[-1].size(0)
-            if ids_sz > max_input_ids_len:
-                max_input_ids_len = ids_sz
-            attn_sz = attention_mask_lst[-1].size(0)
-            if attn_sz > max_attention_mask_len:
-                max_attention_mask_len = attn_sz
+        ids = self._encode_ids(text)
+        lens = torch.tensor([len(i) for i in ids], dtype=torch.long)
+        max_input_ids_len = int(lens.max()) + prompt_size
+        text_end = max_input_ids_len - prompt_size
 
-        if prompt is not None:
-            max_input_ids_len += prompt_size
-            max_attention_mask_len += prompt_size
-
-        input_ids = torch.zeros(
-            len(input_ids_lst),
-            max_input_ids_len,
-            device=device,
-            dtype=input_ids_lst[0].dtype,
-        )
-        for i in range(len(input_ids_lst)):
-            input_ids.narrow(0, i, 1).narrow(
-                1,
-                max_input_ids_len - prompt_size - input_ids_lst[i].size(0),
-                input_ids_lst[i].size(0),
-            ).copy_(
-                input_ids_lst[i]
-            )  # left padding
-        del_all(input_ids_lst)
-
-        attention_mask = torch.zeros(
-            len(attention_mask_lst),
-            max_attention_mask_len,
-            device=device,
-            dtype=attention_mask_lst[0].dtype,
+        # left padding, followed by the prompt in every row
+        cols = torch.arange(max_input_ids_len)
+        attention_mask = cols >= (text_end - lens).unsqueeze_(1)
+        text_mask = attention_mask & (cols < text_end)
+
+        input_ids = torch.zeros(len(ids), max_input_ids_len, dtype=torch.long)
+        input_ids[text_mask] = torch.tensor(
+            [i for row in ids for i in row], dtype=torch.long
         )
-        for i in range(len(attention_mask_lst)):
-            attn = attention_mask.narrow(0, i, 1)
-            attn.narrow(
-                1,
-                max_attention_mask_len - prompt_size - attention_mask_lst[i].size(0),
-                attention_mask_lst[i].size(0),
-            ).copy_(
-                attention_mask_lst[i]
-            )  # left padding
-            if prompt_size > 0:
-                attn.narrow(
-                    1,
-                    max_attention_mask_len - prompt_size,
-                    prompt_size,
-                ).fill_(1)
-        del_all(attention_mask_lst)
-
-        text_mask = attention_mask.bool()
         new_input_ids = input_ids.unsqueeze_(-1).expand(-1, -1, num_vq).clone()
         del input_ids
 
         if prompt_size > 0:
-            text_mask.narrow(1, max_input_ids_len - prompt_size, prompt_size).fill_(0)
             prompt_t = prompt.t().unsqueeze_(0).expand(new_input_ids.size(0), -1, -1)
-            new_input_ids.narrow(
-                1,
-                max_input_ids_len - prompt_size,
-                prompt_size,
-            ).copy_(prompt_t)
+            new_input_ids.narrow(1, text_end, prompt_size).copy_(prompt_t)
             del prompt_t
 
-        return new_input_ids, attention_mask, text_mask
+        return (
+            new_input_ids.to(device),
+            attention_mask.long().to(device),
+            text_mask.to(device),
+        )
 
     @staticmethod
     def _decode_spk_emb(spk_emb: str) -> np.ndarray:
+        dec = b14.decode_from_string(spk_emb)
+        if dec[: len(_SPK_MAGIC)] == _SPK_MAGIC:
+            n = int(np.frombuffer(dec, dtype="<u2", count=1, offset=4)[0])
+            if dec[3] != _SPK_VERSION or len(dec) != _SPK_HEADER_SIZE + 2 * n:
+                raise ValueError("invalid compact speaker embedding")
+            return np.frombuffer(
+                dec, dtype="<f2", offset=_SPK_HEADER_SIZE
+            ).astype(np.float16)
         return np.frombuffer(
             lzma.decompress(
-                b14.decode_from_string(spk_emb),
+                dec,
                 format=lzma.FORMAT_RAW,
-                filters=[{"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME}],
+                filters=_LZMA_DECODE_FILTERS,
             ),
             dtype=np.float16,
         ).copy()
 
+    @torch.no_grad()
+    def _normalize_spk_emb(self, spk_emb: str) -> torch.Tensor:
+        return F.normalize(
+            torch.from_numpy(
+                self._decode_spk_emb(spk_emb),
+            ),
+            p=2.0,
+            dim=0,
+            eps=1e-12,
+        )
+
+    def cache_spk_emb(self, spk_emb: str, device: torch.device):
+        """
+        keep the decoded embedding of a frequently used speaker on device,
+        unlike the small lru of apply_spk_emb it stays until uncached
+        """
+        if spk_emb not in self._spk_emb_cache:
+            self._spk_emb_cache[spk_emb] = self._normalize_spk_emb(spk_emb).to(device)
+
+    def uncache_spk_emb(self, spk_emb: str):
+        self._spk_emb_cache.pop(spk_emb, None)
+
     @torch.no_grad()
     def apply_spk_emb(
         self,
@@ -147,17 +190,12 @@ class Tokenizer:
         input_ids: torch.Tensor,
         device: torch.device,
     ):
+        n = self._spk_emb_cache.get(spk_emb)
+        if n is None:
+            n = self._lru_get(self._spk_emb_lru, spk_emb, self._normalize_spk_emb)
         n = (
-            F.normalize(
-                torch.from_numpy(
-                    self._decode_spk_emb(spk_emb),
-                ),
-                p=2.0,
-                dim=0,
-                eps=1e-12,
-            )
-            .to(device)
-            .unsqueeze_(0)
+            n.to(device, emb.dtype)
+            .unsqueeze(0)
             .expand(emb.size(0), -1)
             .unsqueeze_(1)
             .expand(emb.shape)
@@ -175,7 +213,7 @@ class Tokenizer:
             lzma.decompress(
                 dec[4:],
                 format=lzma.FORMAT_RAW,
-                filters=[{"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME}],
+                filters=_LZMA_DECODE_FILTERS,
             ),
             dtype="<u2",
         ).copy()
@@ -193,7 +231,7 @@ class Tokenizer:
             + lzma.compress(
                 arr.astype("<u2").tobytes(),
                 format=lzma.FORMAT_RAW,
-                filters=[{"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME}],
+                filters=_LZMA_ENCODE_FILTERS,
             ),
         )
         del arr
@@ -201,14 +239,26 @@ class Tokenizer:
 
     @staticmethod
     @torch.no_grad()
-    def _encode_spk_emb(spk_emb: torch.Tensor) -> str:
+    def _encode_spk_emb(spk_emb: torch.Tensor, compact=False) -> str:
+        """
+        compact=True stores the raw float16 values after a small header,
+        which loads without decompression but is not readable by
+        versions before the compact format
+        """
         arr: np.ndarray = spk_emb.to(dtype=torch.float16, device="cpu").numpy()
-        s = b14.encode_to_string(
-            lzma.compress(
+        if compact:
+            data = (
+                _SPK_MAGIC
+                + bytes([_SPK_VERSION])
+                + np.array([arr.size], dtype="<u2").tobytes()
+                + arr.astype("<f2").tobytes()
+            )
+        else:
+            data = lzma.compress(
                 arr.tobytes(),
                 format=lzma.FORMAT_RAW,
-                filters=[{"id": lzma.FILTER_LZMA2, "preset": 9 | lzma.PRESET_EXTREME}],
-            ),
-        )
+                filters=_LZMA_ENCODE_FILTERS,
+            )
+        s = b14.encode_to_string(data)
         del arr
         return s
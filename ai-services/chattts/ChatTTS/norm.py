@@ -1,7 +1,7 @@
 import json
 import logging
 import re
-from typing import Dict, Tuple, List, Literal, Callable, Optional
+from typing import Dict, Tuple, Literal, Callable, Optional
 import sys
 
 from numba import jit
@@ -11,27 +11,21 @@ from .utils import del_all
 
 
 @jit
-def _find_index(table: np.ndarray, val: np.uint16):
-    for i in range(table.size):
-        if table[i] == val:
-            return i
-    return -1
-
-
-@jit
-def _fast_replace(
-    table: np.ndarray, text: bytes
-) -> Tuple[np.ndarray, List[Tuple[str, str]]]:
+def _fast_replace(table: np.ndarray, text: bytes) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    translate the utf-16 code units of text by table,
+    returning the result and the positions replaced
+    """
     result = np.frombuffer(text, dtype=np.uint16).copy()
-    replaced_words = []
+    replaced = np.empty(result.size, dtype=np.int64)
+    n = 0
     for i in range(result.size):
-        ch = result[i]
-        p = _find_index(table[0], ch)
-        if p >= 0:
-            repl_char = table[1][p]
-            result[i] = repl_char
-            replaced_words.append((chr(ch), chr(repl_char)))
-    return result, replaced_words
+        ch = table[result[i]]
+        if ch != result[i]:
+            result[i] = ch
+            replaced[n] = i
+            n += 1
+    return result, replaced[:n]
 
 
 class Normalizer:
@@ -144,14 +138,16 @@ class Normalizer:
             self.logger.warning(f"found invalid characters: {invalid_characters}")
             text = self._apply_character_map(text)
         if do_homophone_replacement:
-            arr, replaced_words = _fast_replace(
-                self.homophones_map,
-                text.encode(self.coding),
-            )
-            if replaced_words:
+            encoded = text.encode(self.coding)
+            arr, replaced = _fast_replace(self.homophones_map, encoded)
+            if replaced.size:
                 text = arr.tobytes().decode(self.coding)
-                repl_res = ", ".join([f"{_[0]}->{_[1]}" for _ in replaced_words])
-                self.logger.info(f"replace homophones: {repl_res}")
+                if self.logger.isEnabledFor(logging.INFO):
+                    orig = np.frombuffer(encoded, dtype=np.uint16)
+                    repl_res = ", ".join(
+                        [f"{chr(orig[i])}->{chr(arr[i])}" for i in replaced]
+                    )
+                    self.logger.info(f"replace homophones: {repl_res}")
         if len(invalid_characters):
             text = self.reject_pattern.sub("", text)
         return text
@@ -182,9 +178,12 @@ class Normalizer:
     def _load_homophones_map(self, map_file_path: str) -> np.ndarray:
         with open(map_file_path, "r", encoding="utf-8") as f:
             homophones_map: Dict[str, str] = json.load(f)
-        map = np.empty((2, len(homophones_map)), dtype=np.uint32)
-        for i, k in enumerate(homophones_map.keys()):
-            map[:, i] = (ord(k), ord(homophones_map[k]))
+        # dense translation table indexed by utf-16 code unit, identity
+        # for the characters not in the map
+        map = np.arange(0x10000, dtype=np.uint16)
+        for k, v in homophones_map.items():
+            if ord(k) < 0x10000 and ord(v) < 0x10000:
+                map[ord(k)] = ord(v)
         del homophones_map
         return map
 
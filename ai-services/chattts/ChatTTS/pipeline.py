@@ -0,0 +1,163 @@
+import queue
+import threading
+from contextlib import nullcontext
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+import torch
+
+
+class _Failed:
+    __slots__ = ("error",)
+
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+_STOP = object()
+
+
+def _record_stream(x: Any, stream: torch.cuda.Stream):
+    # tensors made on another stream must not be reused by the caching
+    # allocator before the kernels of this stream are done with them
+    if isinstance(x, torch.Tensor):
+        if x.is_cuda:
+            x.record_stream(stream)
+    elif isinstance(x, (list, tuple)):
+        for v in x:
+            _record_stream(v, stream)
+    elif isinstance(x, dict):
+        for v in x.values():
+            _record_stream(v, stream)
+
+
+class StagePipeline:
+    """
+    Runs every item through the stages in order, each stage in its own
+    worker thread. The stages are connected by queues of at most
+    queue_size items, so a fast stage waits for a slow one instead of
+    piling up results (and device memory) ahead of it.
+
+    On CUDA the stages with use_streams set issue their kernels on
+    their own stream. The output of a stage is handed over with an event
+    that the next stage waits for on the device.
+    """
+
+    def __init__(
+        self,
+        stages: List[Callable[[Any], Any]],
+        queue_size=2,
+        device: Optional[torch.device] = None,
+        use_streams: Optional[List[bool]] = None,
+        name="pipeline",
+    ):
+        self.stages = stages
+        self.queue_size = max(1, int(queue_size))
+        self.use_cuda = (
+            device is not None
+            and torch.device(device).type == "cuda"
+            and torch.cuda.is_available()
+        )
+        self.device = device
+        self.use_streams = (
+            [True] * len(stages) if use_streams is None else list(use_streams)
+        )
+        self.name = name
+
+    def run(self, items: Iterable[Any], return_exceptions=False) -> Iterator[Any]:
+        """
+        yields the results of the last stage in the order of items.
+        a failed item raises at its position, or is yielded as
+        the exception with return_exceptions=True.
+        """
+        queues: List[queue.Queue] = [
+            queue.Queue(self.queue_size) for _ in range(len(self.stages) + 1)
+        ]
+        stop = threading.Event()
+
+        def put(q: queue.Queue, msg) -> bool:
+            while not stop.is_set():
+                try:
+                    q.put(msg, timeout=0.1)
+                    return True
+                except queue.Full:
+                    continue
+            return False
+
+        def get(q: queue.Queue):
+            while not stop.is_set():
+                try:
+                    return q.get(timeout=0.1)
+                except queue.Empty:
+                    continue
+            return _STOP
+
+        def feed():
+            try:
+                for item in items:
+                    if not put(queues[0], (item, None)):
+                        return
+            except Exception as e:
+                put(queues[0], (_Failed(e), None))
+            put(queues[0], _STOP)
+
+        def work(i: int):
+            fn = self.stages[i]
+            stream = None
+            if self.use_cuda and self.use_streams[i]:
+                stream = torch.cuda.Stream(self.device)
+            with torch.cuda.stream(stream) if stream is not None else nullcontext():
+                while True:
+                    msg = get(queues[i])
+                    if msg is _STOP:
+                        put(queues[i + 1], _STOP)
+                        return
+                    item, event = msg
+                    if not isinstance(item, _Failed):
+                        try:
+                            if event is not None:
+                                if stream is not None:
+                                    stream.wait_event(event)
+                                    _record_stream(item, stream)
+                                else:
+                                    torch.cuda.current_stream(
+                                        self.device
+                                    ).wait_event(event)
+                            item = fn(item)
+                            event = None
+                            if self.use_cuda:
+                                event = torch.cuda.Event()
+                                event.record(
+                                    stream or torch.cuda.current_stream(self.device)
+                                )
+                        except Exception as e:
+                            item = _Failed(e)
+                    if not put(queues[i + 1], (item, event)):
+                        return
+
+        threads = [
+            threading.Thread(target=feed, name=f"{self.name}-feed", daemon=True)
+        ] + [
+            threading.Thread(
+                target=work, args=(i,), name=f"{self.name}-{i}", daemon=True
+            )
+            for i in range(len(self.stages))
+        ]
+        for t in threads:
+            t.start()
+        try:
+            while True:
+                msg = get(queues[-1])
+                if msg is _STOP:
+                    return
+                item, event = msg
+                if event is not None:
+                    event.synchronize()
+                if isinstance(item, _Failed):
+                    if not return_exceptions:
+                        raise item.error
+                    item = item.error
+                yield item
+        finally:
+            stop.set()
+            for t in threads:
+                t.join()
@@ -0,0 +1,135 @@
+from typing import Callable, List, Optional
+
+import numpy as np
+import torch
+
+
+class StreamDecoder:
+    """
+    Incremental vocoder decoding for streaming inference.
+
+    Instead of decoding the whole accumulated prefix on every stream batch,
+    only the new frames plus `context` frames of left context are decoded.
+    The last `crossfade` samples of each window are held back and blended
+    with the next window, so the per-chunk cost stays constant no matter
+    how long the utterance gets.
+
+    Output columns are aligned across rows, like slicing the
+    full-prefix decoding result.
+    """
+
+    def __init__(
+        self,
+        decode: Callable[[List[torch.Tensor]], np.ndarray],
+        hop_length=256,
+        context=40,
+        crossfade=512,
+    ):
+        """
+        decode: frames (T, C) of every row -> padded wavs (B, samples)
+        hop_length: samples per mel frame, each code frame is 2 mel frames
+        context: left context in code frames
+        crossfade: samples held back and blended between windows
+        """
+        self.decode = decode
+        self.hop_length = hop_length
+        self.frame_length = 2 * hop_length
+        self.context = context
+        self.crossfade = crossfade
+
+        self._decoded: List[int] = []  # decoded code frames of each row
+        self._lengths: List[int] = []  # decoded samples of each row
+        self._ready: List[np.ndarray] = []  # final samples after the read cursor
+        self._tail: List[np.ndarray] = []  # held back samples after ready
+        self._cursor = 0  # absolute sample position of the next read
+
+    def _ensure_rows(self, n: int):
+        while len(self._decoded) < n:
+            self._decoded.append(0)
+            self._lengths.append(0)
+            self._ready.append(np.zeros(0, dtype=np.float32))
+            self._tail.append(np.zeros(0, dtype=np.float32))
+
+    def update(self, frames: List[torch.Tensor]):
+        """
+        frames: all generated frames (T, C) of every row so far
+        """
+        self._ensure_rows(len(frames))
+        rows = []
+        for i, f in enumerate(frames):
+            if f.size(0) > self._decoded[i]:
+                rows.append(i)
+            else:
+                # the row has finished, nothing to blend with anymore
+                self._release(i)
+        if len(rows) == 0:
+            return
+
+        starts = [max(0, self._decoded[i] - self.context) for i in rows]
+        windows = [frames[i].narrow(0, s, frames[i].size(0) - s) for i, s in zip(rows, starts)]
+        n_frames = [w.size(0) for w in windows]
+        max_n = max(n_frames)
+        wavs = self.decode(windows)
+        del windows
+        full = wavs.shape[1]
+
+        for j, (i, s, n) in enumerate(zip(rows, starts, n_frames)):
+            # (n * 2 - 1) * hop_length samples starting at s * frame_length
+            wav = wavs[j, : full - (max_n - n) * self.frame_length]
+            offset = s * self.frame_length
+            # absolute position of the first sample not yet fixed
+            pending = self._cursor + self._ready[i].size
+            new = wav[pending - offset :]
+            tail = self._tail[i]
+            if tail.size > 0:
+                fade = min(tail.size, new.size)
+                w = np.linspace(0.0, 1.0, fade, endpoint=False, dtype=np.float32)
+                new = new.copy()
+                new[:fade] = tail[:fade] * (1.0 - w) + new[:fade] * w
+            hold = min(self.crossfade, new.size)
+            self._ready[i] = np.concatenate([self._ready[i], new[: new.size - hold]])
+            self._tail[i] = new[new.size - hold :].copy()
+            self._decoded[i] = frames[i].size(0)
+            self._lengths[i] = offset + wav.size
+        del wavs
+
+    @property
+    def lengths(self) -> List[int]:
+        """
+        samples of each row decoded so far, counted from the first one.
+        the columns after it in the output of read are padding
+        """
+        return list(self._lengths)
+
+    def flush(self):
+        """
+        no more frames will come, release the held back samples
+        """
+        for i in range(len(self._ready)):
+            self._release(i)
+
+    def _release(self, i: int):
+        if self._tail[i].size == 0:
+            return
+        self._ready[i] = np.concatenate([self._ready[i], self._tail[i]])
+        self._tail[i] = np.zeros(0, dtype=np.float32)
+
+    def read(self, max_samples: Optional[int] = None) -> np.ndarray:
+        """
+        pop up to max_samples aligned columns of every row, (B, n)
+        """
+        if len(self._ready) == 0:
+            return np.zeros((0, 0), dtype=np.float32)
+        # rows still generating must not fall behind the cursor,
+        # finished rows are padded with silence
+        active = [r.size for r, t in zip(self._ready, self._tail) if t.size > 0]
+        n = min(active) if len(active) else max(r.size for r in self._ready)
+        if max_samples is not None:
+            n = min(n, max_samples)
+        out = np.zeros((len(self._ready), n), dtype=np.float32)
+        for i, r in enumerate(self._ready):
+            m = min(n, r.size)
+            out[i, :m] = r[:m]
+            self._ready[i] = r[m:]
+        self._cursor += n
+        return out
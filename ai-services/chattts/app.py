@@ -46,12 +46,32 @@ from random import random
 from modelscope import snapshot_download
 import numpy as np
 import threading
+import queue
 from uilib.cfg import WEB_ADDRESS, SPEAKER_DIR, LOGS_DIR, WAVS_DIR, MODEL_DIR, ROOT_DIR
 from uilib import utils, VERSION
 from ChatTTS.utils import select_device
 from uilib.utils import is_chinese_os, modelscope_status
+from uilib.scheduler import InferScheduler
+from uilib.cache import SynthesisCache
+from uilib.speaker import SpeakerRegistry
+from tools.audio import float_to_pcm16, wav_header
 
 merge_size = int(os.getenv("merge_size", 10))
+# 跨请求批处理：单个batch最多分段数，以及收集请求的时间窗口(秒)
+batch_size = int(os.getenv("batch_size", merge_size))
+batch_window = float(os.getenv("batch_window", 0.02))
+# 连续批处理：分段结束即返回，空出的位置立即接纳新请求
+continuous_batching = os.getenv("continuous_batching", "false").lower() == "true"
+# 分段超过一个batch时，GPT 与 decoder/vocos 流水线执行，以及各阶段之间最多排队的batch数
+pipeline = os.getenv("pipeline", "true").lower() == "true"
+pipeline_queue_size = int(os.getenv("pipeline_queue_size", 2))
+# 分段生成结束后立即移出batch，其余分段继续生成
+compact_finished = os.getenv("compact_finished", "true").lower() == "true"
+# 旧的输出方式：每个分段单独保存wav，再用 ffmpeg concat 合并
+ffmpeg_concat = os.getenv("ffmpeg_concat", "false").lower() == "true"
+# 合成结果缓存：内存中保留的条数，以及磁盘缓存上限(MB)，均为0时关闭
+cache_items = int(os.getenv("cache_items", 64))
+cache_disk_mb = int(os.getenv("cache_disk_mb", 512))
 env_lang = os.getenv("lang", "")
 if env_lang == "zh":
     is_cn = True
@@ -60,7 +80,7 @@ elif env_lang == "en":
 else:
     is_cn = is_chinese_os()
 
-if not shutil.which("ffmpeg"):
+if ffmpeg_concat and not shutil.which("ffmpeg"):
     print("请先安装ffmpeg")
     time.sleep(60)
     exit()
@@ -77,11 +97,57 @@ elif device_str == "cpu":
     device = torch.device("cpu")
 
 
+# 会改变合成结果的模型配置，同时参与合成缓存的键
+model_options = dict(
+    compile=True if os.getenv("compile", "true").lower() != "false" else False,
+    # 预分配KV缓存，单步解码形状固定，可配合 compile 编译；
+    # 各批大小共用按最大批分配的缓存，float32 下 8 行约占 2.5GB 内存/显存
+    static_cache=os.getenv("static_cache", "false").lower() == "true",
+    # 单个分段时由前几层草拟、完整模型一次校验多帧，0为关闭
+    speculative_layers=int(os.getenv("speculative_layers", "0")),
+    # 仅CPU：GPT线性层权重量化为 int8 或 int4，结果缓存在 asset 目录
+    quantize=os.getenv("quantize", "") or None,
+    # GPT、decoder 与 vocos 的精度：float16 / bfloat16，默认 float32
+    dtype=os.getenv("dtype", "") or None,
+    # decoder 与 vocos 改用 onnxruntime(CPU)执行，模型可用 export-onnx.py 预先导出
+    onnx=os.getenv("onnx", "false").lower() == "true",
+    # 长短不一的分段按长度分组解码，每组补齐的帧数占比不超过该值，1为不分组
+    max_padding_waste=float(os.getenv("max_padding_waste", "0.25")),
+)
 chat.load(
     source="local" if not os.path.exists(MODEL_DIR + "/DVAE_full.pt") else "custom",
     custom_path=ROOT_DIR,
     device=device,
-    compile=True if os.getenv("compile", "true").lower() != "false" else False,
+    prefix_cache_size=int(os.getenv("prefix_cache_size", "8")),
+    onnx_threads=int(os.getenv("onnx_threads", "0")),
+    **model_options,
+)
+# 启动时加载全部音色，之后监视 SPEAKER_DIR 的变化
+speakers = SpeakerRegistry(chat, SPEAKER_DIR)
+scheduler = InferScheduler(
+    chat,
+    max_batch_size=batch_size,
+    batch_window=batch_window,
+    continuous=continuous_batching,
+    pipeline=pipeline,
+    pipeline_queue_size=pipeline_queue_size,
+)
+# 磁盘缓存在重启后仍然有效，修改 .env 中的上述配置后不能再使用旧的结果；
+# batch_size 决定了分段如何拆成 batch，也会影响结果
+cache_config = dict(
+    model_options,
+    device=str(device),
+    batch_size=batch_size,
+    compact_finished=compact_finished,
+)
+synthesis_cache = (
+    SynthesisCache(
+        WAVS_DIR + "/cache",
+        max_items=cache_items,
+        max_disk_bytes=cache_disk_mb * 1024 * 1024,
+    )
+    if cache_items > 0 or cache_disk_mb > 0
+    else None
 )
 
 
@@ -152,9 +218,10 @@ def index():
 audio_queue = []
 
 
-@app.route("/tts", methods=["GET", "POST"])
-def tts():
-    global audio_queue
+def parse_tts_request():
+    """
+    解析 /tts 与 /tts/stream 共用的请求参数，text 为空时返回 None
+    """
     # 原始字符串
     text = request.args.get("text", "").strip() or request.form.get("text", "").strip()
     prompt = request.args.get("prompt", "").strip() or request.form.get("prompt", "")
@@ -199,51 +266,15 @@ def tts():
 
     app.logger.info(f"[tts]{text=}\n{voice=},{skip_refine=}\n")
     if not text:
-        return jsonify({"code": 1, "msg": "text params lost"})
-    # 固定音色
-    rand_spk = None
-    # voice可能是 {voice}.csv or {voice}.pt or number
-    voice = voice.replace(".csv", ".pt")
-    seed_path = f"{SPEAKER_DIR}/{voice}"
+        return None
+    # 固定音色，voice可能是 {voice}.csv or {voice}.pt or number
     print(f"{voice=}")
-    # if voice.endswith('.csv') and os.path.exists(seed_path):
-    #    rand_spk=utils.load_speaker(voice)
-    #    print(f'当前使用音色 {seed_path=}')
-    # el
-
-    if voice.endswith(".pt") and os.path.exists(seed_path):
-        # 如果.env中未指定设备，则使用 ChatTTS相同算法找设备，否则使用指定设备
-        rand_spk = torch.load(seed_path, map_location=device)
-        print(f"当前使用音色 {seed_path=}")
-    # 否则 判断是否存在 {voice}.csv
-    # elif os.path.exists(f'{SPEAKER_DIR}/{voice}.csv'):
-    #    rand_spk=utils.load_speaker(voice)
-    #    print(f'当前使用音色 {SPEAKER_DIR}/{voice}.csv')
-
-    if rand_spk is None:
-        print(f"当前使用音色：根据seed={voice}获取随机音色")
-        voice_int = re.findall(r"^(\d+)", voice)
-        if len(voice_int) > 0:
-            voice = int(voice_int[0])
-        else:
-            voice = 2222
-        torch.manual_seed(voice)
-        # std, mean = chat.sample_random_speaker
-        rand_spk = chat.sample_random_speaker()
-        # rand_spk = torch.randn(768) * std + mean
-        # 保存音色
-        torch.save(rand_spk, f"{SPEAKER_DIR}/{voice}.pt")
-        # utils.save_speaker(voice,rand_spk)
-
-    audio_files = []
-
-    start_time = time.time()
+    voice, rand_spk = speakers.get(voice)
+    print(f"当前使用音色 {voice}")
 
     # 中英按语言分行
     text_list = [t.strip() for t in text.split("\n") if t.strip()]
     new_text = utils.split_text(text_list)
-    if text_seed > 0:
-        torch.manual_seed(text_seed)
 
     params_infer_code = ChatTTS.Chat.InferCodeParams(
         spk_emb=rand_spk,
@@ -252,6 +283,7 @@ def tts():
         top_K=top_k,
         temperature=temperature,
         max_new_token=infer_max_new_token,
+        compact_finished=compact_finished,
     )
     params_refine_text = ChatTTS.Chat.RefineTextParams(
         prompt=prompt,
@@ -259,6 +291,7 @@ def tts():
         top_K=top_k,
         temperature=temperature,
         max_new_token=refine_max_new_token,
+        compact_finished=compact_finished,
     )
     print(f"{prompt=}")
     # 将少于30个字符的行同其他行拼接
@@ -280,39 +313,42 @@ def tts():
 
     new_text = retext
 
-    new_text_list = [new_text[i : i + merge_size] for i in range(0, len(new_text), merge_size)]
-    filename_list = []
+    infer_kwargs = dict(
+        # use_decoder=False,
+        skip_refine_text=skip_refine,
+        do_text_normalization=False,
+        do_homophone_replacement=True,
+        params_refine_text=params_refine_text,
+        params_infer_code=params_infer_code,
+    )
+    return dict(
+        text=text,
+        new_text=new_text,
+        voice=voice,
+        temperature=temperature,
+        top_p=top_p,
+        top_k=top_k,
+        text_seed=text_seed,
+        is_stream=is_stream,
+        wav=wav,
+        infer_kwargs=infer_kwargs,
+    )
 
-    audio_time = 0
-    inter_time = 0
 
-    for i, te in enumerate(new_text_list):
-        print(f"{te=}")
-        wavs = chat.infer(
-            te,
-            # use_decoder=False,
-            stream=True if is_stream == 1 else False,
-            skip_refine_text=skip_refine,
-            do_text_normalization=False,
-            do_homophone_replacement=True,
-            params_refine_text=params_refine_text,
-            params_infer_code=params_infer_code,
+def concat_with_ffmpeg(wavs, name, inference_time_rounded):
+    """
+    旧的输出方式：每个分段保存为单独的wav，再用 ffmpeg concat 合并，
+    返回合并后的文件名与音频时长
+    """
+    filename_list = []
+    for j, w in enumerate(wavs):
+        filename = (
+            datetime.datetime.now().strftime("%H%M%S_")
+            + f"use{inference_time_rounded}s-{name}-{str(random())[2:7]}"
+            + f"-{j}.wav"
         )
-
-        end_time = time.time()
-        inference_time = end_time - start_time
-        inference_time_rounded = round(inference_time, 2)
-        inter_time += inference_time_rounded
-        print(f"推理时长: {inference_time_rounded} 秒")
-
-        for j, w in enumerate(wavs):
-            filename = (
-                datetime.datetime.now().strftime("%H%M%S_")
-                + f"use{inference_time_rounded}s-seed{voice}-te{temperature}-tp{top_p}-tk{top_k}-textlen{len(text)}-{str(random())[2:7]}"
-                + f"-{i}-{j}.wav"
-            )
-            filename_list.append(filename)
-            torchaudio.save(WAVS_DIR + "/" + filename, torch.from_numpy(w).unsqueeze(0), 24000)
+        filename_list.append(filename)
+        torchaudio.save(WAVS_DIR + "/" + filename, torch.from_numpy(w).unsqueeze(0), 24000)
 
     txt_tmp = "\n".join([f"file '{WAVS_DIR}/{it}'" for it in filename_list])
     txt_name = f"{time.time()}.txt"
@@ -320,45 +356,152 @@ def tts():
         f.write(txt_tmp)
     outname = (
         datetime.datetime.now().strftime("%H%M%S_")
-        + f"use{inter_time}s-audio{audio_time}s-seed{voice}-te{temperature}-tp{top_p}-tk{top_k}-textlen{len(text)}-{str(random())[2:7]}"
+        + f"use{inference_time_rounded}s-audio0s-{name}-{str(random())[2:7]}"
         + "-merge.wav"
     )
-    try:
-        subprocess.run(
-            [
-                "ffmpeg",
-                "-hide_banner",
-                "-ignore_unknown",
-                "-y",
-                "-f",
-                "concat",
-                "-safe",
-                "0",
-                "-i",
-                f"{WAVS_DIR}/{txt_name}",
-                "-c:a",
-                "copy",
-                WAVS_DIR + "/" + outname,
-            ],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            encoding="utf-8",
-            check=True,
-            text=True,
-            creationflags=0 if sys.platform != "win32" else subprocess.CREATE_NO_WINDOW,
-        )
-    except Exception as e:
-        return jsonify({"code": 1, "msg": str(e)})
+    subprocess.run(
+        [
+            "ffmpeg",
+            "-hide_banner",
+            "-ignore_unknown",
+            "-y",
+            "-f",
+            "concat",
+            "-safe",
+            "0",
+            "-i",
+            f"{WAVS_DIR}/{txt_name}",
+            "-c:a",
+            "copy",
+            WAVS_DIR + "/" + outname,
+        ],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding="utf-8",
+        check=True,
+        text=True,
+        creationflags=0 if sys.platform != "win32" else subprocess.CREATE_NO_WINDOW,
+    )
 
-    audio_path = WAVS_DIR + "/" + outname
     try:
         #  使用 soundfile
-        audio_info = sf.info(audio_path)
+        audio_info = sf.info(WAVS_DIR + "/" + outname)
         audio_duration = round(audio_info.duration, 2)
     except Exception as e:
         print(f"计算音频时长失败: {e}")
         audio_duration = -1
+    return outname, audio_duration
+
+
+@app.route("/tts", methods=["GET", "POST"])
+def tts():
+    global audio_queue
+    start_time = time.time()
+    req = parse_tts_request()
+    if req is None:
+        return jsonify({"code": 1, "msg": "text params lost"})
+    text = req["text"]
+    new_text = req["new_text"]
+    voice = req["voice"]
+    temperature = req["temperature"]
+    top_p = req["top_p"]
+    top_k = req["top_k"]
+    text_seed = req["text_seed"]
+    is_stream = req["is_stream"]
+    wav = req["wav"]
+    infer_kwargs = req["infer_kwargs"]
+
+    audio_files = []
+
+    inter_time = 0
+
+    # 只有固定了 text_seed 时结果才可复现，连续批处理不按 seed 复现，不使用缓存；
+    # 批处理时还须未与其他请求同批，见下方 reproducible
+    cache_key = None
+    if synthesis_cache is not None and text_seed > 0 and (is_stream == 1 or not continuous_batching):
+        cache_key = SynthesisCache.make_key(
+            cache_config,
+            new_text,
+            text_seed,
+            is_stream,
+            merge_size if is_stream == 1 else 0,
+            infer_kwargs,
+        )
+    cached = synthesis_cache.get(cache_key) if cache_key is not None else None
+
+    if cached is not None:
+        print(f"命中合成缓存 {cache_key}")
+        wavs = [cached]
+    elif is_stream == 1:
+        # 流式推理不参与批处理，直接独占模型
+        new_text_list = [new_text[i : i + merge_size] for i in range(0, len(new_text), merge_size)]
+        wavs = []
+        with scheduler.lock:
+            if text_seed > 0:
+                torch.manual_seed(text_seed)
+            for te in new_text_list:
+                print(f"{te=}")
+                chunks = []
+                lengths = []
+                for w, lengths in chat.infer(te, stream=True, return_lengths=True, **infer_kwargs):
+                    if w.size > 0:
+                        chunks.append(w)
+                if len(chunks) > 0:
+                    # 按分段拼回完整音频，按各分段实际采样点数去掉对齐补齐的尾部
+                    wavs.extend(w[:n] for w, n in zip(np.concatenate(chunks, axis=1), lengths))
+    else:
+        # 交给调度器，与其他并发请求中参数相同的分段合并推理
+        print(f"{new_text=}")
+        wavs, reproducible = scheduler.infer(
+            new_text, text_seed=text_seed, return_reproducible=True, **infer_kwargs
+        )
+        if not reproducible:
+            cache_key = None
+    if cached is None and cache_key is not None and len(wavs) > 0:
+        synthesis_cache.put(cache_key, np.concatenate(wavs))
+
+    inference_time = time.time() - start_time
+    inference_time_rounded = round(inference_time, 2)
+    inter_time += inference_time_rounded
+    # 启动以来首个 token 即为结束符（被重采样）的分段数
+    print(
+        f"推理时长: {inference_time_rounded} 秒，"
+        f"首步结束分段累计: {chat.gpt.unexpected_eos_count}"
+    )
+    try:
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    except Exception:
+        pass
+
+    if ffmpeg_concat:
+        try:
+            outname, audio_duration = concat_with_ffmpeg(
+                wavs,
+                f"seed{voice}-te{temperature}-tp{top_p}-tk{top_k}-textlen{len(text)}",
+                inter_time,
+            )
+        except Exception as e:
+            return jsonify({"code": 1, "msg": str(e)})
+    else:
+        # 在内存中拼接各分段，时长直接由采样点数得出
+        audio = np.concatenate(wavs) if len(wavs) > 0 else np.zeros(0, dtype=np.float32)
+        audio_duration = round(audio.shape[0] / 24000, 2)
+        buffer = io.BytesIO()
+        sf.write(buffer, audio, 24000, format="WAV", subtype="FLOAT")
+        del audio
+        if wav > 0:
+            buffer.seek(0)
+            return send_file(buffer, mimetype="audio/x-wav", download_name="merge.wav")
+        outname = (
+            datetime.datetime.now().strftime("%H%M%S_")
+            + f"use{inter_time}s-audio{audio_duration}s-seed{voice}-te{temperature}-tp{top_p}-tk{top_k}-textlen{len(text)}-{str(random())[2:7]}"
+            + "-merge.wav"
+        )
+        with open(WAVS_DIR + "/" + outname, "wb") as f:
+            f.write(buffer.getbuffer())
 
+    audio_path = WAVS_DIR + "/" + outname
     relative_url = f"/static/wavs/{outname}"
     audio_files.append(
         {
@@ -370,11 +513,6 @@ def tts():
         }
     )
     result_dict = {"code": 0, "msg": "ok", "audio_files": audio_files}
-    try:
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-    except Exception:
-        pass
     # 兼容pyVideoTrans接口调用
     if len(audio_files) == 1:
         result_dict["filename"] = audio_files[0]["filename"]
@@ -387,10 +525,64 @@ def tts():
         return jsonify(result_dict)
 
 
+# 流式返回：立即发送 wav 头，之后每生成一段音频就以 chunked 方式推送 16bit PCM
+# 参数同 /tts，按分段顺序逐段流式推理，以获得最短的首包时间
+@app.route("/tts/stream", methods=["GET", "POST"])
+def tts_stream():
+    req = parse_tts_request()
+    if req is None:
+        return jsonify({"code": 1, "msg": "text params lost"})
+    new_text = req["new_text"]
+    text_seed = req["text_seed"]
+    infer_kwargs = req["infer_kwargs"]
+
+    chunks = queue.Queue()
+    stop = threading.Event()
+
+    def produce():
+        try:
+            with scheduler.lock:
+                if text_seed > 0:
+                    torch.manual_seed(text_seed)
+                for te in new_text:
+                    print(f"{te=}")
+                    for w in chat.infer([te], stream=True, **infer_kwargs):
+                        if stop.is_set():
+                            # 客户端已断开，关闭生成器即可中止推理
+                            return
+                        if w.size > 0:
+                            chunks.put(w[0])
+        except Exception as e:
+            app.logger.exception(f"stream tts failed: {e}")
+        finally:
+            chunks.put(None)
+
+    threading.Thread(target=produce, daemon=True).start()
+
+    def generate():
+        try:
+            yield wav_header(24000)
+            while True:
+                w = chunks.get()
+                if w is None:
+                    break
+                yield float_to_pcm16(w).tobytes()
+        finally:
+            stop.set()
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="audio/wav",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 @app.route("/clear_wavs", methods=["POST"])
 def clear_wavs():
     dir_path = "static/wavs"  # wav音频文件存储目录
     success, message = utils.ClearWav(dir_path)
+    if synthesis_cache is not None:
+        synthesis_cache.clear()
     if success:
         return jsonify({"code": 0, "msg": message})
     else:
@@ -0,0 +1,94 @@
+"""
+对比 DVAEDecoder 中 12 个 ConvNeXtBlock 的原实现与 channels-last 融合实现：
+(B, 512, T) 输入下的最大误差与耗时，误差超过 --atol 时报错退出
+
+python benchmark/convnext.py [--batch 1 4 10] [--frames 200 800] [--threads 4]
+asset/Decoder.pt 存在时使用其权重，否则使用随机权重(gamma 随机化，避免各层接近恒等)
+"""
+
+import argparse
+import os
+import sys
+import time
+from dataclasses import asdict
+
+import torch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from ChatTTS.config import Config
+from ChatTTS.model.dvae import DVAE, DVAEDecoder
+
+
+def build(device, dtype) -> DVAEDecoder:
+    config = Config()
+    dvae = DVAE(decoder_config=asdict(config.decoder), dim=config.decoder.idim)
+    path = os.path.join(ROOT_DIR, config.path.decoder_ckpt_path)
+    if os.path.exists(path):
+        dvae.load_state_dict(torch.load(path, weights_only=True, mmap=True))
+    else:
+        torch.manual_seed(0)
+        for block in dvae.decoder.decoder_block:
+            block.gamma.data.uniform_(0, 0.5)
+    return dvae.decoder.to(device, dtype).eval()
+
+
+def run(decoder: DVAEDecoder, x: torch.Tensor, fused: bool) -> torch.Tensor:
+    decoder.fused = fused
+    if fused:
+        return decoder._forward_blocks_channels_last(x)
+    for block in decoder.decoder_block:
+        x = block(x)
+    return x
+
+
+def timeit(fn, repeat: int, device) -> float:
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    t = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - t) / repeat
+
+
+@torch.inference_mode()
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", type=int, nargs="+", default=[1, 4, 10])
+    parser.add_argument("--frames", type=int, nargs="+", default=[200, 800])
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--dtype", default="float32")
+    parser.add_argument("--atol", type=float, default=1e-4)
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = torch.device(args.device)
+    dtype = getattr(torch, args.dtype)
+
+    decoder = build(device, dtype)
+    hidden = decoder.decoder_block[0].dwconv.in_channels
+    for batch in args.batch:
+        for frames in args.frames:
+            x = torch.randn(batch, hidden, frames, device=device, dtype=dtype)
+            ref = run(decoder, x.clone(), False)
+            out = run(decoder, x.clone(), True)
+            err = out.sub(ref).abs().max().item() / max(ref.abs().max().item(), 1)
+            if err > args.atol:
+                raise SystemExit(f"({batch}, {hidden}, {frames}) mismatch {err:.2e}")
+            eager = timeit(lambda: run(decoder, x.clone(), False), args.repeat, device)
+            fused = timeit(lambda: run(decoder, x.clone(), True), args.repeat, device)
+            print(
+                f"({batch:>2}, {hidden}, {frames:>4})  max err {err:.2e}  "
+                f"eager {eager * 1000:8.1f}ms  fused {fused * 1000:8.1f}ms  "
+                f"x{eager / fused:.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
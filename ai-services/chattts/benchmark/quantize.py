@@ -0,0 +1,109 @@
+"""
+对比 float32 与 int8/int4 权重量化的 GPT：
+相同输入下 code logits 的误差、top-1 一致率、采样分布的 KL，以及单行逐帧解码的速度
+
+python benchmark/quantize.py [--gpt asset/GPT.pt] [--frames 100] [--threads 4]
+没有模型文件时可加 --random 使用随机权重，只比较速度
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+
+import torch
+import torch.nn.functional as F
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+from ChatTTS.config import Config
+from ChatTTS.model.gpt import GPT
+
+
+def build(path, quantize, device):
+    gpt = GPT(gpt_config=asdict(Config().gpt), device=device).eval()
+    gpt.from_pretrained(path, quantize=quantize)
+    gpt.prepare()
+    return gpt
+
+
+@torch.no_grad()
+def teacher_forced_logits(gpt: GPT, ids: torch.Tensor) -> torch.Tensor:
+    emb = gpt._embed_next(ids, False)
+    hidden = gpt.gpt(inputs_embeds=emb).last_hidden_state
+    return gpt._compute_logits(hidden.squeeze(0).float(), False)
+
+
+@torch.no_grad()
+def decode_speed(gpt: GPT, ids: torch.Tensor, frames: int) -> float:
+    emb = gpt._embed_next(ids.narrow(1, 0, 1), False)
+    out = gpt.gpt(inputs_embeds=emb, use_cache=True)
+    past = out.past_key_values
+    t = time.perf_counter()
+    for i in range(1, frames + 1):
+        emb = gpt._embed_next(ids.narrow(1, i, 1), False)
+        out = gpt.gpt(inputs_embeds=emb, past_key_values=past, use_cache=True)
+        past = out.past_key_values
+        gpt._compute_logits(out.last_hidden_state.squeeze(0).float(), False)
+    return frames / (time.perf_counter() - t)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--gpt", default=os.path.join(ROOT_DIR, "asset", "GPT.pt"))
+    parser.add_argument("--frames", type=int, default=100)
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--random", action="store_true")
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+    device = torch.device("cpu")
+
+    tmp = None
+    path = args.gpt
+    if args.random:
+        tmp = tempfile.TemporaryDirectory()
+        path = os.path.join(tmp.name, "GPT.pt")
+        torch.manual_seed(0)
+        torch.save(GPT(gpt_config=asdict(Config().gpt), device=device).state_dict(), path)
+
+    torch.manual_seed(1)
+    num_audio_tokens = Config().gpt.num_audio_tokens
+    ids = torch.randint(0, num_audio_tokens - 1, (1, args.frames + 1, 4))
+
+    base = build(path, None, device)
+    ref = teacher_forced_logits(base, ids)
+    speed = decode_speed(base, ids, args.frames)
+    print(f"float32  {speed:7.2f} frames/s")
+    del base
+
+    ref_logp = F.log_softmax(ref, -1)
+    for quantize in ("int8", "int4"):
+        for start in ("first", "cached"):
+            t = time.perf_counter()
+            gpt = build(path, quantize, device)
+            load_time = time.perf_counter() - t
+            if start == "cached":
+                break
+            del gpt
+        logits = teacher_forced_logits(gpt, ids)
+        speed = decode_speed(gpt, ids, args.frames)
+        logp = F.log_softmax(logits, -1)
+        kl = F.kl_div(logp, ref_logp, log_target=True, reduction="batchmean")
+        top1 = logits.argmax(-1).eq(ref.argmax(-1)).float().mean()
+        print(
+            f"{quantize:<8} {speed:7.2f} frames/s  load {load_time:5.2f}s (cached)  "
+            f"max |dlogit| {logits.sub(ref).abs().max():.4f}  "
+            f"top-1 {top1:.4f}  KL {kl:.6f}"
+        )
+        del gpt
+
+    if tmp is not None:
+        tmp.cleanup()
+
+
+if __name__ == "__main__":
+    main()
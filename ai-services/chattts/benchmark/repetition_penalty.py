@@ -0,0 +1,87 @@
+"""
+对比 one_hot 版本与增量计数版本的重复惩罚：结果一致性与单步耗时
+
+python benchmark/repetition_penalty.py [--device cuda] [--steps 200]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+import torch.nn.functional as F
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ChatTTS.model.processors import CustomRepetitionPenaltyLogitsProcessorRepeat
+
+
+def one_hot_penalty(input_ids, scores, penalty, max_input_ids, past_window):
+    # 原 one_hot 实现
+    if input_ids.size(1) > past_window:
+        input_ids = input_ids.narrow(1, -past_window, past_window)
+    if input_ids.lt(0).any():
+        valid = input_ids.ge(0).unsqueeze_(-1)
+        freq = F.one_hot(input_ids.clamp(min=0), scores.size(1)).mul_(valid).sum(1)
+    else:
+        freq = F.one_hot(input_ids, scores.size(1)).sum(1)
+    if freq.size(0) > max_input_ids:
+        freq.narrow(0, max_input_ids, freq.size(0) - max_input_ids).zero_()
+    alpha = torch.pow(penalty, freq)
+    scores = scores.contiguous()
+    return torch.where(scores < 0, scores.multiply(alpha), scores.divide(alpha))
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def run(name, rows, vocab, steps, device, penalty=1.05, window=16):
+    torch.manual_seed(0)
+    history = torch.randint(0, vocab, (rows, steps), device=device)
+    # 让部分 token 重复出现
+    history[:, 1::3] = history[:, 0:-1:3]
+    logits = torch.randn(steps, rows, vocab, device=device)
+
+    processor = CustomRepetitionPenaltyLogitsProcessorRepeat(penalty, vocab, window)
+    max_diff = 0.0
+    t_old = t_new = 0.0
+    for i in range(steps):
+        ids = history.narrow(1, 0, i)
+        sync(device)
+        t = time.perf_counter()
+        old = one_hot_penalty(ids, logits[i].clone(), penalty, vocab, window)
+        sync(device)
+        t_old += time.perf_counter() - t
+        t = time.perf_counter()
+        new = processor(ids, logits[i].clone())
+        sync(device)
+        t_new += time.perf_counter() - t
+        max_diff = max(max_diff, (old - new).abs().max().item())
+    print(
+        f"{name:<6} rows={rows:<4} vocab={vocab:<6} "
+        f"one_hot {t_old / steps * 1e3:8.3f} ms/step  "
+        f"incremental {t_new / steps * 1e3:8.3f} ms/step  "
+        f"max diff {max_diff}"
+    )
+    return max_diff
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--steps", type=int, default=200)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    diffs = [
+        run("code", 8 * 4, 626, args.steps, device),
+        run("code", 32 * 4, 626, args.steps, device),
+        run("text", 8, 21178, args.steps, device),
+        run("text", 32, 21178, args.steps, device),
+    ]
+    if max(diffs) != 0:
+        print("penalties differ!")
+        sys.exit(1)
@@ -0,0 +1,99 @@
+"""
+对比 transformers 的 TopP + TopK 两个 warper 与合并后的 TopKTopPLogitsWarper：
+过滤结果、相同随机数下的采样结果与耗时
+
+warper 一列只计 top-k/top-p 过滤本身；step 一列为完整的一步采样
+(除以温度、过滤、softmax、multinomial)，后三者两边相同，未被合并
+
+python benchmark/sampler.py [--device cuda] [--iters 50]
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+from transformers.generation import TopKLogitsWarper, TopPLogitsWarper
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ChatTTS.model.sampler import TopKTopPLogitsWarper
+
+
+def sync(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+def timeit(fn, iters, device):
+    sync(device)
+    t = time.perf_counter()
+    for _ in range(iters):
+        out = fn()
+    sync(device)
+    return out, (time.perf_counter() - t) / iters * 1e3
+
+
+def run(name, rows, vocab, top_P, top_K, iters, device):
+    torch.manual_seed(0)
+    scores = torch.randn(rows, vocab, device=device) * 3
+    warpers = []
+    if top_P is not None:
+        warpers.append(TopPLogitsWarper(top_P, min_tokens_to_keep=3))
+    if top_K is not None:
+        warpers.append(TopKLogitsWarper(top_K, min_tokens_to_keep=3))
+    fused = TopKTopPLogitsWarper(top_P, top_K, min_tokens_to_keep=3)
+
+    def chain():
+        x = scores.clone()
+        for w in warpers:
+            x = w(None, x)
+        return x
+
+    old, t_old = timeit(chain, iters, device)
+    new, t_new = timeit(lambda: fused(None, scores.clone()), iters, device)
+
+    temperature = torch.full((rows, 1), 0.7, device=device)
+
+    def step(warp):
+        x = warp(scores.clone() / temperature)
+        return torch.multinomial(torch.softmax(x, -1), 1)
+
+    def chain_warp(x):
+        for w in warpers:
+            x = w(None, x)
+        return x
+
+    _, t_step_old = timeit(lambda: step(chain_warp), iters, device)
+    _, t_step_new = timeit(lambda: step(lambda x: fused(None, x)), iters, device)
+
+    same = torch.equal(old, new)
+    torch.manual_seed(1)
+    s_old = torch.multinomial(torch.softmax(old, -1), 1)
+    torch.manual_seed(1)
+    s_new = torch.multinomial(torch.softmax(new, -1), 1)
+    same_sample = torch.equal(s_old, s_new)
+    print(
+        f"{name:<5} rows={rows:<3} top_P={top_P} top_K={top_K}  "
+        f"warper {t_old:8.3f} -> {t_new:8.3f} ms  "
+        f"step {t_step_old:8.3f} -> {t_step_new:8.3f} ms  "
+        f"same logits {same}  same samples {same_sample}"
+    )
+    return same and same_sample
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default="cpu")
+    parser.add_argument("--iters", type=int, default=50)
+    args = parser.parse_args()
+    device = torch.device(args.device)
+
+    ok = True
+    for top_P, top_K in ((0.7, 20), (0.3, 20), (0.99, 5), (None, 20)):
+        ok &= run("code", 8 * 4, 626, top_P, top_K, args.iters, device)
+        ok &= run("text", 8, 21178, top_P, top_K, args.iters, device)
+    if not ok:
+        print("results differ!")
+        sys.exit(1)
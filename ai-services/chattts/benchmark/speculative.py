@@ -0,0 +1,72 @@
+"""
+单条文本推理时，对比逐帧生成与投机解码(前 N 层草拟)的 RTF 与草拟帧接受率
+
+python benchmark/speculative.py [--layers 0 2 4 6] [--tokens 4] [--device cuda]
+模型文件需已下载到 --custom_path (默认为本项目根目录)
+"""
+
+import argparse
+import os
+import sys
+import time
+
+import torch
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(ROOT_DIR)
+
+import ChatTTS
+
+TEXT = "四川美食确实以辣闻名，但也有不辣的选择。比如甜水面、赖汤圆、蛋烘糕、叶儿粑等，这些小吃口味温和，甜而不腻，也很受欢迎。"
+
+
+def run(layers, tokens, device, custom_path, repeat):
+    chat = ChatTTS.Chat()
+    chat.load(
+        source="custom",
+        custom_path=custom_path,
+        device=device,
+        compile=False,
+        speculative_layers=layers,
+    )
+    if chat.gpt.speculative_decoder is not None:
+        chat.gpt.speculative_decoder.num_draft = tokens
+    torch.manual_seed(2222)
+    spk = chat.sample_random_speaker()
+    params = ChatTTS.Chat.InferCodeParams(spk_emb=spk, show_tqdm=False)
+    audio_seconds = 0.0
+    elapsed = 0.0
+    for i in range(repeat + 1):
+        torch.manual_seed(i)
+        t = time.perf_counter()
+        wavs = chat.infer(
+            [TEXT],
+            skip_refine_text=True,
+            params_infer_code=params,
+        )
+        if i == 0:
+            # 预热
+            continue
+        elapsed += time.perf_counter() - t
+        audio_seconds += wavs[0].shape[-1] / 24000
+    spec = chat.gpt.speculative_decoder
+    rate = f"{spec.acceptance_rate:.3f}" if spec is not None else "-"
+    print(
+        f"layers={layers:<2} tokens={tokens}  RTF {elapsed / audio_seconds:.3f}  "
+        f"audio {audio_seconds:.1f}s  accepted {rate}"
+    )
+    chat.unload()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--layers", type=int, nargs="+", default=[0, 2, 4, 6])
+    parser.add_argument("--tokens", type=int, default=4)
+    parser.add_argument("--device", default=None)
+    parser.add_argument("--custom_path", default=ROOT_DIR)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    device = torch.device(args.device) if args.device else None
+
+    for layers in args.layers:
+        run(layers, args.tokens, device, args.custom_path, args.repeat)
@@ -0,0 +1,92 @@
+"""
+把 GPT 之后的 Decoder / DVAE 解码与 Vocos 导出为 ONNX(批大小与时间维度可变)，
+文件保存在模型文件旁：asset/Decoder.onnx、asset/DVAE_full.onnx、asset/Vocos.onnx
+
+python export-onnx.py [--custom_path .] [--opset 17] [--check] [--threads 4]
+--check 用随机 GPT 隐状态对比 torch 与 onnxruntime 的输出误差和耗时
+
+.env 中设置 onnx=true 后启动时使用导出的模型(缺失或比 .pt 旧时会自动导出)，
+onnx_threads 为 onnxruntime 的线程数，0 为默认，需先 pip install onnxruntime
+"""
+
+import argparse
+import os
+import sys
+import time
+from dataclasses import asdict
+
+import numpy as np
+import torch
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(ROOT_DIR)
+
+import ChatTTS
+from ChatTTS.model.ort import export_decoder, export_vocos, onnx_path
+
+
+def check(chat: ChatTTS.Chat, paths, threads: int, frames: int):
+    torch.manual_seed(0)
+    hiddens = [
+        torch.randn(n, chat.config.gpt.hidden_size) for n in (frames, frames // 2)
+    ]
+    t = time.perf_counter()
+    ref = chat._decode_to_wavs([h.clone() for h in hiddens], True)
+    torch_time = time.perf_counter() - t
+    chat._load_onnx(*paths, threads=threads)
+    chat._decode_to_wavs([h.clone() for h in hiddens], True)  # 预热
+    t = time.perf_counter()
+    out = chat._decode_to_wavs([h.clone() for h in hiddens], True)
+    onnx_time = time.perf_counter() - t
+    print(
+        f"max |diff| {np.abs(ref - out).max():.2e}  "
+        f"torch {torch_time:.3f}s  onnxruntime {onnx_time:.3f}s"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--custom_path", default=ROOT_DIR)
+    parser.add_argument("--opset", type=int, default=17)
+    parser.add_argument("--check", action="store_true")
+    parser.add_argument("--threads", type=int, default=0)
+    parser.add_argument("--frames", type=int, default=300)
+    args = parser.parse_args()
+    if args.threads > 0:
+        torch.set_num_threads(args.threads)
+
+    chat = ChatTTS.Chat()
+    chat.load(
+        source="custom",
+        custom_path=args.custom_path,
+        device=torch.device("cpu"),
+        compile=False,
+    )
+    paths = {
+        k: os.path.join(args.custom_path, v)
+        for k, v in asdict(chat.config.path).items()
+    }
+    for name, module, export in (
+        ("decoder_ckpt_path", chat.decoder, export_decoder),
+        ("dvae_ckpt_path", chat.dvae, export_decoder),
+        ("vocos_ckpt_path", chat.vocos, export_vocos),
+    ):
+        path = onnx_path(paths[name])
+        export(module, path, args.opset)
+        print(f"exported {path}")
+
+    if args.check:
+        check(
+            chat,
+            (
+                paths["vocos_ckpt_path"],
+                paths["dvae_ckpt_path"],
+                paths["decoder_ckpt_path"],
+            ),
+            args.threads,
+            args.frames,
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -1 +1,2 @@
-from .np import unsafe_float_to_int16
+from .np import unsafe_float_to_int16, float_to_pcm16
+from .wav import wav_header
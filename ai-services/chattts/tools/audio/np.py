@@ -12,3 +12,12 @@ def unsafe_float_to_int16(audio: np.ndarray) -> np.ndarray:
     np.multiply(audio, am, audio)
     audio16 = audio.astype(np.int16)
     return audio16
+
+
+@jit
+def float_to_pcm16(audio: np.ndarray) -> np.ndarray:
+    """
+    Clip to [-1, 1] without normalizing, so that
+    successive chunks of one stream keep the same gain.
+    """
+    return (np.clip(audio, -1.0, 1.0) * 32767).astype(np.int16)
@@ -0,0 +1,29 @@
+import struct
+
+
+def wav_header(
+    sample_rate=24000, channels=1, sample_width=2, data_size=0xFFFFFFFF
+) -> bytes:
+    """
+    RIFF/WAVE header of PCM audio.
+    The default data_size marks an unknown length for streaming.
+    """
+    byte_rate = sample_rate * channels * sample_width
+    riff_size = 0xFFFFFFFF if data_size == 0xFFFFFFFF else 36 + data_size
+    return (
+        b"RIFF"
+        + struct.pack("<I", riff_size)
+        + b"WAVEfmt "
+        + struct.pack(
+            "<IHHIIHH",
+            16,
+            1,  # PCM
+            channels,
+            sample_rate,
+            byte_rate,
+            channels * sample_width,
+            sample_width * 8,
+        )
+        + b"data"
+        + struct.pack("<I", data_size)
+    )
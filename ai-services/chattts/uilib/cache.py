@@ -0,0 +1,159 @@
+import hashlib
+import logging
+import os
+import threading
+from collections import OrderedDict
+from dataclasses import fields, is_dataclass
+from typing import Optional
+
+import numpy as np
+import torch
+
+
+def _update_digest(h, value):
+    # 递归地把参数写入哈希，张量按内容参与计算
+    if is_dataclass(value):
+        h.update(type(value).__name__.encode())
+        for f in fields(value):
+            h.update(f.name.encode())
+            _update_digest(h, getattr(value, f.name))
+    elif isinstance(value, dict):
+        h.update(b"{")
+        for k in sorted(value.keys()):
+            h.update(str(k).encode())
+            _update_digest(h, value[k])
+        h.update(b"}")
+    elif isinstance(value, (list, tuple)):
+        h.update(b"[")
+        for v in value:
+            _update_digest(h, v)
+        h.update(b"]")
+    elif isinstance(value, torch.Tensor):
+        _update_digest(h, value.detach().cpu().numpy())
+    elif isinstance(value, np.ndarray):
+        h.update(str(value.dtype).encode() + str(value.shape).encode())
+        h.update(np.ascontiguousarray(value).tobytes())
+    else:
+        h.update(repr(value).encode())
+    h.update(b";")
+
+
+class SynthesisCache:
+    """
+    合成结果缓存
+
+    以规范化后的文本、音色、text_seed、全部推理参数及会改变结果的模型配置的哈希为键，
+    内存中按 LRU 保留最近的结果，同时写入 cache_dir 下的 .npy 文件，
+    磁盘占用超过 max_disk_bytes 时删除最久未使用的文件。
+    只有在 text_seed 固定（结果可复现）时才应使用。
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        max_items=64,
+        max_disk_bytes=512 * 1024 * 1024,
+        logger=logging.getLogger(__name__),
+    ):
+        self.cache_dir = cache_dir
+        self.max_items = max(0, int(max_items))
+        self.max_disk_bytes = max(0, int(max_disk_bytes))
+        self.logger = logger
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        os.makedirs(cache_dir, exist_ok=True)
+        # 键 -> 文件大小，按最近使用顺序排列
+        self._disk: "OrderedDict[str, int]" = OrderedDict()
+        self._disk_bytes = 0
+        entries = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if name.endswith(".npy") and os.path.isfile(path):
+                st = os.stat(path)
+                entries.append((st.st_mtime, name[:-4], st.st_size))
+        for _, key, size in sorted(entries):
+            self._disk[key] = size
+            self._disk_bytes += size
+        self._evict_disk()
+
+    @staticmethod
+    def make_key(*args) -> str:
+        h = hashlib.sha256()
+        _update_digest(h, args)
+        return h.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.npy")
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        with self._lock:
+            audio = self._memory.get(key)
+            if audio is not None:
+                self._memory.move_to_end(key)
+                if key in self._disk:
+                    self._disk.move_to_end(key)
+                return audio
+            if key not in self._disk:
+                return None
+            path = self._path(key)
+            try:
+                audio = np.load(path)
+                # 更新修改时间，重启后仍按最近使用顺序淘汰
+                os.utime(path)
+            except Exception as e:
+                self.logger.warning(f"read synthesis cache {path} failed: {e}")
+                self._remove_disk(key)
+                return None
+            self._disk.move_to_end(key)
+            self._put_memory(key, audio)
+            return audio
+
+    def put(self, key: str, audio: np.ndarray):
+        audio = np.array(audio, dtype=np.float32)
+        with self._lock:
+            self._put_memory(key, audio)
+            if self.max_disk_bytes == 0 or key in self._disk:
+                return
+            path = self._path(key)
+            tmp = f"{path}.{threading.get_ident()}.tmp"
+            try:
+                with open(tmp, "wb") as f:
+                    np.save(f, audio)
+                os.replace(tmp, path)
+            except Exception as e:
+                self.logger.warning(f"write synthesis cache {path} failed: {e}")
+                if os.path.exists(tmp):
+                    os.unlink(tmp)
+                return
+            size = os.path.getsize(path)
+            self._disk[key] = size
+            self._disk_bytes += size
+            self._evict_disk()
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            for key in list(self._disk.keys()):
+                self._remove_disk(key)
+
+    def _put_memory(self, key: str, audio: np.ndarray):
+        if self.max_items == 0:
+            return
+        audio.setflags(write=False)
+        self._memory[key] = audio
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_items:
+            self._memory.popitem(last=False)
+
+    def _remove_disk(self, key: str):
+        self._disk_bytes -= self._disk.pop(key, 0)
+        try:
+            os.unlink(self._path(key))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            self.logger.warning(f"remove synthesis cache {key} failed: {e}")
+
+    def _evict_disk(self):
+        while self._disk_bytes > self.max_disk_bytes and len(self._disk):
+            self._remove_disk(next(iter(self._disk)))
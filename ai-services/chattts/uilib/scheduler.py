@@ -0,0 +1,322 @@
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, astuple, is_dataclass
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+
+@dataclass(repr=False, eq=False)
+class _Job:
+    texts: List[str]
+    kwargs: dict
+    text_seed: int
+    key: tuple
+    future: Future
+    wavs: List[Optional[np.ndarray]]
+    pending: int
+    # 整组只有这一个请求时，其 batch 不含其他请求的分段，固定 seed 即可复现
+    reproducible: bool = False
+
+
+class InferScheduler:
+    """
+    跨请求动态批处理
+
+    在一个很短的时间窗口内收集多个 /tts 请求的文本分段，
+    将推理参数（temperature/top_P/top_K/speed/音色等）相同的分段
+    合并为一个 batch 调用 chat.infer，再把各自的音频按顺序返回给对应请求。
+
+    continuous=True 时改为连续批处理：每组参数对应一个 ContinuousBatchingEngine，
+    新请求的分段随时插入空出的位置，分段一结束就解码并返回，
+    此时 text_seed 不再保证结果可复现。
+
+    pipeline=True 时一组请求超过 max_batch_size 被拆成多个 batch 后，
+    GPT、Decoder 与 Vocos 分别在各自的线程中流水线执行，
+    每个 batch 仍使用同一个 text_seed，结果与逐个 batch 推理一致。
+
+    同一 batch 中的各行共用一个随机数序列，请求的结果与同批的其他请求有关，
+    只有独占一组的请求（reproducible）在固定 text_seed 时可复现。
+    """
+
+    def __init__(
+        self,
+        chat,
+        max_batch_size=10,
+        batch_window=0.02,
+        continuous=False,
+        pipeline=True,
+        pipeline_queue_size=2,
+        logger=logging.getLogger(__name__),
+    ):
+        self.chat = chat
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.batch_window = max(0.0, float(batch_window))
+        self.continuous = continuous
+        self.pipeline = pipeline
+        self.pipeline_queue_size = max(1, int(pipeline_queue_size))
+        self.logger = logger
+        # 直接调用 chat 的代码（如流式推理）也需持有该锁，避免与批处理并发使用模型
+        self.lock = threading.Lock()
+        self._queue: "queue.Queue[Optional[_Job]]" = queue.Queue()
+        self._worker = threading.Thread(
+            target=self._run_continuous if continuous else self._run,
+            name="InferScheduler",
+            daemon=True,
+        )
+        self._worker.start()
+
+    def submit(self, text: List[str], text_seed=0, **kwargs) -> Future:
+        """
+        提交一组文本分段，kwargs 为 chat.infer 的参数（stream 除外）。
+        返回的 Future 结果为与 text 一一对应的一维音频数组列表。
+        """
+        return self._submit(text, text_seed, kwargs).future
+
+    def infer(
+        self, text: List[str], text_seed=0, return_reproducible=False, **kwargs
+    ):
+        """
+        return_reproducible=True 时返回 (音频列表, 是否可复现)，
+        可复现指固定 text_seed 时结果与同时处理的其他请求无关，可用于缓存
+        """
+        job = self._submit(text, text_seed, kwargs)
+        wavs = job.future.result()
+        if return_reproducible:
+            return wavs, job.reproducible and text_seed > 0
+        return wavs
+
+    def _submit(self, text: List[str], text_seed: int, kwargs: dict) -> _Job:
+        if not isinstance(text, list):
+            text = [text]
+        job = _Job(
+            texts=text,
+            kwargs=kwargs,
+            text_seed=text_seed,
+            # 连续批处理不按 seed 复现，seed 不参与分组
+            key=self._make_key(0 if self.continuous else text_seed, kwargs),
+            future=Future(),
+            wavs=[None] * len(text),
+            pending=len(text),
+        )
+        if len(text) == 0:
+            job.reproducible = True
+            job.future.set_result([])
+        else:
+            self._queue.put(job)
+        return job
+
+    def close(self):
+        self._queue.put(None)
+        self._worker.join()
+
+    @staticmethod
+    def _make_key(text_seed: int, kwargs: dict) -> tuple:
+        key = [text_seed]
+        for k in sorted(kwargs.keys()):
+            v = kwargs[k]
+            key.append((k, astuple(v) if is_dataclass(v) else v))
+        return tuple(key)
+
+    def _collect(self, job: _Job) -> List[Optional[_Job]]:
+        # 拿到第一个请求后，在时间窗口内继续收集，直到分段数达到上限
+        jobs = [job]
+        size = len(job.texts)
+        deadline = time.monotonic() + self.batch_window
+        while size < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    nxt = self._queue.get(timeout=timeout)
+                else:
+                    # 窗口已过，仍把已在排队的请求一并带走
+                    nxt = self._queue.get_nowait()
+            except queue.Empty:
+                break
+            jobs.append(nxt)
+            if nxt is None:
+                break
+            size += len(nxt.texts)
+        return jobs
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            jobs = self._collect(job)
+            stop = jobs[-1] is None
+            if stop:
+                jobs.pop()
+            groups: Dict[tuple, List[_Job]] = {}
+            for j in jobs:
+                groups.setdefault(j.key, []).append(j)
+            for group in groups.values():
+                self._run_group(group)
+            if stop:
+                return
+
+    def _run_group(self, group: List[_Job]):
+        segments = [(job, i) for job in group for i in range(len(job.texts))]
+        first = group[0]
+        # 须在设置结果前标记，等待方一拿到结果就会读取
+        first.reproducible = len(group) == 1
+        batches = [
+            segments[start : start + self.max_batch_size]
+            for start in range(0, len(segments), self.max_batch_size)
+        ]
+        for batch in batches:
+            self.logger.info(
+                "run batch of %d segments from %d requests",
+                len(batch),
+                len({id(job) for job, _ in batch}),
+            )
+        try:
+            with self.lock:
+                if self.pipeline and len(batches) > 1:
+                    # 多个 batch 时流水线执行：GPT 生成下一个 batch 的同时解码上一个
+                    results = self.chat.infer_groups(
+                        [[job.texts[i] for job, i in batch] for batch in batches],
+                        seed=first.text_seed if first.text_seed > 0 else None,
+                        queue_size=self.pipeline_queue_size,
+                        return_exceptions=True,
+                        return_lengths=True,
+                        **first.kwargs,
+                    )
+                    for batch, wavs in zip(batches, results):
+                        self._finish_batch(batch, wavs)
+                    return
+                for batch in batches:
+                    try:
+                        if first.text_seed > 0:
+                            torch.manual_seed(first.text_seed)
+                        wavs = self.chat.infer(
+                            [job.texts[i] for job, i in batch],
+                            stream=False,
+                            return_lengths=True,
+                            **first.kwargs,
+                        )
+                    except Exception as e:
+                        wavs = e
+                    self._finish_batch(batch, wavs)
+        except Exception as e:
+            self.logger.exception("group inference failed")
+            for job in group:
+                if not job.future.done():
+                    job.future.set_exception(e)
+
+    def _finish_batch(self, batch: list, result):
+        if isinstance(result, Exception):
+            self.logger.error("batch inference failed", exc_info=result)
+            for job, _ in batch:
+                if not job.future.done():
+                    job.future.set_exception(result)
+            return
+        wavs, lengths = result
+        for (job, i), w, n in zip(batch, wavs, lengths):
+            if job.future.done():
+                continue
+            # 按实际采样点数去掉因与其他分段对齐而补齐的尾部
+            job.wavs[i] = w[:n]
+            job.pending -= 1
+            if job.pending == 0:
+                job.future.set_result(job.wavs)
+
+    def _prepare_text(self, job: _Job) -> List[str]:
+        # 与 chat.infer 相同的文本规范化与 refine 流程
+        kwargs = job.kwargs
+        if not kwargs.get("skip_refine_text", False):
+            return self.chat.infer(
+                list(job.texts),
+                stream=False,
+                refine_text_only=True,
+                **kwargs,
+            )
+        return [
+            self.chat.normalizer(
+                t,
+                kwargs.get("do_text_normalization", True),
+                kwargs.get("do_homophone_replacement", True),
+                kwargs.get("lang", None),
+            )
+            for t in job.texts
+        ]
+
+    def _admit_continuous(self, job: _Job, engines: dict):
+        kwargs = job.kwargs
+        params = kwargs.get("params_infer_code", self.chat.InferCodeParams())
+        use_decoder = kwargs.get("use_decoder", True)
+        try:
+            with self.lock:
+                texts = self._prepare_text(job)
+                engine = engines.get(job.key)
+                if engine is None:
+                    engine = self.chat.new_code_engine(
+                        params, self.max_batch_size, use_decoder
+                    )
+                    engines[job.key] = engine
+                self.chat.submit_code(
+                    engine,
+                    texts,
+                    params,
+                    tags=[(job, i) for i in range(len(texts))],
+                )
+        except Exception as e:
+            self.logger.exception("prepare continuous inference failed")
+            if not job.future.done():
+                job.future.set_exception(e)
+
+    def _step_continuous(self, key: tuple, engine, engines: dict):
+        use_decoder = engine.return_hidden
+        try:
+            with self.lock:
+                outputs = engine.step()
+                if len(outputs) == 0:
+                    return
+                wavs, lengths = self.chat._decode_to_wavs(
+                    [o.hiddens if use_decoder else o.ids for o in outputs],
+                    use_decoder,
+                    return_lengths=True,
+                )
+        except Exception as e:
+            self.logger.exception("continuous inference failed")
+            # 引擎状态已不可信，丢弃并通知其中所有请求
+            engines.pop(key, None)
+            for job, _ in engine.abort():
+                if not job.future.done():
+                    job.future.set_exception(e)
+            return
+        for o, w, n in zip(outputs, wavs, lengths):
+            job, i = o.tag
+            if job.future.done():
+                continue
+            job.wavs[i] = w[:n]
+            job.pending -= 1
+            if job.pending == 0:
+                job.future.set_result(job.wavs)
+        del outputs, wavs
+
+    def _run_continuous(self):
+        engines: Dict[tuple, object] = {}
+        stop = False
+        while not stop or len(engines):
+            # 空闲时阻塞等待，否则只取走已在排队的请求
+            block = len(engines) == 0
+            while not stop:
+                try:
+                    job = self._queue.get() if block else self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                block = False
+                if job is None:
+                    stop = True
+                    break
+                self._admit_continuous(job, engines)
+            for key, engine in list(engines.items()):
+                self._step_continuous(key, engine, engines)
+                if not engine.has_work():
+                    engines.pop(key, None)
@@ -0,0 +1,143 @@
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple
+
+import torch
+
+
+class SpeakerRegistry:
+    """
+    音色注册表
+
+    启动时一次性加载 speaker_dir 下的全部 .pt 音色，之后由后台线程
+    轮询目录的修改时间，增删改的文件会被自动同步；
+    由数字 seed 生成的随机音色在内存中保留最近使用的 seed_cache_size 个，
+    首次生成时若目录中还没有 {seed}.pt 则保存一次，便于在界面中选择，
+    之后由轮询线程像其他文件一样加载。
+    目录中的音色会同时在 tokenizer 中缓存解码后的 embedding，
+    推理时无需再次 lzma 解压。
+    """
+
+    def __init__(
+        self,
+        chat,
+        speaker_dir: str,
+        poll_interval=2.0,
+        seed_cache_size=64,
+        logger=logging.getLogger(__name__),
+    ):
+        self.chat = chat
+        self.speaker_dir = speaker_dir
+        self.poll_interval = poll_interval
+        self.logger = logger
+        self._lock = threading.Lock()
+        # 文件名 -> (修改时间, spk_emb)
+        self._files: Dict[str, Tuple[float, str]] = {}
+        # seed -> spk_emb，按最近使用淘汰
+        self._seeds: "OrderedDict[int, str]" = OrderedDict()
+        self.seed_cache_size = max(1, int(seed_cache_size))
+        self.refresh()
+        self._stop = threading.Event()
+        if poll_interval > 0:
+            threading.Thread(target=self._watch, name="SpeakerRegistry", daemon=True).start()
+
+    def _load(self, path: str) -> str:
+        spk = torch.load(path, map_location="cpu")
+        if isinstance(spk, torch.Tensor):
+            # 旧版本保存的是原始张量，转为无需解压的紧凑格式
+            spk = self.chat.tokenizer._encode_spk_emb(spk, compact=True)
+        return spk
+
+    def _cache(self, spk: str):
+        self.chat.tokenizer.cache_spk_emb(spk, self.chat.gpt.device_gpt)
+
+    def _uncache(self, spk: str):
+        # 仍被其他文件使用时保留
+        if any(v == spk for _, v in self._files.values()):
+            return
+        self.chat.tokenizer.uncache_spk_emb(spk)
+
+    def refresh(self):
+        try:
+            entries = {
+                e.name: e.stat().st_mtime
+                for e in os.scandir(self.speaker_dir)
+                if e.name.endswith(".pt") and e.is_file()
+            }
+        except OSError as e:
+            self.logger.warning(f"scan {self.speaker_dir} failed: {e}")
+            return
+        with self._lock:
+            for name in list(self._files.keys()):
+                if name not in entries:
+                    _, spk = self._files.pop(name)
+                    self._uncache(spk)
+            for name, mtime in entries.items():
+                old = self._files.get(name)
+                if old is not None and old[0] == mtime:
+                    continue
+                try:
+                    spk = self._load(os.path.join(self.speaker_dir, name))
+                except Exception as e:
+                    # 可能正在写入，下次轮询再试
+                    self.logger.warning(f"load speaker {name} failed: {e}")
+                    continue
+                self._files[name] = (mtime, spk)
+                self._cache(spk)
+                if old is not None:
+                    self._uncache(old[1])
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_interval):
+            self.refresh()
+
+    def close(self):
+        self._stop.set()
+
+    def names(self) -> List[str]:
+        with self._lock:
+            return sorted(self._files.keys())
+
+    def get(self, voice: str):
+        """
+        voice 可能是 {voice}.csv、{voice}.pt 或数字 seed，
+        返回 (音色名, spk_emb)，数字 seed 的音色名为 int
+        """
+        voice = voice.replace(".csv", ".pt")
+        if voice.endswith(".pt"):
+            with self._lock:
+                f = self._files.get(voice)
+            if f is None and os.path.exists(os.path.join(self.speaker_dir, voice)):
+                # 新文件尚未被轮询到
+                self.refresh()
+                with self._lock:
+                    f = self._files.get(voice)
+            if f is not None:
+                return voice, f[1]
+
+        voice_int = re.findall(r"^(\d+)", voice)
+        seed = int(voice_int[0]) if len(voice_int) > 0 else 2222
+        with self._lock:
+            spk = self._seeds.get(seed)
+            if spk is not None:
+                self._seeds.move_to_end(seed)
+                return seed, spk
+            # 使用独立的随机数生成器，不打乱调度线程中正在进行的固定 seed 推理
+            spk = self.chat.sample_random_speaker(compact=True, seed=seed)
+            self._seeds[seed] = spk
+            while len(self._seeds) > self.seed_cache_size:
+                self._seeds.popitem(last=False)
+        # 只在首次生成时保存，且在锁外进行
+        path = os.path.join(self.speaker_dir, f"{seed}.pt")
+        if not os.path.exists(path):
+            try:
+                # 先写临时文件再改名，轮询线程不会读到写了一半的文件
+                tmp = f"{path}.{os.getpid()}.tmp"
+                torch.save(spk, tmp)
+                os.replace(tmp, path)
+            except OSError as e:
+                self.logger.warning(f"save speaker {path} failed: {e}")
+        return seed, spk